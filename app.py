@@ -10,6 +10,8 @@ import socket
 import hashlib
 import secrets
 import json
+import threading
+from collections import OrderedDict
 from werkzeug.utils import secure_filename
 
 # 导入所有模块
@@ -33,6 +35,9 @@ app.config['ALLOWED_IMAGE_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['AVATAR_FOLDER'], exist_ok=True)
 
+# 商品卡片 JSON 片段缓存的最大条目数
+CARD_FRAGMENT_CACHE_SIZE = int(os.getenv('CARD_FRAGMENT_CACHE_SIZE', '5000'))
+
 
 def allowed_file(filename):
     """校验图片扩展名"""
@@ -94,6 +99,139 @@ def normalize_listing_collection(listings):
     return [normalize_listing_images(dict(item)) for item in listings]
 
 
+# ===== 商品卡片片段缓存 =====
+class RawJSON(str):
+    """已序列化好的 JSON 片段，拼接响应时原样写入"""
+
+
+_card_fragments = OrderedDict()
+_card_fragments_lock = threading.Lock()
+_card_fragment_stats = {'hits': 0, 'misses': 0}
+
+
+# 片段只缓存物品表字段和卖家信息（按键排序、拼好的 JSON 前缀）；浏览量和各查询附加的字段
+# （距离、评分、热度等）每次单独序列化，按键名顺序追加在前缀之后，view_count 放在最后
+CARD_STATIC_FIELDS = frozenset((
+    'id', 'user_id', 'title', 'description', 'price', 'images', 'category', 'course_code', 'course_code_norm',
+    'isbn', 'isbn_norm', 'community_id', 'meetup_point', 'status', 'created_at', 'updated_at',
+    'latitude', 'longitude', 'user'
+))
+
+
+def _card_version(listing):
+    """
+    卡片的缓存键：(id, updated_at, 卖家信息)
+    
+    物品修改和状态变化都会更新 updated_at；卖家头像、认证状态变化不改物品，单独计入键
+    """
+    user = listing.get('user')
+    return (listing.get('id'), str(listing.get('updated_at')),
+            tuple(user.items()) if isinstance(user, dict) else None)
+
+
+def _dynamic_key(key):
+    return key == 'view_count', key
+
+
+def listing_card_fragment(listing):
+    """单个商品卡片的 JSON 片段（图片和头像已转换为 URL）"""
+    version = _card_version(listing)
+    with _card_fragments_lock:
+        prefix = _card_fragments.get(version)
+        if prefix is not None:
+            _card_fragments.move_to_end(version)
+            _card_fragment_stats['hits'] += 1
+        else:
+            _card_fragment_stats['misses'] += 1
+    
+    if prefix is None:
+        static = normalize_listing_images({key: value for key, value in listing.items() if key in CARD_STATIC_FIELDS})
+        prefix = '{' + ','.join(f'{app.json.dumps(key)}:{app.json.dumps(static[key])}' for key in sorted(static))
+        with _card_fragments_lock:
+            _card_fragments[version] = prefix
+            while len(_card_fragments) > CARD_FRAGMENT_CACHE_SIZE:
+                _card_fragments.popitem(last=False)
+    
+    dynamic = sorted((key for key in listing if key not in CARD_STATIC_FIELDS), key=_dynamic_key)
+    return RawJSON(prefix + ''.join(f',{app.json.dumps(key)}:{app.json.dumps(listing[key])}' for key in dynamic) + '}')
+
+
+def listing_cards(listings):
+    """把商品列表拼接为 JSON 数组片段，每张卡片只在内容变化后重新序列化"""
+    return RawJSON('[' + ','.join(listing_card_fragment(listing) for listing in listings or []) + ']')
+
+
+def get_card_fragment_stats():
+    """卡片片段缓存统计"""
+    with _card_fragments_lock:
+        lookups = _card_fragment_stats['hits'] + _card_fragment_stats['misses']
+        return {
+            'entries': len(_card_fragments),
+            'hits': _card_fragment_stats['hits'],
+            'misses': _card_fragment_stats['misses'],
+            'hit_rate': round(_card_fragment_stats['hits'] / lookups, 4) if lookups else 0
+        }
+
+
+def json_response(value):
+    """
+    JSON 响应，value 中的 RawJSON 片段原样拼接
+    
+    对象按键排序输出，与 jsonify 一致；商品卡片片段中查询附加的字段排在
+    物品字段之后（见 listing_card_fragment）
+    """
+    def encode(item):
+        if isinstance(item, RawJSON):
+            return item
+        if isinstance(item, dict) and any(isinstance(field, RawJSON) for field in item.values()):
+            return '{' + ','.join(f'{app.json.dumps(key)}:{encode(item[key])}' for key in sorted(item)) + '}'
+        return app.json.dumps(item)
+    
+    return app.response_class(encode(value) + '\n', mimetype='application/json')
+
+
+def paginated_response(items, next_cursor):
+    """
+    分页列表响应
+    
+    请求带 cursor 参数（首页可为空）时返回 {items, next_cursor}，
+    否则保持原有的数组格式；下一页游标同时放在 X-Next-Cursor 响应头中。
+    items 可以是 listing_cards 拼好的片段。
+    """
+    if 'cursor' in request.args:
+        response = json_response({'items': items, 'next_cursor': next_cursor})
+    else:
+        response = json_response(items)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+def request_near():
+    """
+    读取附近查询参数 lat、lng、km（距离，默认 3 公里）
+    
+    未提供坐标时返回 None；格式无效时抛出 ValueError
+    """
+    if request.args.get('lat') is None and request.args.get('lng') is None:
+        return None
+    return parse_near((request.args.get('lat'), request.args.get('lng'), request.args.get('km', 3)))
+
+
+def request_list(name, type=str):
+    """读取多选参数：可重复传参或用逗号分隔，如 category=textbook,furniture"""
+    values = []
+    for raw in request.args.getlist(name):
+        for item in raw.split(','):
+            item = item.strip()
+            if item:
+                try:
+                    values.append(type(item))
+                except ValueError:
+                    raise ValueError(f'无效的参数: {name}')
+    return values
+
+
 # ===== 页面路由 =====
 @app.route('/')
 def index():
@@ -282,6 +420,18 @@ def get_communities():
     return jsonify(communities), 200
 
 
+@app.route('/api/communities/nearby', methods=['GET'])
+def get_nearby_communities_api():
+    """获取附近的社区（按距离排序）"""
+    try:
+        near = request_near()
+        if near is None:
+            return jsonify({'error': '缺少位置参数'}), 400
+        return jsonify(get_nearby_communities(*near)), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+
 @app.route('/api/communities/<int:community_id>', methods=['GET'])
 def get_community(community_id):
     """获取社区详情"""
@@ -300,19 +450,87 @@ def get_listings_api():
     status = request.args.get('status', 'active')
     limit = request.args.get('limit', 50, type=int)
     offset = request.args.get('offset', 0, type=int)
+    after = request.args.get('cursor') or None
+    try:
+        near = request_near()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # facets=1：走高级搜索，同一次请求返回当前筛选下的分面计数（仅限在售物品）
+    if request.args.get('facets') in ('1', 'true') and status == 'active':
+        filters = {
+            'community_id': community_id,
+            'category': category if category != 'all' else None,
+            'course_code': request.args.get('course_code') or None,
+            'min_price': request.args.get('min_price', type=float),
+            'max_price': request.args.get('max_price', type=float),
+            'has_images': request.args.get('has_images') in ('1', 'true'),
+            'sort_by': 'created_at',
+            'limit': limit,
+            'offset': offset,
+            'cursor': after,
+            'near': near
+        }
+        try:
+            result = search.search_listings_advanced(request.args.get('q', '').strip(), filters, facets=True)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        next_cursor = make_next_cursor(result['items'], limit, 'created_at', 'id')
+        response = json_response({
+            'items': listing_cards(result['items']),
+            'facets': result['facets'],
+            'next_cursor': next_cursor
+        })
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
+    
+    # 不按位置筛选时走内存位图：分类、社区可多选，另支持价格区间和有无图片
+    if near is None:
+        try:
+            expr = {
+                'category': [value for value in request_list('category') if value != 'all'],
+                'community_id': request_list('community_id', int),
+                'price_bucket': request_list('price_bucket', int),
+                'min_price': request.args.get('min_price', type=float),
+                'max_price': request.args.get('max_price', type=float)
+            }
+            expr = {field: value for field, value in expr.items() if value not in (None, [])}
+            if status != 'all':
+                expr['status'] = status
+            if request.args.get('has_images') in ('1', 'true'):
+                expr['has_images'] = True
+            # 单个社区/分类的在售信息流交给 get_listings，前几页由首页信息流缓存直接返回
+            hot_feed_shape = (status == 'active' and set(expr) <= {'status', 'category', 'community_id'}
+                              and all(len(expr.get(field, ())) <= 1 for field in ('category', 'community_id')))
+            browsed = None if hot_feed_shape else search.browse_listings(expr, limit, offset, after)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if browsed is not None:
+            listings, total = browsed
+            next_cursor = make_next_cursor(listings, limit, 'created_at', 'id')
+            response = paginated_response(listing_cards(listings), next_cursor)
+            response.headers['X-Total-Count'] = str(total)
+            return response, 200
     
-    listings = get_listings(community_id, category, status, limit, offset)
-    return jsonify(normalize_listing_collection(listings)), 200
+    try:
+        listings = get_listings(community_id, category, status, limit, offset, after=after, near=near)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    next_cursor = make_next_cursor(listings, limit, 'created_at', 'id')
+    return paginated_response(listing_cards(listings), next_cursor), 200
 
 
 @app.route('/api/listings/<int:listing_id>', methods=['GET'])
 def get_listing(listing_id):
     """获取商品详情"""
-    increment_view_count(listing_id)
     listing = get_listing_by_id(listing_id)
-    if listing:
-        return jsonify(normalize_listing_images(listing)), 200
-    return jsonify({'error': '物品不存在'}), 404
+    if not listing:
+        return jsonify({'error': '物品不存在'}), 404
+    # 物品存在才计入浏览，返回的浏览量包含本次
+    increment_view_count(listing_id)
+    listing['view_count'] += 1
+    return jsonify(normalize_listing_images(listing)), 200
 
 
 @app.route('/api/favorites', methods=['POST'])
@@ -382,14 +600,18 @@ def get_user_favorites_api(user_id):
 
         limit = request.args.get('limit', 100, type=int)
         offset = request.args.get('offset', 0, type=int)
+        after = request.args.get('cursor') or None
 
-        favorites = get_user_favorites(user_id, limit, offset)
+        favorites = get_user_favorites(user_id, limit, offset, after=after)
         favorite_ids = get_user_favorite_ids(user_id)
 
-        return jsonify({
-            'favorites': normalize_listing_collection(favorites),
-            'favorite_ids': favorite_ids
+        return json_response({
+            'favorites': listing_cards(favorites),
+            'favorite_ids': favorite_ids,
+            'next_cursor': make_next_cursor(favorites, limit, 'favorite_created_at', 'id')
         }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f'获取用户收藏错误: {str(e)}')
         return jsonify({'error': str(e)}), 500
@@ -408,6 +630,7 @@ def get_user_listings_api(user_id):
         community_id = request.args.get('community_id', type=int)
         limit = request.args.get('limit', 50, type=int)
         offset = request.args.get('offset', 0, type=int)
+        after = request.args.get('cursor') or None
         
         listings = get_listings(
             community_id=community_id,
@@ -415,9 +638,13 @@ def get_user_listings_api(user_id):
             status=status,
             limit=limit,
             offset=offset,
-            user_id=user_id
+            user_id=user_id,
+            after=after
         )
-        return jsonify(normalize_listing_collection(listings)), 200
+        next_cursor = make_next_cursor(listings, limit, 'created_at', 'id')
+        return paginated_response(listing_cards(listings), next_cursor), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f'获取用户发布错误: {str(e)}')
         return jsonify({'error': str(e)}), 500
@@ -487,6 +714,14 @@ def create_listing_api():
         except (TypeError, ValueError):
             return jsonify({'error': '用户、社区或价格格式无效'}), 400
 
+        # 可选的交易地点坐标，须同时提供
+        latitude = longitude = None
+        if data.get('latitude') not in (None, '') or data.get('longitude') not in (None, ''):
+            try:
+                latitude, longitude, _ = parse_near((data.get('latitude'), data.get('longitude'), 1))
+            except ValueError:
+                return jsonify({'error': '交易地点坐标无效'}), 400
+
         user = get_user_by_id(user_id)
         if not user or user['verify_status'] == 'unverified':
             return jsonify({'error': '用户未认证，无法发布'}), 403
@@ -526,6 +761,8 @@ def create_listing_api():
             course_code=data.get('course_code'),
             isbn=data.get('isbn'),
             meetup_point=data.get('meetup_point', ''),
+            latitude=latitude,
+            longitude=longitude,
             images=all_images
         )
         
@@ -547,8 +784,44 @@ def search_listings_api():
             return jsonify({'error': '搜索关键词不能为空'}), 400
         
         listings = search_listings(query, community_id, limit)
-        return jsonify(normalize_listing_collection(listings)), 200
         
+        # 结果太少时按纠正拼写后的查询补充
+        corrected = None
+        if len(listings) < min(limit, search.FUZZY_MIN_RESULTS):
+            corrected = search.suggest_correction(query)
+            if corrected:
+                seen = {listing['id'] for listing in listings}
+                listings += [listing for listing in search_listings(corrected, community_id, limit - len(listings))
+                             if listing['id'] not in seen]
+        
+        response = json_response(listing_cards(listings))
+        if corrected:
+            response.headers['X-Corrected-Query'] = corrected
+        return response, 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# ===== 课程相关API =====
+@app.route('/api/courses', methods=['GET'])
+def get_courses_api():
+    """获取课程目录（每门课的在售数量和最低价）"""
+    try:
+        prefix = request.args.get('q', '').strip() or None
+        limit = request.args.get('limit', 100, type=int)
+        return jsonify(get_course_catalog(prefix, limit)), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/courses/<course_code>/listings', methods=['GET'])
+def get_course_listings_api(course_code):
+    """获取某门课程的在售教材"""
+    try:
+        limit = request.args.get('limit', 50, type=int)
+        listings = get_listings_by_course(course_code, limit)
+        return json_response(listing_cards(listings)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -598,8 +871,12 @@ def get_user_threads_api(user_id):
     """获取用户的会话列表"""
     try:
         limit = request.args.get('limit', 50, type=int)
-        threads = get_user_threads(user_id, limit)
-        return jsonify(threads), 200
+        after = request.args.get('cursor') or None
+        threads = get_user_threads(user_id, limit, after=after)
+        next_cursor = make_next_cursor(threads, limit, 'last_message_at', 'id')
+        return paginated_response(threads, next_cursor), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -659,8 +936,12 @@ def get_messages_api(thread_id):
     """获取会话的消息列表"""
     try:
         limit = request.args.get('limit', 100, type=int)
-        messages = get_thread_messages(thread_id, limit)
-        return jsonify(messages), 200
+        after = request.args.get('cursor') or None
+        messages = get_thread_messages(thread_id, limit, after=after)
+        next_cursor = make_next_cursor(messages, limit, 'created_at', 'id')
+        return paginated_response(messages, next_cursor), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -792,6 +1073,23 @@ def get_category_stats_api():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/stats/runtime', methods=['GET'])
+def get_runtime_stats_api():
+    """获取运行时统计（连接池、写队列等）"""
+    try:
+        return jsonify({
+            'db_pool': get_pool_stats(),
+            'write_queue': get_write_queue_stats(),
+            'view_buffer': get_view_buffer_stats(),
+            'result_cache': get_result_cache_stats(),
+            'hot_feed': get_hot_feed_stats(),
+            'card_fragments': get_card_fragment_stats(),
+            'search_index': search.get_search_index_stats()
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 # ===== 健康检查 =====
 @app.route('/api/health', methods=['GET'])
 @app.route('/health', methods=['GET'])
@@ -873,6 +1171,24 @@ def init_app():
     except Exception as e:
         print(f"初始化数据库出错: {e}")
     
+    # 各内存索引相互独立，单个失败不影响其余构建
+    index_builds = [
+        ('搜索索引', search.build_search_index),
+        ('相关商品索引', search.build_related_index),
+        ('热度引擎', search.load_trending),
+        ('筛选位图', search.build_bitmap_index),
+        ('搜索历史压缩', search.compact_search_history),
+        ('热门搜索', search.load_popular_searches)
+    ]
+    for name, build in index_builds:
+        try:
+            build()
+        except Exception as e:
+            app.logger.exception('%s构建失败', name)
+            print(f"✗ {name}构建出错: {e}")
+        else:
+            print(f"✓ {name}已就绪")
+    
     print("应用初始化完成！")
 
 
@@ -6,19 +6,185 @@ Database Module - Fixed Version
 
 import sqlite3
 import json
+import os
+import re
+import base64
+import math
+import time
+import operator
+import queue
+import atexit
+import inspect
+import threading
 from pathlib import Path
 from datetime import datetime
+from functools import wraps
+from collections import OrderedDict
 from contextlib import contextmanager
+from concurrent.futures import Future
+from modules.models import Listing, decode_images
 
 BASE_DIR = Path(__file__).resolve().parent
 DATABASE_PATH = str((BASE_DIR.parent / 'marketplace.db').resolve())
 
+# 连接池配置
+POOL_MAX_IDLE = int(os.getenv('DB_POOL_MAX_IDLE', '8'))
+BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', '16384'))
+MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(128 * 1024 * 1024)))
+
+# 写队列配置：单批最多操作数、合并等待窗口
+WRITE_BATCH_MAX = int(os.getenv('DB_WRITE_BATCH_MAX', '64'))
+WRITE_BATCH_WINDOW_MS = float(os.getenv('DB_WRITE_BATCH_WINDOW_MS', '2'))
+
+# 浏览量缓冲写回间隔（秒）
+VIEW_FLUSH_INTERVAL = float(os.getenv('VIEW_COUNT_FLUSH_INTERVAL', '5'))
+
+# 查询结果缓存：最大条目数、最大占用（字节，按 JSON 长度估算）、过期时间（秒）
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '2048'))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', '60'))
+
+# 首页信息流缓存：每个 (社区, 分类) 保留的最新物品数、最多缓存的组合数
+HOT_FEED_SIZE = int(os.getenv('HOT_FEED_SIZE', '100'))
+HOT_FEED_MAX_WINDOWS = int(os.getenv('HOT_FEED_MAX_WINDOWS', '256'))
+
+# 附近查询允许的最大距离（公里）
+NEARBY_MAX_KM = float(os.getenv('NEARBY_MAX_KM', '50'))
+
+
+# ===== 连接池 =====
+class ConnectionPool:
+    """
+    SQLite 连接池
+
+    连接在创建时统一设置 WAL 等 PRAGMA，用完归还复用，
+    避免每个请求反复建立连接。
+    """
+
+    def __init__(self, max_idle=POOL_MAX_IDLE):
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._path = None
+        self._created = 0
+        self._reused = 0
+        self._closed = 0
+        self._in_use = 0
+
+    @staticmethod
+    def _connect(path):
+        """建立新连接并设置 PRAGMA"""
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.create_function('haversine_km', 4, haversine_km, deterministic=True)
+        return conn
+
+    def _close_idle_locked(self):
+        for conn in self._idle:
+            conn.close()
+            self._closed += 1
+        self._idle = []
+
+    def acquire(self):
+        """取出一个连接，返回 (conn, path)"""
+        path = DATABASE_PATH
+        conn = None
+        with self._lock:
+            # 数据库路径变化时丢弃旧连接
+            if self._path != path:
+                self._close_idle_locked()
+                self._path = path
+            if self._idle:
+                conn = self._idle.pop()
+                self._reused += 1
+            self._in_use += 1
+
+        if conn is None:
+            try:
+                conn = self._connect(path)
+            except Exception:
+                with self._lock:
+                    self._in_use -= 1
+                raise
+            with self._lock:
+                self._created += 1
+        return conn, path
+
+    def release(self, conn, path):
+        """归还连接，空闲连接过多或路径已变化时直接关闭"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            path = None
+
+        with self._lock:
+            self._in_use -= 1
+            if path == self._path and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self._closed += 1
+        conn.close()
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        with self._lock:
+            self._close_idle_locked()
+
+    def stats(self):
+        """连接池统计"""
+        with self._lock:
+            return {
+                'created': self._created,
+                'reused': self._reused,
+                'closed': self._closed,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'max_idle': self.max_idle
+            }
+
+
+_pool = ConnectionPool()
+_local = threading.local()
+
 
 @contextmanager
 def get_db():
-    """获取数据库连接的上下文管理器"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
+    """
+    获取数据库连接的上下文管理器
+
+    连接来自连接池；同一线程内嵌套调用复用同一连接，
+    内层以 SAVEPOINT 隔离，只有最外层负责提交或回滚。
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.depth += 1
+        savepoint = f'sp_{_local.depth}'
+        # 外层尚未开启事务时先开启，否则 SAVEPOINT 自身成为事务、RELEASE 即提交
+        if not conn.in_transaction:
+            conn.execute('BEGIN')
+        conn.execute(f'SAVEPOINT {savepoint}')
+        try:
+            yield conn
+            conn.execute(f'RELEASE {savepoint}')
+        except Exception as e:
+            conn.execute(f'ROLLBACK TO {savepoint}')
+            conn.execute(f'RELEASE {savepoint}')
+            raise e
+        finally:
+            _local.depth -= 1
+        return
+
+    conn, path = _pool.acquire()
+    _local.conn = conn
+    _local.depth = 0
     try:
         yield conn
         conn.commit()
@@ -26,10 +192,824 @@ def get_db():
         conn.rollback()
         raise e
     finally:
-        conn.close()
+        _local.conn = None
+        _pool.release(conn, path)
+
+
+def get_pool_stats():
+    """获取连接池统计信息"""
+    return _pool.stats()
+
+
+def close_pool():
+    """关闭连接池中的空闲连接"""
+    _pool.close_all()
+
+
+# ===== 写入队列 =====
+class WriteQueue:
+    """
+    单写线程队列
+
+    写操作以 op(cursor) 的形式入队，由专用线程在一个事务里批量执行
+    （组提交）。每个操作用 SAVEPOINT 隔离，单个失败不影响同批其他操作。
+    调用方拿到 Future，提交完成后才返回结果。
+    """
+
+    def __init__(self, max_batch=WRITE_BATCH_MAX, window_ms=WRITE_BATCH_WINDOW_MS):
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._batches = 0
+        self._ops = 0
+        self._failed = 0
+        self._max_batch_seen = 0
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, op):
+        """提交写操作，返回 Future"""
+        future = Future()
+        # 写线程内部或已持有事务的线程直接执行，避免互相等待
+        if threading.current_thread() is self._thread or getattr(_local, 'conn', None) is not None:
+            try:
+                with get_db() as conn:
+                    future.set_result(op(conn.cursor()))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        self._ensure_started()
+        self._queue.put((op, future))
+        return future
+
+    def execute(self, op):
+        """提交写操作并等待结果"""
+        return self.submit(op).result()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+            if stop:
+                return
+
+    def _commit_batch(self, batch):
+        started = [(op, future) for op, future in batch if future.set_running_or_notify_cancel()]
+        outcomes = []
+        try:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                # 整批在一个事务里执行，否则每个 SAVEPOINT/RELEASE 都会单独提交
+                cursor.execute('BEGIN IMMEDIATE')
+                for op, future in started:
+                    cursor.execute('SAVEPOINT write_op')
+                    try:
+                        result = op(cursor)
+                    except Exception as e:
+                        cursor.execute('ROLLBACK TO write_op')
+                        cursor.execute('RELEASE write_op')
+                        outcomes.append((future, None, e))
+                    else:
+                        cursor.execute('RELEASE write_op')
+                        outcomes.append((future, result, None))
+        except Exception as e:
+            # 开启或提交事务失败，整批操作都未生效
+            outcomes = [(future, None, e) for _, future in started]
+
+        with self._lock:
+            self._batches += 1
+            self._ops += len(outcomes)
+            self._failed += sum(1 for _, _, error in outcomes if error is not None)
+            self._max_batch_seen = max(self._max_batch_seen, len(outcomes))
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, timeout=5):
+        """处理完已入队的写操作后停止写线程"""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+
+    def stats(self):
+        """写队列统计"""
+        with self._lock:
+            return {
+                'batches': self._batches,
+                'ops': self._ops,
+                'failed': self._failed,
+                'pending': self._queue.qsize(),
+                'avg_batch': round(self._ops / self._batches, 2) if self._batches else 0,
+                'max_batch': self._max_batch_seen
+            }
+
+
+_writer = WriteQueue()
+atexit.register(_writer.shutdown)
+
+
+def submit_write(op):
+    """提交写操作到写队列，返回 Future"""
+    return _writer.submit(op)
+
+
+def execute_write(op):
+    """通过写队列执行写操作并返回结果"""
+    return _writer.execute(op)
+
+
+def get_write_queue_stats():
+    """获取写队列统计信息"""
+    return _writer.stats()
+
+
+# ===== 浏览量缓冲 =====
+class ViewCountBuffer:
+    """
+    浏览量累加器
+
+    浏览次数先在内存中按 listing_id 累加，由后台线程定期
+    用一次 executemany 批量写回；读取时加上未落库的增量。
+    """
+
+    def __init__(self, interval=VIEW_FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._flushes = 0
+        self._flushed_views = 0
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='view-count-flusher', daemon=True)
+                self._thread.start()
+
+    def add(self, listing_id, count=1):
+        """累加浏览次数"""
+        with self._lock:
+            self._pending[listing_id] = self._pending.get(listing_id, 0) + count
+        self._ensure_started()
+
+    def pending(self, listing_id):
+        """获取尚未写入数据库的浏览增量"""
+        with self._lock:
+            return self._pending.get(listing_id, 0) + self._inflight.get(listing_id, 0)
+
+    def flush(self):
+        """把累积的浏览次数批量写回数据库，返回涉及的物品数"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch = self._pending
+                self._pending = {}
+                self._inflight = batch
+
+            rows = [(count, listing_id) for listing_id, count in batch.items()]
+            try:
+                execute_write(lambda cursor: cursor.executemany(
+                    'UPDATE listings SET view_count = view_count + ? WHERE id = ?', rows
+                ))
+            except Exception:
+                # 写入失败，增量放回待写队列
+                with self._lock:
+                    for listing_id, count in batch.items():
+                        self._pending[listing_id] = self._pending.get(listing_id, 0) + count
+                    self._inflight = {}
+                raise
+
+            with self._lock:
+                self._inflight = {}
+                self._flushes += 1
+                self._flushed_views += sum(batch.values())
+            return len(batch)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'浏览量写回失败: {e}')
+
+    def shutdown(self):
+        """停止后台线程并写回剩余增量"""
+        self._stop.set()
+        self.flush()
+
+    def stats(self):
+        """浏览量缓冲统计"""
+        with self._lock:
+            return {
+                'pending_listings': len(self._pending),
+                'pending_views': sum(self._pending.values()),
+                'flushes': self._flushes,
+                'flushed_views': self._flushed_views
+            }
+
+
+_view_buffer = ViewCountBuffer()
+atexit.register(_view_buffer.shutdown)
+
+
+def get_pending_views(listing_id):
+    """获取物品尚未落库的浏览次数"""
+    return _view_buffer.pending(listing_id)
+
+
+def flush_view_counts():
+    """立即写回缓冲中的浏览次数"""
+    return _view_buffer.flush()
+
+
+def get_view_buffer_stats():
+    """获取浏览量缓冲统计信息"""
+    return _view_buffer.stats()
+
+
+# ===== 分页游标 =====
+def encode_cursor(*values):
+    """把排序键编码为不透明的分页游标"""
+    raw = json.dumps(list(values), ensure_ascii=False, separators=(',', ':'), default=str)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, size=2):
+    """解析分页游标，格式无效时抛出 ValueError"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('无效的分页游标')
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('无效的分页游标')
+    return values
+
+
+def make_next_cursor(items, limit, *fields):
+    """根据本页最后一条记录生成下一页游标，已到末页时返回 None"""
+    if not items or not limit or len(items) < limit:
+        return None
+    last = items[-1]
+    return encode_cursor(*(last[field] for field in fields))
+
+
+# ===== 查询结果缓存 =====
+class ResultCache:
+    """
+    物品查询结果缓存（LRU + TTL）
+    
+    每个条目带一个范围 (community_id, category, user_id)，None 表示不限，
+    存取前都经 cache_scope 标准化。物品变更时只清除范围能覆盖该物品的条目；
+    按条目数和估算的 JSON 大小淘汰最久未用的条目。
+    
+    浏览量只在写回时更新物品行，不触发失效：缓存结果中的 view_count
+    停留在计算时的值，最多滞后 RESULT_CACHE_TTL 秒，这是有意为之。
+    """
+    
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._scopes = {}
+        self._bytes = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+    
+    def _drop_locked(self, key):
+        expires, value, scope, size = self._entries.pop(key)
+        self._bytes -= size
+        keys = self._scopes.get(scope)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._scopes[scope]
+    
+    def fetch(self, key, scope, compute):
+        """命中时返回缓存结果的副本，否则调用 compute 并缓存"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return _copy_result(entry[1])
+            if entry is not None:
+                self._drop_locked(key)
+            self._misses += 1
+            generation = self._generation
+        
+        value = compute()
+        size = len(json.dumps(value, default=str, ensure_ascii=False))
+        
+        with self._lock:
+            # 计算期间发生过失效则不缓存，避免写入旧结果
+            if generation == self._generation and size <= self.max_bytes:
+                if key in self._entries:
+                    self._drop_locked(key)
+                self._entries[key] = (now + self.ttl, value, scope, size)
+                self._scopes.setdefault(scope, set()).add(key)
+                self._bytes += size
+                while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                    self._drop_locked(next(iter(self._entries)))
+                    self._evictions += 1
+        return _copy_result(value)
+    
+    def invalidate(self, community_id=None, category=None, user_id=None):
+        """清除范围覆盖 (community_id, category, user_id) 的条目"""
+        community_id, category, user_id = cache_scope(community_id, category, user_id)
+        with self._lock:
+            self._generation += 1
+            for scope in [(c, k, u) for c in {None, community_id} for k in {None, category} for u in {None, user_id}]:
+                for key in list(self._scopes.get(scope, ())):
+                    self._drop_locked(key)
+                    self._invalidations += 1
+    
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._scopes.clear()
+            self._bytes = 0
+    
+    def stats(self):
+        """缓存统计"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else 0,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations
+            }
+
+
+def cache_scope(community_id=None, category=None, user_id=None):
+    """
+    标准化缓存范围
+    
+    'all'、空值视为不限（None）；社区和用户 id 转为整数，无法识别的值
+    （如多选列表）也视为不限，这样任何物品变更都会清除该条目
+    """
+    def identifier(value):
+        if not value or value == 'all':
+            return None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    
+    if not isinstance(category, str) or category in ('', 'all'):
+        category = None
+    return identifier(community_id), category, identifier(user_id)
+
+
+def _copy_result(value):
+    """复制缓存结果，调用方修改返回值不会影响缓存"""
+    if isinstance(value, list):
+        return [dict(item) if isinstance(item, dict) else item for item in value]
+    if isinstance(value, dict):
+        return {key: _copy_result(item) if isinstance(item, list) else item for key, item in value.items()}
+    return value
+
+
+def _freeze(value):
+    """把参数转换为可哈希的缓存键"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+_result_cache = ResultCache()
+
+
+def cached_result(scope, key=None):
+    """
+    查询结果缓存装饰器
+    
+    scope(arguments) 返回结果的范围 (community_id, category, user_id)，由 cache_scope 标准化；
+    key(arguments) 可返回标准化后的参数，默认使用全部参数。
+    在事务内（当前线程已持有连接）调用时不走缓存，以免缓存未提交的数据。
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, 'conn', None) is not None or RESULT_CACHE_TTL <= 0:
+                return func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = bound.arguments
+            cache_key = (func.__module__, func.__qualname__, _freeze(key(arguments) if key else arguments))
+            return _result_cache.fetch(cache_key, cache_scope(*scope(arguments)), lambda: func(*args, **kwargs))
+        
+        wrapper.uncached = func
+        return wrapper
+    return decorator
+
+
+def invalidate_listing_results(community_id=None, category=None, user_id=None):
+    """物品变更后清除受影响的缓存结果（在通知监听器之后调用，内存索引已是最新）"""
+    _result_cache.invalidate(community_id, category, user_id)
+
+
+def get_result_cache_stats():
+    """获取查询结果缓存统计"""
+    return _result_cache.stats()
+
+
+# ===== 行映射 =====
+# 卖家列 -> user 字典中的键
+SELLER_COLUMNS = {'seller_id': 'id', 'nickname': 'nickname', 'verify_status': 'verify_status', 'avatar': 'avatar'}
+# listings 表中映射到 Listing 槽位的列（images 单独处理，延迟解析）
+LISTING_FIELDS = ('id', 'user_id', 'title', 'description', 'price', 'category', 'course_code', 'isbn',
+                  'course_code_norm', 'isbn_norm', 'community_id', 'latitude', 'longitude', 'meetup_point',
+                  'status', 'view_count', 'created_at', 'updated_at')
+
+
+class ListingRowMapper:
+    """
+    物品查询行 -> Listing 记录
+    
+    按列名预先生成一个按位置赋值的构造函数：listings 列写入 Listing 槽位，
+    images 保留原始 JSON 串（首次访问时解析），卖家列（nickname、verify_status、
+    avatar、seller_id）收进 user 字典，其余列放进 extra。
+    没有 seller_id 列时用 user_id 作为卖家 ID。
+    """
+    
+    __slots__ = ('hydrate',)
+    
+    def __init__(self, columns):
+        index = {}
+        for position, name in enumerate(columns):
+            index.setdefault(name, position)
+        
+        def value(name):
+            return 'row[%d]' % index[name] if name in index else 'None'
+        
+        lines = ['def hydrate(row):', '    record = new(Listing)']
+        lines += ['    record.%s = %s' % (name, value(name)) for name in LISTING_FIELDS]
+        lines += ['    record._raw_images = %s' % value('images'), '    record._images = None']
+        seller = [(SELLER_COLUMNS[name], position) for name, position in index.items() if name in SELLER_COLUMNS]
+        if 'seller_id' not in index and 'user_id' in index:
+            seller.insert(0, ('id', index['user_id']))
+        lines.append('    record.user = {%s}' % ', '.join('%r: row[%d]' % item for item in seller))
+        extra = [(name, position) for name, position in index.items()
+                 if name not in SELLER_COLUMNS and name not in LISTING_FIELDS and name != 'images']
+        lines.append('    record.extra = %s' % ('{%s}' % ', '.join('%r: row[%d]' % item for item in extra)
+                                               if extra else 'None'))
+        lines.append('    return record')
+        namespace = {'new': Listing.__new__, 'Listing': Listing}
+        exec(compile('\n'.join(lines), '<listing row mapper>', 'exec'), namespace)
+        self.hydrate = namespace['hydrate']
+    
+    def __call__(self, row):
+        return self.hydrate(row).to_dict()
+
+
+_row_mappers = {}
+
+
+def _columns_row_mapper(columns):
+    mapper = _row_mappers.get(columns)
+    if mapper is None:
+        mapper = _row_mappers[columns] = ListingRowMapper(columns)
+    return mapper
+
+
+def listing_row_mapper(cursor):
+    """按当前查询的列取得（或编译）行映射器，同样的列只编译一次"""
+    return _columns_row_mapper(tuple(column[0] for column in cursor.description))
+
+
+def map_listing_dict(row):
+    """把物品变更监听器收到的行（列名 -> 值）转换为结果字典"""
+    return _columns_row_mapper(tuple(row))(tuple(row.values()))
+
+
+def map_listing_rows(cursor, rows=None):
+    """把物品查询结果（默认取游标剩余的全部行）转换为结果字典列表"""
+    if rows is None:
+        rows = cursor.fetchall()
+    if not rows:
+        return []
+    hydrate = listing_row_mapper(cursor).hydrate
+    return [hydrate(row).to_dict() for row in rows]
+
+
+# ===== 物品变更监听 =====
+class ListingListener:
+    """
+    物品变更监听器基类（内存索引和缓存共用）
+    
+    子类加载完成后把 _ready 置为真，并实现 _apply(listing_id, row)：row 为物品
+    当前行（listings 全部列加卖家列，见 _notify_listing_change），已删除时为 None。
+    row 由所有监听器共享，不要修改。未就绪时忽略变更。
+    stats() 返回 ready、updates 加上子类 _stats_locked() 的内容。
+    """
+    
+    def __init__(self, lock=None):
+        self._lock = lock if lock is not None else threading.RLock()
+        self._ready = False
+        self._updates = 0
+    
+    @property
+    def ready(self):
+        return self._ready
+    
+    def on_listing_change(self, event, listing_id, row=None):
+        """物品变更监听器（见 register_listing_listener）"""
+        if not self.ready:
+            return
+        self._apply(listing_id, None if event == 'deleted' else row)
+        with self._lock:
+            self._updates += 1
+    
+    def _apply(self, listing_id, row):
+        raise NotImplementedError
+    
+    def _stats_locked(self):
+        return {}
+    
+    def stats(self):
+        """统计信息"""
+        with self._lock:
+            stats = {'ready': self.ready, 'updates': self._updates}
+            stats.update(self._stats_locked())
+            return stats
+
+
+# ===== 首页信息流缓存 =====
+class HotFeedCache(ListingListener):
+    """
+    首页信息流缓存
+    
+    按 (community_id, category) 保存最新 HOT_FEED_SIZE 个在售物品的完整卡片
+    （图片已解析、带卖家信息），首次访问时加载一次，之后由物品变更、浏览和
+    卖家资料更新增量维护，不设过期时间。同一物品的卡片在各组合间共享。
+    落在窗口内的 get_listings 分页直接从内存切片返回，不查库也不解析 JSON。
+    """
+    
+    def __init__(self, size=HOT_FEED_SIZE, max_windows=HOT_FEED_MAX_WINDOWS):
+        super().__init__(threading.Lock())
+        self.size = size
+        self.max_windows = max_windows
+        self._windows = OrderedDict()
+        self._cards = {}
+        self._path = None
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._loads = 0
+    
+    @property
+    def ready(self):
+        # 还没有加载过任何窗口时无需维护
+        return bool(self._windows)
+    
+    @staticmethod
+    def _sort_key(card):
+        return (card['created_at'] or '', card['id'])
+    
+    @staticmethod
+    def _window_keys(card):
+        """卡片所属的全部组合"""
+        return {(None, None), (card['community_id'], None), (None, card['category']),
+                (card['community_id'], card['category'])}
+    
+    @staticmethod
+    def _copy(card):
+        return dict(card, user=dict(card['user']), images=list(card['images']))
+    
+    def _check_path_locked(self):
+        # 数据库路径变化时丢弃全部窗口
+        if self._path != DATABASE_PATH:
+            self._path = DATABASE_PATH
+            self._windows.clear()
+            self._cards.clear()
+            self._generation += 1
+    
+    def _release_locked(self, card):
+        """卡片不再属于任何窗口时移出共享表"""
+        listing_id = card['id']
+        for key in self._window_keys(card):
+            window = self._windows.get(key)
+            if window is not None and listing_id in window['ids']:
+                return
+        self._cards.pop(listing_id, None)
+    
+    def _insert_locked(self, window, card):
+        position = len(window['cards'])
+        sort_key = self._sort_key(card)
+        while position > 0 and self._sort_key(window['cards'][position - 1]) < sort_key:
+            position -= 1
+        # 比窗口内所有卡片都旧：窗口不完整或已满时，窗口外可能还有更新的物品，不能放入
+        if position == len(window['cards']) and not (window['complete'] and position < self.size):
+            window['complete'] = False
+            return
+        window['cards'].insert(position, card)
+        window['ids'].add(card['id'])
+        if len(window['cards']) > self.size:
+            dropped = window['cards'].pop()
+            window['ids'].discard(dropped['id'])
+            window['complete'] = False
+            self._release_locked(dropped)
+    
+    def _load(self, key):
+        """从数据库加载一个组合的最新物品"""
+        with self._lock:
+            self._check_path_locked()
+            generation = self._generation
+        
+        community_id, category = key
+        cards = _query_listings.uncached(community_id, category, 'active', self.size, 0)
+        for card in cards:
+            card['view_count'] = (card['view_count'] or 0) + _view_buffer.pending(card['id'])
+        
+        with self._lock:
+            self._loads += 1
+            window = {'cards': cards, 'ids': {card['id'] for card in cards}, 'complete': len(cards) < self.size}
+            # 加载期间有物品变更则只用于本次请求，不放入缓存
+            if generation != self._generation:
+                return window
+            # 复用已在其他窗口中的卡片，保证浏览增量等修改对所有窗口可见
+            window['cards'] = [self._cards.setdefault(card['id'], card) for card in cards]
+            self._windows[key] = window
+            while len(self._windows) > self.max_windows:
+                _, evicted = self._windows.popitem(last=False)
+                for card in evicted['cards']:
+                    self._release_locked(card)
+            return window
+    
+    def page(self, community_id=None, category=None, limit=50, offset=0, after=None):
+        """
+        从缓存取一页（按 created_at, id 倒序）
+        
+        after 为 (created_at, id)，提供时忽略 offset；所需范围超出窗口时返回 None
+        """
+        key = (community_id or None, category or None)
+        with self._lock:
+            self._check_path_locked()
+            window = self._windows.get(key)
+            if window is not None:
+                self._windows.move_to_end(key)
+        if window is None:
+            window = self._load(key)
+        
+        with self._lock:
+            cards = window['cards']
+            if after is not None:
+                after = tuple(after)
+                start = next((i for i, card in enumerate(cards) if self._sort_key(card) < after), len(cards))
+            else:
+                start = offset
+            if start + limit > len(cards) and not window['complete']:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return [self._copy(card) for card in cards[start:start + limit]]
+    
+    def _apply(self, listing_id, row):
+        """移出旧卡片，仍在售则放回所属组合"""
+        card = None
+        if row is not None and row['status'] == 'active':
+            card = map_listing_dict(row)
+            card['view_count'] = (card['view_count'] or 0) + _view_buffer.pending(listing_id)
+        
+        with self._lock:
+            self._generation += 1
+            old = self._cards.pop(listing_id, None)
+            if old is not None:
+                for key in self._window_keys(old):
+                    window = self._windows.get(key)
+                    if window is not None and listing_id in window['ids']:
+                        window['ids'].discard(listing_id)
+                        window['cards'] = [item for item in window['cards'] if item['id'] != listing_id]
+            if card is not None:
+                for key in self._window_keys(card):
+                    window = self._windows.get(key)
+                    if window is not None:
+                        self._insert_locked(window, card)
+                if any(listing_id in window['ids'] for window in self._windows.values()):
+                    self._cards[listing_id] = card
+            # 删除过多、剩余不到一半的窗口下次访问时重新加载
+            for key in [key for key, window in self._windows.items()
+                        if not window['complete'] and len(window['cards']) < self.size // 2]:
+                for dropped in self._windows.pop(key)['cards']:
+                    self._release_locked(dropped)
+    
+    def on_activity(self, event, listing_id):
+        """浏览监听器：卡片上的浏览量随之增加"""
+        if event != 'view':
+            return
+        with self._lock:
+            card = self._cards.get(listing_id)
+            if card is not None:
+                card['view_count'] = (card['view_count'] or 0) + 1
+    
+    def update_seller(self, user_id, **fields):
+        """卖家资料（头像、认证状态）变化时更新其卡片上的卖家信息"""
+        with self._lock:
+            for card in self._cards.values():
+                if card['user']['id'] == user_id:
+                    card['user'].update(fields)
+    
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._windows.clear()
+            self._cards.clear()
+            self._generation += 1
+    
+    def _stats_locked(self):
+        lookups = self._hits + self._misses
+        return {
+            'windows': len(self._windows),
+            'cards': len(self._cards),
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_rate': round(self._hits / lookups, 4) if lookups else 0,
+            'loads': self._loads
+        }
+
+
+_hot_feed = HotFeedCache()
+
+
+def get_hot_feed_stats():
+    """获取首页信息流缓存统计"""
+    return _hot_feed.stats()
+
+
+# ===== 全文索引 =====
+# bm25 字段权重：title, description, course_code, category
+FTS_COLUMN_WEIGHTS = '10.0, 3.0, 20.0, 5.0'
+# trigram 分词可匹配的最短搜索词长度
+FTS_MIN_QUERY_LENGTH = 3
+_fts_available = {}
 
 
 # ===== 数据库初始化 =====
+# 已被复合索引（以其为前缀）取代的旧索引
+SUPERSEDED_INDEXES = [
+    'idx_listings_user',
+    'idx_listings_status',
+    'idx_threads_buyer',
+    'idx_threads_seller',
+    'idx_messages_thread',
+    'idx_notifications_user',
+    'idx_notifications_unread'
+]
+
+
 def init_database():
     """初始化数据库表结构"""
     with get_db() as conn:
@@ -89,7 +1069,11 @@ def init_database():
                 category TEXT NOT NULL,
                 course_code TEXT,
                 isbn TEXT,
+                course_code_norm TEXT,
+                isbn_norm TEXT,
                 community_id INTEGER NOT NULL,
+                latitude REAL,
+                longitude REAL,
                 meetup_point TEXT,
                 status TEXT DEFAULT 'active',
                 view_count INTEGER DEFAULT 0,
@@ -208,37 +1192,541 @@ def init_database():
             )
         ''')
         
+        print("创建搜索历史汇总表...")
+        # 超过保留期的原始搜索记录压缩为按天汇总和每个用户最近的搜索词
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS search_history_daily (
+                day TEXT NOT NULL,
+                query TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (day, query)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS search_history_user (
+                user_id INTEGER NOT NULL,
+                query TEXT NOT NULL,
+                last_searched TIMESTAMP NOT NULL,
+                PRIMARY KEY (user_id, query),
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        ''')
+        
+        print("创建相关商品表...")
+        # 每个在售物品预先计算的前 N 个相似物品
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS listing_related (
+                listing_id INTEGER NOT NULL,
+                rank INTEGER NOT NULL,
+                related_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (listing_id, rank),
+                FOREIGN KEY (listing_id) REFERENCES listings(id),
+                FOREIGN KEY (related_id) REFERENCES listings(id)
+            )
+        ''')
+        
+        print("创建热门搜索统计表...")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS search_trend_buckets (
+                bucket TEXT NOT NULL,
+                query TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                error INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket, query)
+            )
+        ''')
+        
+        print("迁移物品表字段...")
+        _migrate_listing_columns(cursor)
+        
+        print("创建课程目录...")
+        _init_course_catalog(cursor)
+        
+        print("创建统计计数表...")
+        _init_stats_counters(cursor)
+        
+        print("创建分类统计表...")
+        _init_category_stats(cursor)
+        
+        print("创建空间索引...")
+        try:
+            _init_geo_index(cursor)
+        except sqlite3.OperationalError as e:
+            print(f"⚠ 当前 SQLite 不支持 R*Tree，附近查询将直接比较经纬度: {e}")
+        
+        print("创建全文索引...")
+        try:
+            _init_fts_index(cursor)
+        except sqlite3.OperationalError as e:
+            print(f"⚠ 当前 SQLite 不支持 FTS5 trigram 分词，搜索将使用 LIKE: {e}")
+        
         print("创建索引...")
         # 用户表索引
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_openid ON users(openid)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)')
         
         # 物品表索引
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_user ON listings(user_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_community ON listings(community_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_category ON listings(category)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_status ON listings(status)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_search ON listings(status, category, community_id)')
-        
-        # 会话表索引
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_threads_buyer ON threads(buyer_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_threads_seller ON threads(seller_id)')
+        # 信息流: WHERE status [AND community_id] [AND category] ORDER BY created_at DESC, id DESC
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_status_created ON listings(status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_status_community_created ON listings(status, community_id, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_status_category_created ON listings(status, category, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_status_community_category_created ON listings(status, community_id, category, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_created ON listings(created_at)')
+        # 用户发布: WHERE user_id [AND status] ORDER BY created_at DESC
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_user_created ON listings(user_id, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_user_status_created ON listings(user_id, status, created_at)')
+        # 高级搜索按价格/浏览量排序
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_status_price ON listings(status, price)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_status_views ON listings(status, view_count)')
+        # 分类统计（覆盖 COUNT/AVG/MIN/MAX）
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_status_category_price ON listings(status, category, price)')
+        # 按课程 / ISBN 查教材，同时覆盖课程目录的 MIN(price) 重算
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_course_status_price ON listings(course_code_norm, status, price)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_listings_isbn_status ON listings(isbn_norm, status)')
+        
+        # 会话表索引: WHERE buyer_id/seller_id ORDER BY last_message_at DESC
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_threads_buyer_last ON threads(buyer_id, last_message_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_threads_seller_last ON threads(seller_id, last_message_at)')
         
         # 消息表索引
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_thread ON messages(thread_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_thread_created ON messages(thread_id, created_at)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_to_user ON messages(to_user_id, is_read)')
         
+        # 收藏表索引: WHERE user_id ORDER BY created_at DESC, listing_id DESC
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_favorites_user_created ON favorites(user_id, created_at, listing_id)')
+        
         # 通知表索引
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_user ON notifications(user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_unread ON notifications(user_id, is_read)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications(user_id, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_user_unread_created ON notifications(user_id, is_read, created_at)')
+        
+        # 举报、评价表索引
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reports_pending ON reports(handled, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reviews_reviewee_created ON reviews(reviewee_id, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reviews_listing ON reviews(listing_id, rating)')
         
         # 搜索历史索引
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_history_user ON search_history(user_id, created_at DESC)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_history_query ON search_history(query)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_history_created ON search_history(created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_history_user_last ON search_history_user(user_id, last_searched)')
+        
+        # 移除已被复合索引覆盖的旧索引
+        for index_name in SUPERSEDED_INDEXES:
+            cursor.execute(f'DROP INDEX IF EXISTS {index_name}')
         
         print("✓ 数据库表创建完成")
 
 
+def _init_fts_index(cursor):
+    """创建物品全文索引（FTS5 trigram，中英文均可做子串匹配）及同步触发器"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'listings_fts'")
+    exists = cursor.fetchone() is not None
+    
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(
+            title, description, course_code, category,
+            content='listings', content_rowid='id',
+            tokenize='trigram'
+        )
+    ''')
+    # 默认 rank 使用与 SearchEngine 一致的字段权重
+    cursor.execute(
+        "INSERT INTO listings_fts(listings_fts, rank) VALUES('rank', ?)",
+        (f'bm25({FTS_COLUMN_WEIGHTS})',)
+    )
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS listings_fts_insert AFTER INSERT ON listings BEGIN
+            INSERT INTO listings_fts (rowid, title, description, course_code, category)
+            VALUES (new.id, new.title, new.description, new.course_code, new.category);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS listings_fts_delete AFTER DELETE ON listings BEGIN
+            INSERT INTO listings_fts (listings_fts, rowid, title, description, course_code, category)
+            VALUES ('delete', old.id, old.title, old.description, old.course_code, old.category);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS listings_fts_update
+        AFTER UPDATE OF title, description, course_code, category ON listings BEGIN
+            INSERT INTO listings_fts (listings_fts, rowid, title, description, course_code, category)
+            VALUES ('delete', old.id, old.title, old.description, old.course_code, old.category);
+            INSERT INTO listings_fts (rowid, title, description, course_code, category)
+            VALUES (new.id, new.title, new.description, new.course_code, new.category);
+        END
+    ''')
+    
+    # 首次创建时为已有数据建立索引
+    if not exists:
+        cursor.execute("INSERT INTO listings_fts(listings_fts) VALUES('rebuild')")
+    _fts_available.pop(DATABASE_PATH, None)
+
+
+def has_fts_index():
+    """当前数据库是否已建立物品全文索引"""
+    path = DATABASE_PATH
+    if path not in _fts_available:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'listings_fts'")
+            _fts_available[path] = cursor.fetchone() is not None
+    return _fts_available[path]
+
+
+def build_fts_query(text, columns=None):
+    """
+    把搜索词转换为 FTS5 MATCH 表达式（整体作为子串短语匹配）
+    
+    trigram 分词要求至少 3 个字符，更短的搜索词返回 None，由调用方回退到 LIKE
+    """
+    text = ' '.join((text or '').split())
+    if len(text) < FTS_MIN_QUERY_LENGTH:
+        return None
+    phrase = '"' + text.replace('"', '""') + '"'
+    if columns:
+        return '{' + ' '.join(columns) + '} : ' + phrase
+    return phrase
+
+
+# ===== 课程代码与 ISBN =====
+def normalize_course_code(code):
+    """标准化课程代码: CS-UY 1134 / cs uy 1134 -> CSUY1134"""
+    if not code:
+        return ''
+    return re.sub(r'[^\w]', '', str(code).upper())
+
+
+ISBN10_PATTERN = re.compile(r'^\d{9}[\dX]$')
+
+
+def _isbn10_checksum_valid(isbn):
+    """ISBN-10 校验：各位依次乘以 10..1 求和能被 11 整除（末位 X 表示 10）"""
+    digits = [10 if char == 'X' else int(char) for char in isbn]
+    return sum(weight * digit for weight, digit in zip(range(10, 0, -1), digits)) % 11 == 0
+
+
+def normalize_isbn(isbn):
+    """
+    标准化 ISBN：去掉连字符和空格，ISBN-10 转为 ISBN-13
+    
+    不符合 ISBN-10 格式（如 X 不在末位）或校验位错误的值只做清理，不转换
+    """
+    if not isbn:
+        return ''
+    isbn = re.sub(r'[^0-9X]', '', str(isbn).upper())
+    if ISBN10_PATTERN.match(isbn) and _isbn10_checksum_valid(isbn):
+        body = '978' + isbn[:9]
+        check = (10 - sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(body)) % 10) % 10
+        isbn = body + str(check)
+    return isbn
+
+
+def _ensure_column(cursor, table, column, definition):
+    """旧库缺少某列时补上，返回是否新增"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column in {row[1] for row in cursor.fetchall()}:
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return True
+
+
+def _migrate_listing_columns(cursor):
+    """为旧库补上标准化课程代码 / ISBN 列（回填已有数据）和可选的经纬度列"""
+    _ensure_column(cursor, 'listings', 'course_code_norm', 'TEXT')
+    _ensure_column(cursor, 'listings', 'isbn_norm', 'TEXT')
+    _ensure_column(cursor, 'listings', 'latitude', 'REAL')
+    _ensure_column(cursor, 'listings', 'longitude', 'REAL')
+    
+    cursor.execute('''
+        SELECT id, course_code, isbn FROM listings
+        WHERE (course_code IS NOT NULL AND course_code_norm IS NULL)
+           OR (isbn IS NOT NULL AND isbn_norm IS NULL)
+    ''')
+    rows = cursor.fetchall()
+    if rows:
+        updates = []
+        for listing_id, course_code, isbn in rows:
+            # 单条脏数据不能阻止建表，跳过并提示
+            try:
+                updates.append((normalize_course_code(course_code) or None, normalize_isbn(isbn) or None, listing_id))
+            except (TypeError, ValueError, AttributeError) as e:
+                print(f"⚠ 物品 {listing_id} 的课程代码 / ISBN 无法标准化，已跳过: {e}")
+        cursor.executemany('UPDATE listings SET course_code_norm = ?, isbn_norm = ? WHERE id = ?', updates)
+        print(f"✓ 已回填 {len(updates)} 个物品的标准化课程代码 / ISBN")
+
+
+# 按标准化课程代码重算一门课的在售数量和最低价（走 idx_listings_course_status_price）
+_COURSE_CATALOG_REFRESH = '''
+    INSERT INTO course_catalog (course_code_norm, course_code, listing_count, min_price, updated_at)
+    SELECT {code}, COALESCE(MIN(course_code), {code}), COUNT(*), MIN(price), CURRENT_TIMESTAMP
+    FROM listings
+    WHERE course_code_norm = {code} AND status = 'active'
+    ON CONFLICT(course_code_norm) DO UPDATE SET
+        course_code = excluded.course_code,
+        listing_count = excluded.listing_count,
+        min_price = excluded.min_price,
+        updated_at = excluded.updated_at;
+    DELETE FROM course_catalog WHERE course_code_norm = {code} AND listing_count = 0;
+'''
+
+
+def _init_course_catalog(cursor):
+    """创建课程目录表（由触发器维护每门课的在售数量和最低价）"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'course_catalog'")
+    exists = cursor.fetchone() is not None
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS course_catalog (
+            course_code_norm TEXT PRIMARY KEY,
+            course_code TEXT NOT NULL,
+            listing_count INTEGER NOT NULL DEFAULT 0,
+            min_price REAL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS course_catalog_insert
+        AFTER INSERT ON listings WHEN new.course_code_norm IS NOT NULL BEGIN
+            {_COURSE_CATALOG_REFRESH.format(code='new.course_code_norm')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS course_catalog_delete
+        AFTER DELETE ON listings WHEN old.course_code_norm IS NOT NULL BEGIN
+            {_COURSE_CATALOG_REFRESH.format(code='old.course_code_norm')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS course_catalog_update_old
+        AFTER UPDATE OF status, price, course_code, course_code_norm ON listings
+        WHEN old.course_code_norm IS NOT NULL BEGIN
+            {_COURSE_CATALOG_REFRESH.format(code='old.course_code_norm')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS course_catalog_update_new
+        AFTER UPDATE OF status, price, course_code, course_code_norm ON listings
+        WHEN new.course_code_norm IS NOT NULL
+         AND new.course_code_norm IS NOT old.course_code_norm BEGIN
+            {_COURSE_CATALOG_REFRESH.format(code='new.course_code_norm')}
+        END
+    ''')
+    
+    # 首次创建时按已有数据汇总
+    if not exists:
+        cursor.execute('''
+            INSERT INTO course_catalog (course_code_norm, course_code, listing_count, min_price)
+            SELECT course_code_norm, MIN(course_code), COUNT(*), MIN(price)
+            FROM listings
+            WHERE course_code_norm IS NOT NULL AND status = 'active'
+            GROUP BY course_code_norm
+        ''')
+
+
+def get_course_catalog(prefix=None, limit=100):
+    """
+    获取课程目录：每门课的在售数量和最低价
+    
+    prefix 为课程代码前缀（任意写法，如 "cs-uy"），按标准化代码做范围查找
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        query = 'SELECT course_code_norm, course_code, listing_count, min_price FROM course_catalog'
+        params = []
+        
+        prefix = normalize_course_code(prefix)
+        if prefix:
+            query += ' WHERE course_code_norm >= ? AND course_code_norm < ?'
+            params.extend([prefix, prefix + '\uffff'])
+        
+        query += ' ORDER BY course_code_norm LIMIT ?'
+        params.append(limit)
+        
+        cursor.execute(query, params)
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def get_listings_by_course(course_code, limit=50):
+    """按课程代码（任意写法）获取在售教材，价格从低到高"""
+    course_code_norm = normalize_course_code(course_code)
+    if not course_code_norm:
+        return []
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT l.*, u.nickname, u.verify_status, u.avatar, u.id as seller_id
+            FROM listings l
+            JOIN users u ON l.user_id = u.id
+            WHERE l.course_code_norm = ? AND l.status = 'active'
+            ORDER BY l.price ASC, l.id ASC
+            LIMIT ?
+        ''', (course_code_norm, limit))
+        
+        return map_listing_rows(cursor)
+
+
+# ===== 地理位置 =====
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+_geo_available = {}
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """两点间球面距离（公里），任一坐标为空时返回 None；同时注册为 SQL 函数 haversine_km"""
+    if lat1 is None or lng1 is None or lat2 is None or lng2 is None:
+        return None
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def geo_bounding_box(latitude, longitude, distance_km):
+    """
+    覆盖以 (latitude, longitude) 为圆心、distance_km 为半径的圆的经纬度矩形
+    
+    返回 (min_lat, max_lat, min_lng, max_lng)；靠近两极时经度取全范围，
+    不处理跨 180 度经线的情况（按边界截断）
+    """
+    lat_delta = distance_km / KM_PER_DEGREE
+    min_lat, max_lat = max(-90.0, latitude - lat_delta), min(90.0, latitude + lat_delta)
+    if min_lat <= -90.0 or max_lat >= 90.0:
+        return min_lat, max_lat, -180.0, 180.0
+    lng_delta = lat_delta / math.cos(math.radians(latitude))
+    return min_lat, max_lat, max(-180.0, longitude - lng_delta), min(180.0, longitude + lng_delta)
+
+
+def parse_near(near):
+    """校验附近查询参数 (latitude, longitude, distance_km)，格式无效时抛出 ValueError"""
+    try:
+        latitude, longitude, distance_km = (float(value) for value in near)
+    except (TypeError, ValueError):
+        raise ValueError('无效的位置参数')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('无效的位置参数')
+    if not 0 < distance_km <= NEARBY_MAX_KM:
+        raise ValueError(f'距离须在 0 到 {NEARBY_MAX_KM:g} 公里之间')
+    return latitude, longitude, distance_km
+
+
+def _init_geo_index(cursor):
+    """创建社区中心点和物品坐标的 R*Tree 空间索引及同步触发器"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'listings_rtree'")
+    exists = cursor.fetchone() is not None
+    
+    for table, source in (('communities_rtree', 'communities'), ('listings_rtree', 'listings')):
+        cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING rtree(id, min_lat, max_lat, min_lng, max_lng)')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_insert
+            AFTER INSERT ON {source}
+            WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN
+                INSERT INTO {table} VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_update
+            AFTER UPDATE OF latitude, longitude ON {source} BEGIN
+                DELETE FROM {table} WHERE id = old.id;
+                INSERT INTO {table}
+                SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude
+                WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON {source} BEGIN
+                DELETE FROM {table} WHERE id = old.id;
+            END
+        ''')
+        
+        # 首次创建时为已有数据建立索引
+        if not exists:
+            cursor.execute(f'''
+                INSERT INTO {table}
+                SELECT id, latitude, latitude, longitude, longitude FROM {source}
+                WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            ''')
+    _geo_available.pop(DATABASE_PATH, None)
+
+
+def has_geo_index():
+    """当前数据库是否已建立 R*Tree 空间索引"""
+    path = DATABASE_PATH
+    if path not in _geo_available:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'listings_rtree'")
+            _geo_available[path] = cursor.fetchone() is not None
+    return _geo_available[path]
+
+
+def _bbox_filter(table, alias, box):
+    """矩形预筛选：有 R*Tree 时查空间索引，否则直接比较经纬度列"""
+    if has_geo_index():
+        return (f'{alias}.id IN (SELECT id FROM {table}_rtree '
+                'WHERE max_lat >= ? AND min_lat <= ? AND max_lng >= ? AND min_lng <= ?)'), list(box)
+    return (f'{alias}.latitude BETWEEN ? AND ? AND {alias}.longitude BETWEEN ? AND ?'), list(box)
+
+
+def _nearby_community_centers(cursor, latitude, longitude, distance_km):
+    """
+    覆盖范围与查询圆相交的社区 {id: 到社区中心的距离}
+    
+    社区按中心点建索引，矩形按 distance_km + 最大社区半径放宽，再用 haversine 精确判断
+    """
+    cursor.execute('SELECT MAX(radius) FROM communities')
+    max_radius = cursor.fetchone()[0] or 0
+    box = geo_bounding_box(latitude, longitude, distance_km + max_radius)
+    condition, params = _bbox_filter('communities', 'c', box)
+    cursor.execute(f'''
+        SELECT c.id, haversine_km(c.latitude, c.longitude, ?, ?) AS distance_km
+        FROM communities c
+        WHERE {condition}
+          AND haversine_km(c.latitude, c.longitude, ?, ?) <= ? + COALESCE(c.radius, 0)
+    ''', [latitude, longitude] + params + [latitude, longitude, distance_km])
+    return {row['id']: row['distance_km'] for row in cursor.fetchall()}
+
+
+def near_listing_filter(cursor, near, alias='l'):
+    """
+    附近物品的 SQL 条件
+    
+    有坐标的物品：R*Tree 矩形预筛选后按 haversine 精确过滤；
+    没有坐标的物品：所在社区的覆盖范围与查询圆相交即可。
+    返回 (以 AND 开头的条件, 参数, {社区 id: 距离})，社区距离供 annotate_distance 使用
+    """
+    latitude, longitude, distance_km = parse_near(near)
+    condition, params = _bbox_filter('listings', alias, geo_bounding_box(latitude, longitude, distance_km))
+    sql = f'''({alias}.latitude IS NOT NULL AND {condition}
+               AND haversine_km({alias}.latitude, {alias}.longitude, ?, ?) <= ?)'''
+    params += [latitude, longitude, distance_km]
+    
+    centers = _nearby_community_centers(cursor, latitude, longitude, distance_km)
+    if centers:
+        placeholders = ','.join('?' * len(centers))
+        sql += f' OR ({alias}.latitude IS NULL AND {alias}.community_id IN ({placeholders}))'
+        params += list(centers)
+    return f' AND ({sql})', params, centers
+
+
+def annotate_distance(listings, near, centers):
+    """为附近查询的结果补上 distance_km（没有坐标的物品按所在社区中心计算）"""
+    latitude, longitude, _ = parse_near(near)
+    for listing in listings:
+        if listing.get('latitude') is not None and listing.get('longitude') is not None:
+            distance = haversine_km(listing['latitude'], listing['longitude'], latitude, longitude)
+        else:
+            distance = centers.get(listing.get('community_id'))
+        listing['distance_km'] = round(distance, 2) if distance is not None else None
+    return listings
+
+
 def insert_sample_data():
     """插入示例数据"""
     with get_db() as conn:
@@ -284,8 +1772,10 @@ def insert_sample_data():
         ]
         cursor.executemany(
             '''INSERT INTO listings (user_id, title, description, price, images, category, course_code, isbn, 
-               community_id, meetup_point, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            listings
+               community_id, meetup_point, status, course_code_norm, isbn_norm)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            [listing + (normalize_course_code(listing[6]) or None, normalize_isbn(listing[7]) or None)
+             for listing in listings]
         )
         
         print("✓ 示例数据插入完成")
@@ -331,6 +1821,7 @@ def update_user_verify_status(user_id, status):
             'UPDATE users SET verify_status = ?, updated_at = ? WHERE id = ?',
             (status, datetime.now(), user_id)
         )
+    _hot_feed.update_seller(user_id, verify_status=status)
 
 
 def update_user_avatar(user_id, avatar_path):
@@ -341,7 +1832,11 @@ def update_user_avatar(user_id, avatar_path):
             'UPDATE users SET avatar = ?, updated_at = ? WHERE id = ?',
             (avatar_path, datetime.now(), user_id)
         )
-        return cursor.rowcount > 0
+        updated = cursor.rowcount > 0
+    
+    if updated:
+        _hot_feed.update_seller(user_id, avatar=avatar_path)
+    return updated
 
 
 # ===== 社区相关 =====
@@ -362,7 +1857,94 @@ def get_community_by_id(community_id):
         return dict(row) if row else None
 
 
+def get_nearby_communities(latitude, longitude, distance_km):
+    """覆盖范围与给定位置 distance_km 公里内相交的社区，按到中心的距离排序，附带 distance_km"""
+    latitude, longitude, distance_km = parse_near((latitude, longitude, distance_km))
+    with get_db() as conn:
+        cursor = conn.cursor()
+        centers = _nearby_community_centers(cursor, latitude, longitude, distance_km)
+        if not centers:
+            return []
+        placeholders = ','.join('?' * len(centers))
+        cursor.execute(f'SELECT * FROM communities WHERE id IN ({placeholders})', list(centers))
+        communities = [dict(row, distance_km=round(centers[row['id']], 2)) for row in cursor.fetchall()]
+    communities.sort(key=lambda community: (community['distance_km'], community['id']))
+    return communities
+
+
 # ===== 物品相关 =====
+_listing_listeners = []
+
+
+def register_listing_listener(listener):
+    """
+    注册物品变更监听器
+    
+    listener(event, listing_id, row) 在写入提交后调用，
+    event 为 created / updated / status_changed / deleted；
+    row 为物品当前行（dict，listings 全部列加 nickname、verify_status、avatar、seller_id），
+    已删除时为 None。监听器之间共享同一个 row，不要修改
+    """
+    if listener not in _listing_listeners:
+        _listing_listeners.append(listener)
+
+
+def _notify_listing_change(event, listing_id):
+    """通知所有监听器（物品行只查询一次），单个监听器出错不影响写入结果"""
+    listeners = list(_listing_listeners)
+    if not listeners:
+        return
+    row = None
+    if event != 'deleted':
+        try:
+            with get_db() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT l.*, u.nickname, u.verify_status, u.avatar, u.id as seller_id
+                    FROM listings l
+                    JOIN users u ON l.user_id = u.id
+                    WHERE l.id = ?
+                ''', (listing_id,))
+                found = cursor.fetchone()
+            row = dict(found) if found is not None else None
+        except Exception as e:
+            print(f'物品变更通知失败 ({event} #{listing_id}): {e}')
+            return
+    for listener in listeners:
+        try:
+            listener(event, listing_id, row)
+        except Exception as e:
+            print(f'物品变更通知失败 ({event} #{listing_id}): {e}')
+
+
+_activity_listeners = []
+
+
+def register_activity_listener(listener):
+    """
+    注册物品互动监听器
+    
+    listener(event, listing_id) 在浏览（view）或新增收藏（favorite）后调用，
+    应当只做内存操作，不要访问数据库
+    """
+    if listener not in _activity_listeners:
+        _activity_listeners.append(listener)
+
+
+def _notify_activity(event, listing_id):
+    """通知互动监听器"""
+    for listener in list(_activity_listeners):
+        try:
+            listener(event, listing_id)
+        except Exception as e:
+            print(f'物品互动通知失败 ({event} #{listing_id}): {e}')
+
+
+# 首页信息流缓存随物品变更和浏览增量维护
+register_listing_listener(_hot_feed.on_listing_change)
+register_activity_listener(_hot_feed.on_activity)
+
+
 def create_listing(user_id, title, price, category, community_id, **kwargs):
     """创建物品发布"""
     with get_db() as conn:
@@ -373,19 +1955,55 @@ def create_listing(user_id, title, price, category, community_id, **kwargs):
         course_code = kwargs.get('course_code')
         isbn = kwargs.get('isbn')
         meetup_point = kwargs.get('meetup_point', '')
+        latitude = kwargs.get('latitude')
+        longitude = kwargs.get('longitude')
         
         cursor.execute(
             '''INSERT INTO listings (user_id, title, description, price, images, category, 
-               course_code, isbn, community_id, meetup_point) 
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+               course_code, isbn, community_id, meetup_point, course_code_norm, isbn_norm,
+               latitude, longitude) 
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
             (user_id, title, description, price, images, category, 
-             course_code, isbn, community_id, meetup_point)
+             course_code, isbn, community_id, meetup_point,
+             normalize_course_code(course_code) or None, normalize_isbn(isbn) or None,
+             latitude, longitude)
         )
-        return cursor.lastrowid
-
-
-def get_listings(community_id=None, category=None, status='active', limit=50, offset=0, user_id=None):
-    """获取物品列表，可按社区、分类或用户筛选"""
+        listing_id = cursor.lastrowid
+    
+    _notify_listing_change('created', listing_id)
+    invalidate_listing_results(community_id, category, user_id)
+    return listing_id
+
+
+def _listing_scope(cursor, listing_id):
+    """物品的缓存范围 (community_id, category, user_id)，物品不存在时返回 None"""
+    cursor.execute('SELECT community_id, category, user_id FROM listings WHERE id = ?', (listing_id,))
+    row = cursor.fetchone()
+    return tuple(row) if row else None
+
+
+def get_listings(community_id=None, category=None, status='active', limit=50, offset=0, user_id=None, after=None,
+                 near=None):
+    """
+    获取物品列表，可按社区、分类或用户筛选
+    
+    after 为上一页返回的游标 (created_at, id)，提供时按键集分页并忽略 offset；
+    near 为 (纬度, 经度, 距离公里)，只返回该范围内的物品并附带 distance_km。
+    在售物品按社区/分类浏览的前几页由首页信息流缓存直接返回
+    """
+    if (status == 'active' and not user_id and not near and limit > 0
+            and getattr(_local, 'conn', None) is None):
+        page = _hot_feed.page(community_id, category if category != 'all' else None, limit, offset,
+                              decode_cursor(after) if after else None)
+        if page is not None:
+            return page
+    return _query_listings(community_id, category, status, limit, offset, user_id, after, near)
+
+
+@cached_result(scope=lambda a: (a['community_id'], a['category'], a['user_id']))
+def _query_listings(community_id=None, category=None, status='active', limit=50, offset=0, user_id=None, after=None,
+                    near=None):
+    """按条件查询物品列表（get_listings 的数据库实现）"""
     with get_db() as conn:
         cursor = conn.cursor()
         
@@ -413,27 +2031,47 @@ def get_listings(community_id=None, category=None, status='active', limit=50, of
             query += ' AND l.category = ?'
             params.append(category)
         
-        query += ' ORDER BY l.created_at DESC LIMIT ? OFFSET ?'
+        centers = None
+        if near:
+            condition, near_params, centers = near_listing_filter(cursor, near)
+            query += condition
+            params.extend(near_params)
+        
+        if after:
+            query += ' AND (l.created_at, l.id) < (?, ?)'
+            params.extend(decode_cursor(after))
+            offset = 0
+        
+        query += ' ORDER BY l.created_at DESC, l.id DESC LIMIT ? OFFSET ?'
         params.extend([limit, offset])
         
         cursor.execute(query, params)
-        results = []
-        for row in cursor.fetchall():
-            listing = dict(row)
-            listing['images'] = json.loads(listing['images']) if listing['images'] else []
-            listing['user'] = {
-                'id': listing['seller_id'],
-                'nickname': listing['nickname'],
-                'verify_status': listing['verify_status'],
-                'avatar': listing['avatar']
-            }
-            for key in ['nickname', 'verify_status', 'avatar', 'seller_id']:
-                listing.pop(key, None)
-            results.append(listing)
+        results = map_listing_rows(cursor)
         
+        if near:
+            annotate_distance(results, near, centers)
         return results
 
 
+def get_listings_by_ids(listing_ids):
+    """按给定顺序取回物品（格式与 get_listings 一致），不存在的 id 跳过"""
+    if not listing_ids:
+        return []
+    with get_db() as conn:
+        cursor = conn.cursor()
+        placeholders = ','.join('?' * len(listing_ids))
+        cursor.execute(f'''
+            SELECT l.*, u.nickname, u.verify_status, u.avatar, u.id as seller_id
+            FROM listings l
+            JOIN users u ON l.user_id = u.id
+            WHERE l.id IN ({placeholders})
+        ''', list(listing_ids))
+        
+        rows = {listing['id']: listing for listing in map_listing_rows(cursor)}
+        
+        return [rows[listing_id] for listing_id in listing_ids if listing_id in rows]
+
+
 def get_listing_by_id(listing_id):
     """根据ID获取物品详情"""
     with get_db() as conn:
@@ -449,31 +2087,26 @@ def get_listing_by_id(listing_id):
         if not row:
             return None
         
-        listing = dict(row)
-        listing['images'] = json.loads(listing['images']) if listing['images'] else []
-        listing['user'] = {
-            'id': listing['seller_id'],
-            'nickname': listing['nickname'],
-            'verify_status': listing['verify_status'],
-            'avatar': listing['avatar']
-        }
-        for key in ['nickname', 'verify_status', 'avatar', 'seller_id']:
-            listing.pop(key, None)
-        
+        listing = listing_row_mapper(cursor)(row)
+        listing['view_count'] += _view_buffer.pending(listing_id)
         return listing
 
 
 # ===== 收藏相关 =====
 def add_favorite(user_id, listing_id):
     """收藏物品"""
-    with get_db() as conn:
-        cursor = conn.cursor()
+    def op(cursor):
         cursor.execute('''
             INSERT OR IGNORE INTO favorites (user_id, listing_id)
             VALUES (?, ?)
         ''', (user_id, listing_id))
         return cursor.lastrowid if cursor.rowcount else None
 
+    favorite_id = execute_write(op)
+    if favorite_id:
+        _notify_activity('favorite', listing_id)
+    return favorite_id
+
 
 def remove_favorite(user_id, listing_id):
     """取消收藏物品"""
@@ -486,36 +2119,34 @@ def remove_favorite(user_id, listing_id):
         return cursor.rowcount > 0
 
 
-def get_user_favorites(user_id, limit=100, offset=0):
-    """获取用户收藏列表"""
+def get_user_favorites(user_id, limit=100, offset=0, after=None):
+    """
+    获取用户收藏列表
+    
+    after 为上一页返回的游标 (favorite_created_at, id)，提供时忽略 offset
+    """
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
+        
+        query = '''
             SELECT f.created_at as favorite_created_at, l.*, u.nickname, u.verify_status, u.avatar, u.id as seller_id
             FROM favorites f
             JOIN listings l ON f.listing_id = l.id
             JOIN users u ON l.user_id = u.id
             WHERE f.user_id = ?
-            ORDER BY f.created_at DESC
-            LIMIT ? OFFSET ?
-        ''', (user_id, limit, offset))
+        '''
+        params = [user_id]
         
-        favorites = []
-        for row in cursor.fetchall():
-            listing = dict(row)
-            listing['images'] = json.loads(listing['images']) if listing['images'] else []
-            listing['user'] = {
-                'id': listing['seller_id'],
-                'nickname': listing['nickname'],
-                'verify_status': listing['verify_status'],
-                'avatar': listing['avatar']
-            }
-            listing['favorite_created_at'] = listing.pop('favorite_created_at', None)
-            for key in ['nickname', 'verify_status', 'avatar', 'seller_id']:
-                listing.pop(key, None)
-            favorites.append(listing)
+        if after:
+            query += ' AND (f.created_at, f.listing_id) < (?, ?)'
+            params.extend(decode_cursor(after))
+            offset = 0
+        
+        query += ' ORDER BY f.created_at DESC, f.listing_id DESC LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
         
-        return favorites
+        cursor.execute(query, params)
+        return map_listing_rows(cursor)
 
 
 def get_user_favorite_ids(user_id):
@@ -529,71 +2160,120 @@ def get_user_favorite_ids(user_id):
         return [row['listing_id'] for row in cursor.fetchall()]
 
 
+@cached_result(
+    scope=lambda a: (a['community_id'], None, None),
+    key=lambda a: (' '.join((a['query'] or '').lower().split()), a['community_id'], a['limit'])
+)
 def search_listings(query, community_id=None, limit=50):
-    """搜索物品"""
+    """搜索物品（有全文索引时按 bm25 相关度排序）"""
+    match = build_fts_query(query, ['title', 'description', 'course_code']) if has_fts_index() else None
+    
     with get_db() as conn:
         cursor = conn.cursor()
         
-        sql = '''
-            SELECT l.*, u.nickname, u.verify_status, u.avatar, u.id as seller_id
-            FROM listings l
-            JOIN users u ON l.user_id = u.id
-            WHERE l.status = 'active' 
-            AND (l.title LIKE ? OR l.description LIKE ? OR l.course_code LIKE ?)
-        '''
-        search_term = f'%{query}%'
-        params = [search_term, search_term, search_term]
+        if match:
+            sql = '''
+                SELECT l.*, u.nickname, u.verify_status, u.avatar, u.id as seller_id
+                FROM listings_fts
+                JOIN listings l ON l.id = listings_fts.rowid
+                JOIN users u ON l.user_id = u.id
+                WHERE listings_fts MATCH ? AND l.status = 'active'
+            '''
+            params = [match]
+        else:
+            sql = '''
+                SELECT l.*, u.nickname, u.verify_status, u.avatar, u.id as seller_id
+                FROM listings l
+                JOIN users u ON l.user_id = u.id
+                WHERE l.status = 'active' 
+                AND (l.title LIKE ? OR l.description LIKE ? OR l.course_code LIKE ?)
+            '''
+            search_term = f'%{query}%'
+            params = [search_term, search_term, search_term]
         
         if community_id:
             sql += ' AND l.community_id = ?'
             params.append(community_id)
         
-        sql += ' ORDER BY l.created_at DESC LIMIT ?'
+        sql += ' ORDER BY rank LIMIT ?' if match else ' ORDER BY l.created_at DESC LIMIT ?'
         params.append(limit)
         
         cursor.execute(sql, params)
-        results = []
-        for row in cursor.fetchall():
-            listing = dict(row)
-            listing['images'] = json.loads(listing['images']) if listing['images'] else []
-            listing['user'] = {
-                'id': listing['seller_id'],
-                'nickname': listing['nickname'],
-                'verify_status': listing['verify_status'],
-                'avatar': listing['avatar']
-            }
-            for key in ['nickname', 'verify_status', 'avatar', 'seller_id']:
-                listing.pop(key, None)
-            results.append(listing)
-        
-        return results
+        return map_listing_rows(cursor)
+
+
+# 可通过 update_listing 修改的字段
+LISTING_UPDATABLE_FIELDS = ('title', 'description', 'price', 'images', 'category',
+                            'course_code', 'isbn', 'meetup_point', 'latitude', 'longitude')
+
+
+def update_listing(listing_id, **fields):
+    """
+    修改物品信息（标题、描述、价格、图片、分类、课程代码、ISBN、交易地点及其经纬度）
+    
+    返回是否有物品被修改
+    """
+    updates = {key: value for key, value in fields.items() if key in LISTING_UPDATABLE_FIELDS}
+    if not updates:
+        return False
+    if 'images' in updates:
+        updates['images'] = json.dumps(updates['images'] or [])
+    if 'course_code' in updates:
+        updates['course_code_norm'] = normalize_course_code(updates['course_code']) or None
+    if 'isbn' in updates:
+        updates['isbn_norm'] = normalize_isbn(updates['isbn']) or None
+    updates['updated_at'] = datetime.now()
+    
+    with get_db() as conn:
+        cursor = conn.cursor()
+        before = _listing_scope(cursor, listing_id)
+        if before is None:
+            return False
+        assignments = ', '.join(f'{column} = ?' for column in updates)
+        cursor.execute(
+            f'UPDATE listings SET {assignments} WHERE id = ?',
+            list(updates.values()) + [listing_id]
+        )
+        after = _listing_scope(cursor, listing_id)
+    
+    _notify_listing_change('updated', listing_id)
+    invalidate_listing_results(*before)
+    if after != before:
+        invalidate_listing_results(*after)
+    return True
 
 
 def update_listing_status(listing_id, status):
     """更新物品状态"""
     with get_db() as conn:
         cursor = conn.cursor()
+        scope = _listing_scope(cursor, listing_id)
         cursor.execute(
             'UPDATE listings SET status = ?, updated_at = ? WHERE id = ?',
             (status, datetime.now(), listing_id)
         )
+    
+    _notify_listing_change('status_changed', listing_id)
+    if scope:
+        invalidate_listing_results(*scope)
 
 
 def increment_view_count(listing_id):
-    """增加浏览次数"""
-    with get_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE listings SET view_count = view_count + 1 WHERE id = ?',
-            (listing_id,)
-        )
+    """增加浏览次数（先进入内存缓冲，定期批量写回）"""
+    _view_buffer.add(listing_id)
+    _notify_activity('view', listing_id)
 
 
 def delete_listing(listing_id):
     """删除物品"""
     with get_db() as conn:
         cursor = conn.cursor()
+        scope = _listing_scope(cursor, listing_id)
         cursor.execute('DELETE FROM listings WHERE id = ?', (listing_id,))
+    
+    _notify_listing_change('deleted', listing_id)
+    if scope:
+        invalidate_listing_results(*scope)
 
 
 # ===== 消息相关 =====
@@ -622,49 +2302,74 @@ def create_thread(buyer_id, seller_id, listing_id):
 
 def create_message(thread_id, from_user_id, to_user_id, content):
     """创建消息"""
-    with get_db() as conn:
-        cursor = conn.cursor()
+    def op(cursor):
         cursor.execute(
             'INSERT INTO messages (thread_id, from_user_id, to_user_id, content) VALUES (?, ?, ?, ?)',
             (thread_id, from_user_id, to_user_id, content)
         )
+        message_id = cursor.lastrowid
         
         cursor.execute(
             'UPDATE threads SET last_message_at = ? WHERE id = ?',
             (datetime.now(), thread_id)
         )
         
-        return cursor.lastrowid
+        return message_id
+
+    return execute_write(op)
 
 
-def get_user_threads(user_id, limit=50):
-    """获取用户的会话列表"""
+def get_user_threads(user_id, limit=50, after=None):
+    """
+    获取用户的会话列表
+    
+    after 为上一页返回的游标 (last_message_at, id)
+    """
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
+        
+        # 买家、卖家两侧各走一个索引，UNION ALL 归并后无需临时排序
+        keyset = ''
+        keyset_params = []
+        if after:
+            keyset = ' AND (last_message_at, id) < (?, ?)'
+            keyset_params = decode_cursor(after)
+        
+        query = f'''
             SELECT t.*, 
                    l.title as listing_title, l.price as listing_price,
                    l.meetup_point as listing_meetup_point,
                    l.category as listing_category,
                    u1.nickname as buyer_nickname, u1.id as buyer_id,
                    u2.nickname as seller_nickname, u2.id as seller_id
-            FROM threads t
+            FROM (
+                SELECT * FROM threads WHERE buyer_id = ?{keyset}
+                UNION ALL
+                SELECT * FROM threads WHERE seller_id = ? AND buyer_id != ?{keyset}
+            ) t
             JOIN listings l ON t.listing_id = l.id
             JOIN users u1 ON t.buyer_id = u1.id
             JOIN users u2 ON t.seller_id = u2.id
-            WHERE t.buyer_id = ? OR t.seller_id = ?
-            ORDER BY t.last_message_at DESC
+            ORDER BY t.last_message_at DESC, t.id DESC
             LIMIT ?
-        ''', (user_id, user_id, limit))
+        '''
+        params = [user_id, *keyset_params, user_id, user_id, *keyset_params, limit]
+        
+        cursor.execute(query, params)
         
         return [dict(row) for row in cursor.fetchall()]
 
 
-def get_thread_messages(thread_id, limit=100):
-    """获取会话的消息列表"""
+def get_thread_messages(thread_id, limit=100, after=None):
+    """
+    获取会话的消息列表
+    
+    after 为上一页返回的游标 (created_at, id)
+    """
     with get_db() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
+        
+        query = '''
             SELECT m.*, 
                    u1.nickname as from_nickname,
                    u2.nickname as to_nickname
@@ -672,9 +2377,17 @@ def get_thread_messages(thread_id, limit=100):
             JOIN users u1 ON m.from_user_id = u1.id
             JOIN users u2 ON m.to_user_id = u2.id
             WHERE m.thread_id = ?
-            ORDER BY m.created_at ASC
-            LIMIT ?
-        ''', (thread_id, limit))
+        '''
+        params = [thread_id]
+        
+        if after:
+            query += ' AND (m.created_at, m.id) > (?, ?)'
+            params.extend(decode_cursor(after))
+        
+        query += ' ORDER BY m.created_at ASC, m.id ASC LIMIT ?'
+        params.append(limit)
+        
+        cursor.execute(query, params)
         
         return [dict(row) for row in cursor.fetchall()]
 
@@ -825,66 +2538,518 @@ def get_user_rating_stats(user_id):
 
 
 # ===== 统计相关 =====
+# 仪表盘计数（stats_counters 单行表的列）：列名 -> (来源表, 计数条件)，{row} 为 new/old 或表名
+STATS_COUNTERS = {
+    'total_users': ('users', '1'),
+    'verified_users': ('users', "{row}.verify_status IN ('email_verified', 'phone_verified')"),
+    'total_listings': ('listings', '1'),
+    'active_listings': ('listings', "{row}.status = 'active'"),
+    'sold_listings': ('listings', "{row}.status = 'sold'"),
+    'hidden_listings': ('listings', "{row}.status = 'hidden'"),
+    'flagged_listings': ('listings', "{row}.status = 'flagged'"),
+    'pending_reports': ('reports', '{row}.handled = 0')
+}
+
+# 每日新增（stats_daily 的列，按 DATE(created_at) 分行）：列名 -> 来源表
+STATS_DAILY_COUNTERS = {'new_users': 'users', 'new_listings': 'listings'}
+
+# 影响计数条件的列：更新这些列时触发器重新计数
+STATS_WATCHED_COLUMNS = {'users': 'verify_status', 'listings': 'status', 'reports': 'handled'}
+
+
+def _stats_condition(condition, row):
+    return f'COALESCE({condition.format(row=row)}, 0)'
+
+
+def _stats_trigger_sql(table, event):
+    """某张表的 INSERT/DELETE/UPDATE 触发器主体：调整计数行和当天新增"""
+    counters = [(column, condition) for column, (source, condition) in STATS_COUNTERS.items() if source == table]
+    if event == 'INSERT':
+        changes = [f'{column} = {column} + {_stats_condition(condition, "new")}' for column, condition in counters]
+    elif event == 'DELETE':
+        changes = [f'{column} = {column} - {_stats_condition(condition, "old")}' for column, condition in counters]
+    else:
+        changes = [
+            f'{column} = {column} + {_stats_condition(condition, "new")} - {_stats_condition(condition, "old")}'
+            for column, condition in counters if condition != '1'
+        ]
+    statements = [f"UPDATE stats_counters SET {', '.join(changes)} WHERE id = 1;"]
+    
+    for column, source in STATS_DAILY_COUNTERS.items():
+        if source != table:
+            continue
+        if event == 'INSERT':
+            statements.append(f'''
+                INSERT INTO stats_daily (day, {column})
+                SELECT DATE(new.created_at), 1 WHERE DATE(new.created_at) IS NOT NULL
+                ON CONFLICT(day) DO UPDATE SET {column} = {column} + 1;''')
+        elif event == 'DELETE':
+            statements.append(
+                f'UPDATE stats_daily SET {column} = {column} - 1 WHERE day = DATE(old.created_at);'
+            )
+    return '\n'.join(statements)
+
+
+def _init_stats_counters(cursor):
+    """创建仪表盘计数表（由触发器随 users / listings / reports 的增删改维护）"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_counters'")
+    exists = cursor.fetchone() is not None
+    
+    columns = ',\n'.join(f'{column} INTEGER NOT NULL DEFAULT 0' for column in STATS_COUNTERS)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            {columns}
+        )
+    ''')
+    daily_columns = ',\n'.join(f'{column} INTEGER NOT NULL DEFAULT 0' for column in STATS_DAILY_COUNTERS)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            {daily_columns}
+        )
+    ''')
+    
+    for table, watched in STATS_WATCHED_COLUMNS.items():
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS stats_{table}_insert AFTER INSERT ON {table} BEGIN
+                {_stats_trigger_sql(table, 'INSERT')}
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS stats_{table}_delete AFTER DELETE ON {table} BEGIN
+                {_stats_trigger_sql(table, 'DELETE')}
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS stats_{table}_update AFTER UPDATE OF {watched} ON {table} BEGIN
+                {_stats_trigger_sql(table, 'UPDATE')}
+            END
+        ''')
+    
+    # 首次创建时按已有数据汇总
+    if not exists:
+        _rebuild_stats_counters(cursor)
+
+
+def _rebuild_stats_counters(cursor):
+    """从源表重新计算全部计数，返回与原计数不一致的项"""
+    cursor.execute('SELECT * FROM stats_counters WHERE id = 1')
+    row = cursor.fetchone()
+    stored = {column: row[column] for column in STATS_COUNTERS} if row else {}
+    
+    actual = {}
+    for table in STATS_WATCHED_COLUMNS:
+        columns = [column for column, (source, _) in STATS_COUNTERS.items() if source == table]
+        sums = ', '.join(
+            f'COALESCE(SUM({_stats_condition(STATS_COUNTERS[column][1], table)}), 0)' for column in columns
+        )
+        cursor.execute(f'SELECT {sums} FROM {table}')
+        actual.update(zip(columns, cursor.fetchone()))
+    
+    cursor.execute('SELECT * FROM stats_daily')
+    stored_daily = {(row['day'], column): row[column] for row in cursor.fetchall() for column in STATS_DAILY_COUNTERS}
+    actual_daily = {}
+    for column, table in STATS_DAILY_COUNTERS.items():
+        cursor.execute(f'''
+            SELECT DATE(created_at) AS day, COUNT(*) FROM {table}
+            WHERE DATE(created_at) IS NOT NULL
+            GROUP BY day
+        ''')
+        for day, count in cursor.fetchall():
+            actual_daily[(day, column)] = count
+    
+    cursor.execute(
+        f"INSERT OR REPLACE INTO stats_counters (id, {', '.join(actual)}) VALUES (1, {', '.join('?' * len(actual))})",
+        list(actual.values())
+    )
+    cursor.execute('DELETE FROM stats_daily')
+    days = sorted({day for day, _ in actual_daily})
+    cursor.executemany(
+        f"INSERT INTO stats_daily (day, {', '.join(STATS_DAILY_COUNTERS)}) "
+        f"VALUES (?, {', '.join('?' * len(STATS_DAILY_COUNTERS))})",
+        [[day] + [actual_daily.get((day, column), 0) for column in STATS_DAILY_COUNTERS] for day in days]
+    )
+    
+    drift = {
+        column: {'stored': stored.get(column), 'actual': value}
+        for column, value in actual.items() if stored.get(column) != value
+    }
+    for key in set(stored_daily) | set(actual_daily):
+        if stored_daily.get(key, 0) != actual_daily.get(key, 0):
+            day, column = key
+            drift[f'{column}@{day}'] = {'stored': stored_daily.get(key), 'actual': actual_daily.get(key, 0)}
+    return drift
+
+
+# 在售物品离开分类时：数量和价格总和增量扣减，被移除的价格是最低/最高价时
+# 沿 idx_listings_status_category_price 索引重新取该分类的 MIN/MAX（一次索引查找）
+_CATEGORY_STATS_REMOVE = '''
+    UPDATE category_stats SET
+        listing_count = listing_count - 1,
+        price_sum = price_sum - old.price,
+        min_price = CASE WHEN old.price <= min_price THEN (
+            SELECT MIN(price) FROM listings WHERE status = 'active' AND category = old.category
+        ) ELSE min_price END,
+        max_price = CASE WHEN old.price >= max_price THEN (
+            SELECT MAX(price) FROM listings WHERE status = 'active' AND category = old.category
+        ) ELSE max_price END
+    WHERE category = old.category;
+    DELETE FROM category_stats WHERE category = old.category AND listing_count <= 0;
+'''
+
+# 在售物品进入分类时
+_CATEGORY_STATS_ADD = '''
+    INSERT INTO category_stats (category, listing_count, price_sum, min_price, max_price)
+    VALUES (new.category, 1, new.price, new.price, new.price)
+    ON CONFLICT(category) DO UPDATE SET
+        listing_count = listing_count + 1,
+        price_sum = price_sum + excluded.price_sum,
+        min_price = MIN(min_price, excluded.min_price),
+        max_price = MAX(max_price, excluded.max_price);
+'''
+
+
+def _init_category_stats(cursor):
+    """创建分类统计表（由触发器维护每个分类的在售数量、价格总和、最低价和最高价）"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'category_stats'")
+    exists = cursor.fetchone() is not None
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS category_stats (
+            category TEXT PRIMARY KEY,
+            listing_count INTEGER NOT NULL DEFAULT 0,
+            price_sum REAL NOT NULL DEFAULT 0,
+            min_price REAL,
+            max_price REAL
+        )
+    ''')
+    # 按在售数量排序读取，免去临时排序
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_category_stats_count
+        ON category_stats(listing_count DESC, category)
+    ''')
+    
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS category_stats_insert
+        AFTER INSERT ON listings WHEN new.status = 'active' BEGIN
+            {_CATEGORY_STATS_ADD}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS category_stats_delete
+        AFTER DELETE ON listings WHEN old.status = 'active' BEGIN
+            {_CATEGORY_STATS_REMOVE}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS category_stats_update_old
+        AFTER UPDATE OF status, price, category ON listings WHEN old.status = 'active' BEGIN
+            {_CATEGORY_STATS_REMOVE}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS category_stats_update_new
+        AFTER UPDATE OF status, price, category ON listings WHEN new.status = 'active' BEGIN
+            {_CATEGORY_STATS_ADD}
+        END
+    ''')
+    
+    # 首次创建时按已有数据汇总
+    if not exists:
+        _rebuild_category_stats(cursor)
+
+
+def _rebuild_category_stats(cursor):
+    """从 listings 重新汇总分类统计，返回与原记录不一致的项"""
+    fields = ('listing_count', 'min_price', 'max_price')
+    cursor.execute('SELECT * FROM category_stats')
+    stored = {row['category']: row for row in cursor.fetchall()}
+    
+    cursor.execute('''
+        SELECT category, COUNT(*), SUM(price), MIN(price), MAX(price)
+        FROM listings
+        WHERE status = 'active'
+        GROUP BY category
+    ''')
+    actual = {row[0]: dict(zip(('listing_count', 'price_sum', 'min_price', 'max_price'), row[1:]))
+              for row in cursor.fetchall()}
+    
+    cursor.execute('DELETE FROM category_stats')
+    cursor.executemany(
+        '''INSERT INTO category_stats (category, listing_count, price_sum, min_price, max_price)
+           VALUES (?, ?, ?, ?, ?)''',
+        [(category, values['listing_count'], values['price_sum'], values['min_price'], values['max_price'])
+         for category, values in actual.items()]
+    )
+    
+    drift = {}
+    for category in set(stored) | set(actual):
+        for field in fields:
+            before = stored[category][field] if category in stored else None
+            after = actual[category][field] if category in actual else None
+            if before != after:
+                drift[f'{field}@{category}'] = {'stored': before, 'actual': after}
+    return drift
+
+
+def rebuild_stats_counters():
+    """
+    重新计算仪表盘计数和分类统计
+    
+    返回 {计数名: {'stored': 原值, 'actual': 重算值}}，只包含有偏差的项；
+    每日新增的计数名为 "new_users@2024-01-01" 形式，分类统计为 "min_price@textbook" 形式
+    """
+    def op(cursor):
+        drift = _rebuild_stats_counters(cursor)
+        drift.update(_rebuild_category_stats(cursor))
+        return drift
+    
+    return execute_write(op)
+
+
 def get_dashboard_stats():
-    """获取仪表盘统计数据"""
+    """获取仪表盘统计数据（读取 stats_counters 计数行和当天的新增行）"""
     with get_db() as conn:
         cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM users WHERE verify_status IN ('email_verified', 'phone_verified')")
-        verified_users = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM listings')
-        total_listings = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM listings WHERE status = 'active'")
-        active_listings = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM listings WHERE status = 'sold'")
-        sold_listings = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM reports WHERE handled = 0')
-        pending_reports = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM users WHERE DATE(created_at) = DATE('now')")
-        today_new_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM listings WHERE DATE(created_at) = DATE('now')")
-        today_new_listings = cursor.fetchone()[0]
+        cursor.execute('''
+            SELECT s.*, d.new_users, d.new_listings
+            FROM stats_counters s
+            LEFT JOIN stats_daily d ON d.day = DATE('now')
+            WHERE s.id = 1
+        ''')
+        row = cursor.fetchone()
+        counters = dict(row) if row else {}
         
         return {
-            'total_users': total_users,
-            'verified_users': verified_users,
-            'total_listings': total_listings,
-            'active_listings': active_listings,
-            'sold_listings': sold_listings,
-            'pending_reports': pending_reports,
-            'today_new_users': today_new_users,
-            'today_new_listings': today_new_listings
+            'total_users': counters.get('total_users', 0),
+            'verified_users': counters.get('verified_users', 0),
+            'total_listings': counters.get('total_listings', 0),
+            'active_listings': counters.get('active_listings', 0),
+            'sold_listings': counters.get('sold_listings', 0),
+            'pending_reports': counters.get('pending_reports', 0),
+            'today_new_users': counters.get('new_users') or 0,
+            'today_new_listings': counters.get('new_listings') or 0
         }
 
 
 def get_category_stats():
-    """获取分类统计"""
+    """获取分类统计（读取 category_stats 汇总表）"""
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT category, COUNT(*) as count
-            FROM listings
-            WHERE status = 'active'
-            GROUP BY category
-            ORDER BY count DESC
+            SELECT category, listing_count as count
+            FROM category_stats
+            ORDER BY listing_count DESC
         ''')
         
         return [dict(row) for row in cursor.fetchall()]
 
 
+# ===== 查询计划检查 =====
+# 已知仍需全表扫描或临时排序的查询计划步骤：{查询: {计划步骤: 原因}}
+# 只豁免列出的步骤，同一查询出现其他扫描或排序仍视为问题
+QUERY_PLAN_EXEMPTIONS = {
+    'get_all_communities': {
+        'SCAN communities': '社区为小型字典表，按主键全量读取'
+    },
+    'get_listings:all_statuses': {
+        'SCAN l USING INDEX idx_listings_created': '不限状态的全站信息流：沿 created_at 索引倒序遍历，LIMIT 后提前结束'
+    },
+    'get_course_catalog:all': {
+        'SCAN course_catalog USING INDEX sqlite_autoindex_course_catalog_1':
+            '不带前缀的课程目录：沿主键顺序遍历，LIMIT 后提前结束'
+    },
+    'get_category_stats': {
+        'SCAN category_stats USING COVERING INDEX idx_category_stats_count': '分类汇总表（每个分类一行），按数量索引全量读取'
+    },
+    'search_by_category_stats': {
+        'SCAN category_stats USING INDEX idx_category_stats_count': '分类汇总表（每个分类一行），按数量索引全量读取'
+    },
+    'get_popular_searches': {
+        'USE TEMP B-TREE FOR ORDER BY': '按 SUM(count) 排序，排序对象是时间窗口内分组后的不同搜索词'
+    },
+    'get_search_history': {
+        'USE TEMP B-TREE FOR ORDER BY': '按 MAX(last_searched) 排序，排序对象是单个用户分组后的不同搜索词'
+    },
+    'get_related_listings': {
+        'USE TEMP B-TREE FOR ORDER BY': '无预计算结果时回退：CASE 相关度无法走索引，只排序同分类或同社区的在售物品'
+    },
+    'get_trending_items': {
+        'USE TEMP B-TREE FOR ORDER BY': '热度引擎未加载时回退：先用 (status, created_at) 索引取时间窗口，再按浏览量排序窗口内的物品'
+    }
+}
+
+
+def _plan_exemption(name, detail):
+    """查询计划步骤的豁免原因，未豁免时返回 None"""
+    return QUERY_PLAN_EXEMPTIONS.get(name, {}).get(detail)
+
+
+def _query_plan_cases():
+    """生产查询用例：(名称, 调用)，参数取自示例数据"""
+    from modules import search, notifications
+    
+    return [
+        ('get_user_by_id', lambda: get_user_by_id(1)),
+        ('get_user_by_openid', lambda: get_user_by_openid('wx_001')),
+        ('get_all_communities', lambda: get_all_communities()),
+        ('get_community_by_id', lambda: get_community_by_id(1)),
+        ('get_listings', lambda: get_listings()),
+        ('get_listings', lambda: get_listings(community_id=1)),
+        ('get_listings', lambda: get_listings(category='textbook')),
+        ('get_listings', lambda: get_listings(community_id=1, category='textbook')),
+        ('get_listings:all_statuses', lambda: get_listings(status='all')),
+        ('get_listings', lambda: get_listings(user_id=1)),
+        ('get_listings', lambda: get_listings(user_id=1, status='all')),
+        ('get_listings', lambda: get_listings(after=encode_cursor('9999-12-31 00:00:00', 0))),
+        ('get_listing_by_id', lambda: get_listing_by_id(1)),
+        ('get_listings_by_ids', lambda: get_listings_by_ids([3, 1, 2])),
+        ('get_user_favorites', lambda: get_user_favorites(1)),
+        ('get_user_favorites', lambda: get_user_favorites(1, after=encode_cursor('9999-12-31 00:00:00', 0))),
+        ('get_user_favorite_ids', lambda: get_user_favorite_ids(1)),
+        ('search_listings', lambda: search_listings('CS-UY')),
+        ('get_course_catalog:all', lambda: get_course_catalog()),
+        ('get_course_catalog', lambda: get_course_catalog('cs-uy')),
+        ('get_listings_by_course', lambda: get_listings_by_course('CS-UY 1134')),
+        ('get_user_threads', lambda: get_user_threads(1)),
+        ('get_user_threads', lambda: get_user_threads(1, after=encode_cursor('9999-12-31 00:00:00', 0))),
+        ('get_thread_messages', lambda: get_thread_messages(1)),
+        ('get_thread_messages', lambda: get_thread_messages(1, after=encode_cursor('0000-01-01 00:00:00', 0))),
+        ('get_unread_count', lambda: get_unread_count(1)),
+        ('get_thread_by_id', lambda: get_thread_by_id(1)),
+        ('get_pending_reports', lambda: get_pending_reports()),
+        ('get_user_reviews', lambda: get_user_reviews(1)),
+        ('get_user_rating_stats', lambda: get_user_rating_stats(1)),
+        ('get_dashboard_stats', lambda: get_dashboard_stats()),
+        ('get_category_stats', lambda: get_category_stats()),
+        ('get_nearby_communities', lambda: get_nearby_communities(40.6943, -73.9865, 2)),
+        ('get_listings', lambda: get_listings(near=(40.6943, -73.9865, 2))),
+        ('get_listings', lambda: get_listings(category='textbook', near=(40.6943, -73.9865, 2))),
+        ('search_listings_advanced', lambda: search.search_listings_advanced('', {'sort_by': 'created_at'})),
+        ('search_listings_advanced', lambda: search.search_listings_advanced('', {'sort_by': 'price', 'sort_order': 'ASC'})),
+        ('search_listings_advanced', lambda: search.search_listings_advanced('', {'sort_by': 'views'})),
+        ('search_listings_advanced', lambda: search.search_listings_advanced('', {'category': 'textbook', 'sort_by': 'created_at'})),
+        ('search_listings_advanced', lambda: search.search_listings_advanced('calculator', {})),
+        ('search_listings_advanced', lambda: search.search_listings_advanced('', {'course_code': 'cs-uy 1134', 'sort_by': 'price'})),
+        ('search_listings_advanced', lambda: search.search_listings_advanced('', {'category': 'textbook'}, facets=True)),
+        ('search_listings_advanced', lambda: search.search_listings_advanced('calculator', {'max_price': 100}, facets=True)),
+        ('search_listings_advanced', lambda: search.search_listings_advanced('', {'near': (40.6943, -73.9865, 2), 'sort_by': 'price'})),
+        ('get_search_suggestions', lambda: search.get_search_suggestions('cs')),
+        ('get_popular_searches', lambda: search.get_popular_searches()),
+        ('get_related_listings', lambda: search.get_related_listings(1)),
+        ('get_search_history', lambda: search.get_search_history(1)),
+        ('get_trending_items', lambda: search.get_trending_items()),
+        ('search_by_category_stats', lambda: search.search_by_category_stats()),
+        ('get_user_notifications', lambda: notifications.get_user_notifications(1)),
+        ('get_user_notifications', lambda: notifications.get_user_notifications(1, unread_only=True)),
+        ('get_unread_notification_count', lambda: notifications.get_unread_count(1))
+    ]
+
+
+def _plan_problems(sql, plan):
+    """找出查询计划中的全表扫描和 ORDER BY 临时排序"""
+    subqueries = set()
+    for detail in plan:
+        if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE ')):
+            subqueries.add(detail.split()[1])
+    
+    problems = []
+    for detail in plan:
+        if 'TEMP B-TREE' in detail and 'ORDER BY' in detail:
+            problems.append(detail)
+        elif detail.startswith('SCAN '):
+            target = detail.split()[1]
+            if target in subqueries or target == 'CONSTANT' or 'VIRTUAL TABLE' in detail:
+                continue
+            problems.append(detail)
+    return problems
+
+
+def audit_query_plans():
+    """
+    对所有生产查询执行 EXPLAIN QUERY PLAN
+    
+    通过 trace 回调捕获各函数实际执行的 SELECT，返回发现的问题列表；
+    列在 QUERY_PLAN_EXEMPTIONS 中的计划步骤标记为 exempt，并附上原因。
+    """
+    problems = []
+    # 先缓存 FTS / R*Tree 是否可用，避免把 sqlite_master 探测算进第一个用例
+    has_fts_index()
+    has_geo_index()
+    with get_db() as conn:
+        for name, run in _query_plan_cases():
+            statements = []
+            conn.set_trace_callback(statements.append)
+            try:
+                run()
+            finally:
+                conn.set_trace_callback(None)
+            
+            for sql in statements:
+                if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+                    continue
+                # FTS5 首次打开虚拟表时读取自身影子表（'main'.'xxx_config' 等），不是业务查询
+                if "'main'." in sql:
+                    continue
+                plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+                for detail in _plan_problems(sql, plan):
+                    reason = _plan_exemption(name, detail)
+                    problems.append({
+                        'query': name,
+                        'detail': detail,
+                        'exempt': reason is not None,
+                        'reason': reason,
+                        'sql': ' '.join(sql.split())
+                    })
+    return problems
+
+
 # 主程序 - 用于直接运行此文件时初始化数据库
+# 检查查询计划: python -m modules.db --check-plans
+# 压缩搜索历史: python -m modules.db --compact-search-history
+# 重新计算相关商品: python -m modules.db --rebuild-related
 if __name__ == '__main__':
+    import sys
+    
     print("开始初始化数据库...")
     init_database()
     print("\n开始插入示例数据...")
     insert_sample_data()
     print("\n数据库初始化完成！")
+    
+    if '--check-plans' in sys.argv:
+        print("\n检查查询计划...")
+        # 以 -m 运行时本文件是 __main__，search 等模块另外导入了 modules.db；
+        # 经由 modules.db 审计，trace 回调才能捕获这些模块执行的查询
+        from modules import db
+        problems = db.audit_query_plans()
+        failures = [p for p in problems if not p['exempt']]
+        for problem in problems:
+            mark = '-' if problem['exempt'] else '✗'
+            reason = f" ({problem['reason']})" if problem['exempt'] else ''
+            print(f"{mark} {problem['query']}: {problem['detail']}{reason}")
+            if not problem['exempt']:
+                print(f"    {problem['sql']}")
+        if failures:
+            print(f"\n✗ {len(failures)} 个查询计划存在全表扫描或临时排序")
+            sys.exit(1)
+        print("\n✓ 查询计划检查通过")
+    
+    if '--compact-search-history' in sys.argv:
+        from modules import search
+        print("\n压缩搜索历史...")
+        result = search.compact_search_history()
+        print(f"✓ 压缩 {result['compacted']} 条原始记录，清理 {result['trimmed']} 条过旧的用户搜索词")
+    
+    if '--rebuild-stats' in sys.argv:
+        print("\n重新计算仪表盘计数...")
+        drift = rebuild_stats_counters()
+        for name, values in sorted(drift.items()):
+            print(f"  {name}: {values['stored']} -> {values['actual']}")
+        print(f"✓ 计数和分类统计已重算，{len(drift)} 项存在偏差")
+    
+    if '--rebuild-related' in sys.argv:
+        from modules import search
+        print("\n重新计算相关商品...")
+        print(f"✓ 已为 {search.build_related_index(rebuild=True)} 个商品计算相关商品")
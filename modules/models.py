@@ -1,5 +1,13 @@
+import os
+import json
+import threading
 from datetime import datetime
 from enum import Enum
+from collections import OrderedDict
+
+# 图片 JSON 解析结果缓存的最大条目数
+IMAGE_DECODE_CACHE_SIZE = int(os.getenv('IMAGE_DECODE_CACHE_SIZE', '4096'))
+
 
 class VerifyStatus(Enum):
     """认证状态枚举"""
@@ -43,6 +51,9 @@ class TargetType(Enum):
 
 class User:
     """用户模型"""
+    __slots__ = ('id', 'openid', 'email', 'phone', 'nickname', 'avatar', 'verify_status', 'community_id',
+                 'building_id', 'credit_score', 'created_at', 'updated_at')
+    
     def __init__(self, openid, email=None, phone=None, nickname=None, avatar=None):
         self.id = None  # 用户ID（由数据库生成）
         self.openid = openid  # 微信用户唯一标识
@@ -77,6 +88,8 @@ class User:
 
 class Community:
     """社区模型"""
+    __slots__ = ('id', 'name', 'type', 'latitude', 'longitude', 'radius', 'created_at')
+    
     def __init__(self, name, type, latitude, longitude, radius=1.0):
         self.id = None
         self.name = name  # 社区名称
@@ -98,8 +111,51 @@ class Community:
         }
 
 
+_decoded_images = OrderedDict()
+_decoded_images_lock = threading.Lock()
+
+
+def decode_images(raw):
+    """
+    解析 images 列，格式错误时返回空列表
+    
+    解析结果按 JSON 串缓存（LRU，最多 IMAGE_DECODE_CACHE_SIZE 条），之后从缓存复制
+    """
+    if not raw:
+        return []
+    with _decoded_images_lock:
+        images = _decoded_images.get(raw)
+        if images is not None:
+            _decoded_images.move_to_end(raw)
+            return list(images)
+    try:
+        images = json.loads(raw)
+    except (TypeError, ValueError):
+        images = ()
+    images = tuple(images) if isinstance(images, list) else ()
+    with _decoded_images_lock:
+        _decoded_images[raw] = images
+        while len(_decoded_images) > IMAGE_DECODE_CACHE_SIZE:
+            _decoded_images.popitem(last=False)
+    return list(images)
+
+
+def _isoformat(value):
+    """datetime 转为 ISO 字符串，数据库读出的字符串原样返回"""
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
 class Listing:
-    """物品发布模型"""
+    """
+    物品发布模型
+    
+    从数据库行构造时（见 db.ListingRowMapper）images 保存原始 JSON 串，
+    首次访问时才解析；user 为卖家信息，extra 为查询附带的其他列。
+    """
+    __slots__ = ('id', 'user_id', 'title', 'description', 'price', '_images', '_raw_images', 'category',
+                 'course_code', 'isbn', 'course_code_norm', 'isbn_norm', 'community_id', 'latitude', 'longitude',
+                 'meetup_point', 'status', 'view_count', 'created_at', 'updated_at', 'user', 'extra')
+    
     def __init__(self, user_id, title, price, category, community_id):
         self.id = None
         self.user_id = user_id  # 发布者ID
@@ -110,15 +166,34 @@ class Listing:
         self.category = category  # 类别
         self.course_code = None  # 课程代码（教材类）
         self.isbn = None  # ISBN码（教材类）
+        self.course_code_norm = None  # 标准化课程代码
+        self.isbn_norm = None  # 标准化 ISBN
         self.community_id = community_id  # 所属社区
+        self.latitude = None  # 纬度
+        self.longitude = None  # 经度
         self.meetup_point = ""  # 推荐面交地点
         self.status = ListingStatus.ACTIVE  # 状态
         self.view_count = 0  # 浏览次数
         self.created_at = datetime.now()
         self.updated_at = datetime.now()
+        self.user = None  # 卖家信息
+        self.extra = None  # 查询附带的其他列
+    
+    @property
+    def images(self):
+        """图片数组（首次访问时解析）"""
+        images = self._images
+        if images is None:
+            images = self._images = decode_images(self._raw_images)
+        return images
+    
+    @images.setter
+    def images(self, value):
+        self._images = value
+        self._raw_images = None
     
     def to_dict(self):
-        return {
+        data = {
             'id': self.id,
             'user_id': self.user_id,
             'title': self.title,
@@ -128,17 +203,28 @@ class Listing:
             'category': self.category.value if isinstance(self.category, Category) else self.category,
             'course_code': self.course_code,
             'isbn': self.isbn,
+            'course_code_norm': self.course_code_norm,
+            'isbn_norm': self.isbn_norm,
             'community_id': self.community_id,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
             'meetup_point': self.meetup_point,
             'status': self.status.value if isinstance(self.status, ListingStatus) else self.status,
             'view_count': self.view_count,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat()
+            'created_at': _isoformat(self.created_at),
+            'updated_at': _isoformat(self.updated_at)
         }
+        if self.extra:
+            data.update(self.extra)
+        if self.user is not None:
+            data['user'] = self.user
+        return data
 
 
 class Message:
     """消息模型"""
+    __slots__ = ('id', 'thread_id', 'from_user_id', 'to_user_id', 'content', 'is_read', 'created_at')
+    
     def __init__(self, thread_id, from_user_id, to_user_id, content):
         self.id = None
         self.thread_id = thread_id  # 会话ID
@@ -162,6 +248,8 @@ class Message:
 
 class Thread:
     """会话模型"""
+    __slots__ = ('id', 'buyer_id', 'seller_id', 'listing_id', 'last_message_at', 'status', 'created_at')
+    
     def __init__(self, buyer_id, seller_id, listing_id):
         self.id = None
         self.buyer_id = buyer_id  # 买家ID
@@ -185,6 +273,9 @@ class Thread:
 
 class Report:
     """举报模型"""
+    __slots__ = ('id', 'reporter_id', 'target_type', 'target_id', 'reason', 'description', 'handled',
+                 'handler_id', 'created_at', 'handled_at')
+    
     def __init__(self, reporter_id, target_type, target_id, reason):
         self.id = None
         self.reporter_id = reporter_id  # 举报人ID
@@ -214,6 +305,8 @@ class Report:
 
 class Review:
     """评价模型（扩展功能）"""
+    __slots__ = ('id', 'listing_id', 'reviewer_id', 'reviewee_id', 'rating', 'comment', 'tags', 'created_at')
+    
     def __init__(self, listing_id, reviewer_id, reviewee_id, rating):
         self.id = None
         self.listing_id = listing_id  # 关联物品ID
@@ -17,14 +17,15 @@ class NotificationType:
 
 def create_notification(user_id, type, title, content, link=None, data=None):
     """创建通知"""
-    with db.get_db() as conn:
-        cursor = conn.cursor()
+    def op(cursor):
         cursor.execute('''
             INSERT INTO notifications (user_id, type, title, content, link, data, is_read)
             VALUES (?, ?, ?, ?, ?, ?, 0)
         ''', (user_id, type, title, content, link, str(data) if data else None))
         return cursor.lastrowid
 
+    return db.execute_write(op)
+
 
 def get_user_notifications(user_id, limit=20, unread_only=False):
     """获取用户通知"""
@@ -140,10 +141,13 @@ def init_notifications_table():
             )
         ''')
         cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_notifications_user 
-            ON notifications(user_id)
+            CREATE INDEX IF NOT EXISTS idx_notifications_user_created 
+            ON notifications(user_id, created_at)
         ''')
         cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_notifications_unread 
-            ON notifications(user_id, is_read)
+            CREATE INDEX IF NOT EXISTS idx_notifications_user_unread_created 
+            ON notifications(user_id, is_read, created_at)
         ''')
+        # 旧索引已被上面的复合索引覆盖
+        cursor.execute('DROP INDEX IF EXISTS idx_notifications_user')
+        cursor.execute('DROP INDEX IF EXISTS idx_notifications_unread')
@@ -3,9 +3,80 @@
 支持全文搜索、智能推荐、搜索历史、热门搜索等
 """
 from modules import db
+import os
 import re
-from datetime import datetime, timedelta
-from collections import Counter
+import time
+import atexit
+import math
+import heapq
+import bisect
+import threading
+from datetime import datetime, timedelta, timezone
+from collections import Counter, OrderedDict, defaultdict
+
+# 是否启用进程内倒排索引
+SEARCH_INDEX_ENABLED = os.getenv('SEARCH_INDEX_ENABLED', '1') != '0'
+
+# 倒排索引：子串查找结果缓存的最大条目数（LRU）
+SUBSTRING_CACHE_SIZE = int(os.getenv('SUBSTRING_CACHE_SIZE', '1024'))
+
+# 搜索建议中热门搜索词的统计天数
+SUGGESTION_QUERY_DAYS = int(os.getenv('SUGGESTION_QUERY_DAYS', '30'))
+
+# 热门搜索：每日桶保留的候选词数、保留天数、写回数据库的间隔（秒）
+POPULAR_SKETCH_CAPACITY = int(os.getenv('POPULAR_SKETCH_CAPACITY', '200'))
+POPULAR_BUCKET_DAYS = int(os.getenv('POPULAR_BUCKET_DAYS', '30'))
+POPULAR_CHECKPOINT_INTERVAL = float(os.getenv('POPULAR_CHECKPOINT_INTERVAL', '30'))
+
+# 搜索历史：原始记录保留天数、每个用户保留的搜索词数、按天汇总保留天数、自动压缩间隔（秒）
+SEARCH_HISTORY_RAW_DAYS = int(os.getenv('SEARCH_HISTORY_RAW_DAYS', '7'))
+SEARCH_HISTORY_PER_USER = int(os.getenv('SEARCH_HISTORY_PER_USER', '50'))
+SEARCH_ROLLUP_DAYS = int(os.getenv('SEARCH_ROLLUP_DAYS', '365'))
+SEARCH_HISTORY_COMPACT_INTERVAL = float(os.getenv('SEARCH_HISTORY_COMPACT_INTERVAL', '3600'))
+
+# 相关商品：每个物品保存的邻居数、同分类补充候选数、忽略的高频词比例
+RELATED_TOP_N = int(os.getenv('RELATED_TOP_N', '8'))
+RELATED_CATEGORY_CANDIDATES = int(os.getenv('RELATED_CATEGORY_CANDIDATES', '20'))
+RELATED_MAX_DF_RATIO = float(os.getenv('RELATED_MAX_DF_RATIO', '0.5'))
+
+# 相关度加分：同分类、价格相近（±50%）、同社区
+RELATED_CATEGORY_BONUS = 0.3
+RELATED_PRICE_BONUS = 0.15
+RELATED_COMMUNITY_BONUS = 0.1
+RELATED_MAX_BONUS = RELATED_CATEGORY_BONUS + RELATED_PRICE_BONUS + RELATED_COMMUNITY_BONUS
+
+# 纠错：结果少于该数量时尝试纠正拼写
+FUZZY_MIN_RESULTS = int(os.getenv('FUZZY_MIN_RESULTS', '3'))
+
+# 热度：半衰期（小时）及浏览、收藏的权重
+TRENDING_HALF_LIFE_HOURS = float(os.getenv('TRENDING_HALF_LIFE_HOURS', '6'))
+TRENDING_WEIGHTS = {'view': 1.0, 'favorite': 5.0}
+
+# 分面：价格区间边界（左闭右开，最后一档不设上限）
+PRICE_FACET_BOUNDARIES = (50, 100, 200, 500)
+FACET_FIELDS = ('category', 'community', 'price', 'has_images')
+# images 列存 JSON 数组，空数组为 '[]'
+HAS_IMAGES_SQL = "COALESCE(l.images, '') NOT IN ('', '[]')"
+
+# 中日韩文字（假名、汉字、谚文）：没有空格分词，按相邻两字切分
+_CJK_RANGES = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_CJK_RUN = re.compile(f'[{_CJK_RANGES}]+')
+_TOKEN_PATTERN = re.compile(f'[{_CJK_RANGES}]+|[^\\W{_CJK_RANGES}]+')
+_QUERY_STRIP_PATTERN = re.compile(r'[^\w\s-]')
+
+# 可排序字段 -> SQL 列
+SORT_COLUMNS = {
+    'price': 'l.price',
+    'views': 'l.view_count',
+    'created_at': 'l.created_at'
+}
+
+# 可排序字段 -> 结果中的游标字段
+SORT_CURSOR_FIELDS = {
+    'price': 'price',
+    'views': 'view_count',
+    'created_at': 'created_at'
+}
 
 
 class SearchEngine:
@@ -19,63 +90,795 @@ class SearchEngine:
         # 转换为小写
         query = query.lower()
         # 移除特殊字符（保留字母、数字、空格、连字符）
-        query = re.sub(r'[^\w\s-]', '', query)
+        query = _QUERY_STRIP_PATTERN.sub('', query)
         return query.strip()
     
     @staticmethod
     def normalize_course_code(code):
-        """标准化课程代码"""
-        if not code:
-            return ''
+        """标准化课程代码（与 listings.course_code_norm 列一致）"""
         # 统一格式: CS-UY 1134 或 CSUY1134 都转换为 CSUY1134
-        code = re.sub(r'[^\w]', '', code.upper())
-        return code
+        return db.normalize_course_code(code)
     
     @staticmethod
     def tokenize(text):
-        """文本分词"""
+        """
+        文本分词
+        
+        拉丁字母和数字按单词切分；连续的中日韩文字切成相邻两字的二元组
+        （单字保留原样），如 "宿舍椅子" -> 宿舍, 舍椅, 椅子
+        """
         if not text:
             return []
-        # 分割成单词
-        tokens = re.findall(r'\w+', text.lower())
+        tokens = []
+        for run in _TOKEN_PATTERN.findall(text.lower()):
+            if len(run) > 1 and _CJK_RUN.match(run):
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            else:
+                tokens.append(run)
         return tokens
     
     @staticmethod
-    def calculate_relevance_score(listing, query_tokens):
-        """计算相关度评分"""
+    def prepare_query(query):
+        """预先计算查询的分词和标准化课程代码，供批量打分复用"""
+        tokens = SearchEngine.tokenize(query)
+        return {
+            'tokens': tokens,
+            'course_code': SearchEngine.normalize_course_code(' '.join(tokens))
+        }
+    
+    @staticmethod
+    def calculate_relevance_score(listing, query_tokens, query_course_code=None):
+        """计算相关度评分（query_course_code 可由 prepare_query 预先算好）"""
         score = 0
         
         # 标题匹配（权重最高）
-        title_tokens = SearchEngine.tokenize(listing.get('title', ''))
+        title_tokens = SearchEngine.tokenize(listing.get('title') or '')
+        title_token_set = set(title_tokens)
         for token in query_tokens:
-            if token in title_tokens:
+            if token in title_token_set:
                 score += 10
             elif any(token in t for t in title_tokens):
                 score += 5
         
         # 描述匹配
-        desc_tokens = SearchEngine.tokenize(listing.get('description', ''))
+        desc_tokens = set(SearchEngine.tokenize(listing.get('description') or ''))
         for token in query_tokens:
             if token in desc_tokens:
                 score += 3
         
         # 课程代码精确匹配（权重很高）
         if listing.get('course_code'):
-            course_code_normalized = SearchEngine.normalize_course_code(listing['course_code'])
-            query_normalized = SearchEngine.normalize_course_code(' '.join(query_tokens))
-            if query_normalized in course_code_normalized or course_code_normalized in query_normalized:
+            course_code_normalized = listing.get('course_code_norm') or SearchEngine.normalize_course_code(listing['course_code'])
+            if query_course_code is None:
+                query_course_code = SearchEngine.normalize_course_code(' '.join(query_tokens))
+            if query_course_code in course_code_normalized or course_code_normalized in query_course_code:
                 score += 20
         
         # 分类匹配
-        category = listing.get('category', '')
+        category = (listing.get('category') or '').lower()
         for token in query_tokens:
-            if token in category.lower():
+            if token in category:
                 score += 5
         
         return score
 
 
-def search_listings_advanced(query, filters=None):
+# ===== 分面统计 =====
+def _failed_facets(doc, filters, course_code=None, allowed_ids=None):
+    """
+    doc 不满足的分面筛选维度列表
+    
+    doc 需含 id/raw_category/community_id/price/has_images/course_code_normalized；
+    course_code 为标准化后的课程筛选，allowed_ids 为附近物品 id 集合，
+    不满足这两项时返回 None（不计入任何分面）
+    """
+    if course_code and doc['course_code_normalized'] != course_code:
+        return None
+    if allowed_ids is not None and doc['id'] not in allowed_ids:
+        return None
+    failed = []
+    if filters.get('category') and doc['raw_category'] != filters['category']:
+        failed.append('category')
+    if filters.get('community_id') and doc['community_id'] != filters['community_id']:
+        failed.append('community')
+    price = doc['price']
+    if ((filters.get('min_price') is not None and (price is None or price < filters['min_price'])) or
+            (filters.get('max_price') is not None and (price is None or price > filters['max_price']))):
+        failed.append('price')
+    if filters.get('has_images') and not doc['has_images']:
+        failed.append('has_images')
+    return failed
+
+
+class FacetCounter:
+    """
+    单遍分面计数
+    
+    满足全部筛选的物品计入每个分面；只有一个分面维度不满足的物品
+    计入该维度，这样已选中的分类/社区/价格仍能显示其他取值的数量。
+    """
+    
+    def __init__(self):
+        self.total = 0
+        self._counts = {field: Counter() for field in FACET_FIELDS}
+    
+    def add(self, doc, failed):
+        if failed is None or len(failed) > 1:
+            return
+        if not failed:
+            self.total += 1
+        for field in failed or FACET_FIELDS:
+            if field == 'category':
+                value = doc['raw_category']
+            elif field == 'community':
+                value = doc['community_id']
+            elif field == 'price':
+                if doc['price'] is None:
+                    continue
+                value = bisect.bisect_right(PRICE_FACET_BOUNDARIES, doc['price'])
+            else:
+                value = bool(doc['has_images'])
+            if value is not None:
+                self._counts[field][value] += 1
+    
+    def result(self):
+        """{total, category, community, price, has_images}，各分面为 [{value, count}] 列表"""
+        def ranked(counter):
+            return [{'value': value, 'count': count}
+                    for value, count in sorted(counter.items(), key=lambda item: (-item[1], str(item[0])))]
+        
+        bounds = (None,) + PRICE_FACET_BOUNDARIES + (None,)
+        price = []
+        for bucket in range(len(PRICE_FACET_BOUNDARIES) + 1):
+            low, high = bounds[bucket] or 0, bounds[bucket + 1]
+            price.append({
+                'value': f'{low}-{high}' if high is not None else f'{low}+',
+                'min': low,
+                'max': high,
+                'count': self._counts['price'][bucket]
+            })
+        
+        return {
+            'total': self.total,
+            'category': ranked(self._counts['category']),
+            'community': ranked(self._counts['community']),
+            'price': price,
+            'has_images': [{'value': value, 'count': self._counts['has_images'][value]} for value in (True, False)]
+        }
+
+
+class SubstringIndex:
+    """
+    字符串集合上的子串查找
+    
+    n-gram -> 字符串 的映射：不超过 GRAM_SIZE 个字符的 token 直接查表，
+    更长的取各 trigram 对应集合的交集再逐个确认，不扫描整个集合。
+    查找结果按 token 缓存（LRU），增删字符串时只丢弃受影响的缓存项。
+    调用方负责加锁。
+    """
+    
+    GRAM_SIZE = 3
+    
+    def __init__(self, cache_size=SUBSTRING_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._grams = {}
+        self._cache = OrderedDict()
+    
+    @classmethod
+    def _key_grams(cls, key):
+        """字符串中长度 1 ~ GRAM_SIZE 的全部子串"""
+        return {key[i:i + n] for n in range(1, cls.GRAM_SIZE + 1) for i in range(len(key) - n + 1)}
+    
+    def add(self, key):
+        for gram in self._key_grams(key):
+            self._grams.setdefault(gram, set()).add(key)
+        self._invalidate(key)
+    
+    def discard(self, key):
+        for gram in self._key_grams(key):
+            keys = self._grams.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._grams[gram]
+        self._invalidate(key)
+    
+    def _invalidate(self, key):
+        for token in [token for token in self._cache if token in key]:
+            del self._cache[token]
+    
+    def containing(self, token):
+        """集合中包含 token 的所有字符串"""
+        keys = self._cache.get(token)
+        if keys is not None:
+            self._cache.move_to_end(token)
+            return keys
+        
+        if len(token) <= self.GRAM_SIZE:
+            keys = tuple(self._grams.get(token, ()))
+        else:
+            gram_sets = sorted(
+                (self._grams.get(token[i:i + self.GRAM_SIZE], set()) for i in range(len(token) - self.GRAM_SIZE + 1)),
+                key=len
+            )
+            keys = tuple(key for key in gram_sets[0].intersection(*gram_sets[1:]) if token in key)
+        
+        self._cache[token] = keys
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return keys
+
+
+class InvertedIndex(db.ListingListener):
+    """
+    进程内倒排索引
+    
+    term -> {listing_id: [标题词频, 描述词频]}，另存课程代码、分类和
+    价格/社区/发布时间等筛选字段。只收录 active 物品，启动时全量构建，
+    之后通过 db.register_listing_listener 增量更新。
+    词、课程代码和分类的子串匹配各用一个 SubstringIndex，不扫描整个词表。
+    匹配与评分规则和 SearchEngine.calculate_relevance_score 保持一致。
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self._postings = {}
+        self._docs = {}
+        self._course_codes = {}
+        self._categories = {}
+        self._term_index = SubstringIndex()
+        self._course_code_index = SubstringIndex()
+        self._category_index = SubstringIndex()
+        self._built_at = None
+        self._queries = 0
+    
+    def build(self):
+        """从 listings 表全量构建索引，返回收录的物品数"""
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, title, description, course_code, course_code_norm, category, price, community_id, images, created_at
+                FROM listings
+                WHERE status = 'active'
+            ''')
+            rows = [dict(row) for row in cursor.fetchall()]
+        
+        with self._lock:
+            self._postings = {}
+            self._docs = {}
+            self._course_codes = {}
+            self._categories = {}
+            self._term_index = SubstringIndex()
+            self._course_code_index = SubstringIndex()
+            self._category_index = SubstringIndex()
+            for row in rows:
+                self._add(row)
+            self._ready = True
+            self._built_at = datetime.now()
+        return len(rows)
+    
+    def _apply(self, listing_id, row):
+        """重新收录变更的物品（已下架或删除则移出索引）"""
+        with self._lock:
+            self._remove(listing_id)
+            if row is not None and row['status'] == 'active':
+                self._add(row)
+    
+    def _add(self, row):
+        title_terms = Counter(SearchEngine.tokenize(row.get('title') or ''))
+        desc_terms = Counter(SearchEngine.tokenize(row.get('description') or ''))
+        course_code = (row.get('course_code') or '').lower()
+        category = (row.get('category') or '').lower()
+        listing_id = row['id']
+        
+        terms = set(title_terms) | set(desc_terms)
+        for term in terms:
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = {}
+                self._term_index.add(term)
+            posting[listing_id] = [title_terms.get(term, 0), desc_terms.get(term, 0)]
+        
+        for mapping, index, key in ((self._course_codes, self._course_code_index, course_code),
+                                    (self._categories, self._category_index, category)):
+            if key:
+                ids = mapping.get(key)
+                if ids is None:
+                    ids = mapping[key] = set()
+                    index.add(key)
+                ids.add(listing_id)
+        
+        self._docs[listing_id] = {
+            'id': listing_id,
+            'terms': terms,
+            'title_terms': title_terms,
+            'course_code': course_code,
+            'course_code_normalized': row.get('course_code_norm') or '',
+            'category': category,
+            'raw_category': row.get('category'),
+            'price': row.get('price'),
+            'community_id': row.get('community_id'),
+            'has_images': (row.get('images') or '') not in ('', '[]'),
+            'created_at': row.get('created_at') or ''
+        }
+    
+    def _remove(self, listing_id):
+        doc = self._docs.pop(listing_id, None)
+        if doc is None:
+            return
+        
+        for term in doc['terms']:
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            posting.pop(listing_id, None)
+            if not posting:
+                del self._postings[term]
+                self._term_index.discard(term)
+        
+        for mapping, index, key in ((self._course_codes, self._course_code_index, doc['course_code']),
+                                    (self._categories, self._category_index, doc['category'])):
+            ids = mapping.get(key)
+            if ids is not None:
+                ids.discard(listing_id)
+                if not ids:
+                    del mapping[key]
+                    index.discard(key)
+    
+    def _candidates(self, token):
+        """标题、描述、课程代码或分类中包含 token 的物品"""
+        ids = set()
+        for term in self._term_index.containing(token):
+            ids.update(self._postings[term])
+        for course_code in self._course_code_index.containing(token):
+            ids.update(self._course_codes[course_code])
+        for category in self._category_index.containing(token):
+            ids.update(self._categories[category])
+        return ids
+    
+    def _score(self, listing_id, doc, prepared):
+        score = 0
+        title_terms = doc['title_terms']
+        
+        for token in prepared['tokens']:
+            # 标题匹配
+            if token in title_terms:
+                score += 10
+            elif any(token in term for term in title_terms):
+                score += 5
+            
+            # 描述匹配
+            posting = self._postings.get(token)
+            if posting is not None and listing_id in posting and posting[listing_id][1]:
+                score += 3
+            
+            # 分类匹配
+            if token in doc['category']:
+                score += 5
+        
+        # 课程代码匹配
+        course_code = doc['course_code_normalized']
+        if course_code:
+            query_course_code = prepared['course_code']
+            if query_course_code in course_code or course_code in query_course_code:
+                score += 20
+        
+        return score
+    
+    def search(self, query, filters=None, limit=50, offset=0, facets=None, allowed_ids=None):
+        """
+        在索引中检索并按相关度排序
+        
+        所有查询词都须命中（标题/描述中的词、课程代码或分类包含该词）。
+        同分按创建时间、id 倒序。facets 为 FacetCounter 时在同一遍中统计分面；
+        allowed_ids 不为 None 时只保留其中的物品（附近筛选）。
+        返回 (当前页 id 列表, {id: 评分})
+        """
+        filters = filters or {}
+        prepared = SearchEngine.prepare_query(query)
+        if not prepared['tokens']:
+            return [], {}
+        course_code = SearchEngine.normalize_course_code(filters['course_code']) if filters.get('course_code') else None
+        
+        with self._lock:
+            self._queries += 1
+            candidates = None
+            # 先处理命中最少的词，尽早缩小候选集
+            for token_ids in sorted((self._candidates(token) for token in set(prepared['tokens'])), key=len):
+                candidates = token_ids if candidates is None else candidates & token_ids
+                if not candidates:
+                    return [], {}
+            
+            scored = []
+            for listing_id in candidates:
+                doc = self._docs.get(listing_id)
+                if doc is None:
+                    continue
+                failed = _failed_facets(doc, filters, course_code, allowed_ids)
+                if facets is not None:
+                    facets.add(doc, failed)
+                if failed == []:
+                    scored.append((self._score(listing_id, doc, prepared), doc['created_at'], listing_id))
+        
+        top = heapq.nlargest(offset + limit, scored)[offset:]
+        return [listing_id for _, _, listing_id in top], {listing_id: score for score, _, listing_id in top}
+    
+    def count_facets(self, filters, facets, allowed_ids=None):
+        """不带搜索词时对全部在售物品（或 allowed_ids 中的物品）统计分面"""
+        filters = filters or {}
+        course_code = SearchEngine.normalize_course_code(filters['course_code']) if filters.get('course_code') else None
+        with self._lock:
+            self._queries += 1
+            docs = self._docs.values() if allowed_ids is None else filter(None, map(self._docs.get, allowed_ids))
+            for doc in docs:
+                facets.add(doc, _failed_facets(doc, filters, course_code))
+    
+    def _stats_locked(self):
+        return {
+            'documents': len(self._docs),
+            'terms': len(self._postings),
+            'queries': self._queries,
+            'built_at': self._built_at.isoformat() if self._built_at else None
+        }
+
+
+class SuggestionIndex(db.ListingListener):
+    """
+    搜索建议（自动补全）索引
+    
+    按 (匹配键, 类型, 文本) 排好序的数组，用 bisect 找出前缀区间；
+    每个建议带预先算好的热度权重：课程代码为在售数量，标题为浏览量，
+    搜索词为近期搜索次数。同一前缀的结果会缓存到下一次变更。
+    """
+    
+    TYPES = ('course_code', 'title', 'query')
+    MAX_CACHED_PREFIXES = 2048
+    
+    def __init__(self):
+        super().__init__()
+        self._keys = []
+        self._weights = {}
+        self._listings = {}
+        self._cache = {}
+        self._built_at = None
+        self._lookups = 0
+        self._cache_hits = 0
+    
+    @staticmethod
+    def _entry_keys(type, text):
+        """建议的匹配键：完整文本、各个词，课程代码再加上标准化形式"""
+        keys = {text.lower()}
+        keys.update(SearchEngine.tokenize(text))
+        # 中文没有空格分词，加入连续中文的各个后缀，使前缀查找等价于子串匹配
+        for run in _CJK_RUN.findall(text):
+            keys.update(run[i:] for i in range(len(run) - 1))
+        if type == 'course_code':
+            keys.add(SearchEngine.normalize_course_code(text).lower())
+        keys.discard('')
+        return keys
+    
+    def build(self):
+        """从在售物品和近期搜索历史全量构建，返回建议条数"""
+        since_date = datetime.now() - timedelta(days=SUGGESTION_QUERY_DAYS)
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, title, course_code, view_count
+                FROM listings
+                WHERE status = 'active'
+            ''')
+            listings = [dict(row) for row in cursor.fetchall()]
+            cursor.execute('''
+                SELECT LOWER(query), COUNT(*)
+                FROM search_history
+                WHERE created_at >= ?
+                GROUP BY LOWER(query)
+            ''', (since_date,))
+            queries = cursor.fetchall()
+        
+        with self._lock:
+            self._keys = []
+            self._weights = {}
+            self._listings = {}
+            self._cache = {}
+            for listing in listings:
+                self._add_listing(listing)
+            for query, count in queries:
+                self._adjust('query', query, count)
+            self._ready = True
+            self._built_at = datetime.now()
+            return len(self._weights)
+    
+    def _adjust(self, type, text, delta):
+        """调整一条建议的权重，权重归零时移出索引"""
+        if not text:
+            return
+        entry = (type, text)
+        weight = self._weights.get(entry, 0) + delta
+        if entry not in self._weights and weight > 0:
+            for key in self._entry_keys(type, text):
+                bisect.insort(self._keys, (key, type, text))
+        elif entry in self._weights and weight <= 0:
+            for key in self._entry_keys(type, text):
+                position = bisect.bisect_left(self._keys, (key, type, text))
+                if position < len(self._keys) and self._keys[position] == (key, type, text):
+                    self._keys.pop(position)
+        
+        if weight > 0:
+            self._weights[entry] = weight
+        else:
+            self._weights.pop(entry, None)
+        self._cache.clear()
+    
+    def _add_listing(self, listing):
+        contribution = (listing.get('title'), listing.get('course_code'), (listing.get('view_count') or 0) + 1)
+        self._listings[listing['id']] = contribution
+        title, course_code, views = contribution
+        self._adjust('title', title, views)
+        self._adjust('course_code', course_code, 1)
+    
+    def _remove_listing(self, listing_id):
+        contribution = self._listings.pop(listing_id, None)
+        if contribution is None:
+            return
+        title, course_code, views = contribution
+        self._adjust('title', title, -views)
+        self._adjust('course_code', course_code, -1)
+    
+    def _apply(self, listing_id, row):
+        """按物品当前状态更新其建议"""
+        with self._lock:
+            self._remove_listing(listing_id)
+            if row is not None and row['status'] == 'active':
+                self._add_listing(row)
+    
+    def record_query(self, query):
+        """记录一次搜索，提升该搜索词的热度"""
+        if not self._ready:
+            return
+        with self._lock:
+            self._adjust('query', query.lower(), 1)
+    
+    def complete(self, prefix, type, limit=5):
+        """返回某类建议中以 prefix 开头、热度最高的 limit 条文本"""
+        cache_key = (prefix, type, limit)
+        with self._lock:
+            self._lookups += 1
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._cache_hits += 1
+                return cached
+            
+            start = bisect.bisect_left(self._keys, (prefix,))
+            end = bisect.bisect_left(self._keys, (prefix + '\uffff',))
+            texts = {text for _, entry_type, text in self._keys[start:end] if entry_type == type}
+            result = heapq.nlargest(limit, texts, key=lambda text: (self._weights[(type, text)], text))
+            
+            if len(self._cache) >= self.MAX_CACHED_PREFIXES:
+                self._cache.clear()
+            self._cache[cache_key] = result
+            return result
+    
+    def weight(self, type, text):
+        """建议的热度权重"""
+        return self._weights.get((type, text), 0)
+    
+    def _stats_locked(self):
+        counts = Counter(type for type, _ in self._weights)
+        return {
+            'entries': {type: counts.get(type, 0) for type in self.TYPES},
+            'keys': len(self._keys),
+            'lookups': self._lookups,
+            'cache_hits': self._cache_hits,
+            'built_at': self._built_at.isoformat() if self._built_at else None
+        }
+
+
+class SpellingCorrector(db.ListingListener):
+    """
+    拼写纠错
+    
+    词表为在售物品标题中的词和标准化课程代码，按三元组（trigram）建倒排。
+    纠错时先按共同三元组数量筛出候选（每处编辑最多破坏 3 个三元组），
+    再计算有上限的编辑距离（含相邻字符交换），取距离最小、出现次数最多的词。
+    """
+    
+    MIN_TOKEN_LENGTH = 3
+    MAX_CACHED_TOKENS = 4096
+    
+    def __init__(self):
+        super().__init__()
+        self._counts = Counter()
+        self._trigrams = defaultdict(set)
+        self._listings = {}
+        self._cache = {}
+        self._corrections = 0
+    
+    @staticmethod
+    def _grams(term):
+        padded = f'^{term}$'
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+    
+    @classmethod
+    def _listing_terms(cls, row):
+        terms = {token for token in SearchEngine.tokenize(row.get('title') or '')
+                 if len(token) >= cls.MIN_TOKEN_LENGTH and not token.isdigit()}
+        course_code = (row.get('course_code_norm') or '').lower()
+        if course_code:
+            terms.add(course_code)
+        return terms
+    
+    @staticmethod
+    def max_distance(token):
+        """允许的最大编辑距离：短词 1，较长的词 2"""
+        return 1 if len(token) <= 5 else 2
+    
+    @staticmethod
+    def distance(a, b, limit):
+        """
+        编辑距离（插入、删除、替换、相邻交换），超过 limit 时返回 limit + 1
+        """
+        if abs(len(a) - len(b)) > limit:
+            return limit + 1
+        previous2 = None
+        previous = list(range(len(b) + 1))
+        for i in range(1, len(a) + 1):
+            current = [i] + [0] * len(b)
+            for j in range(1, len(b) + 1):
+                cost = 0 if a[i - 1] == b[j - 1] else 1
+                current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+                if previous2 is not None and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                    current[j] = min(current[j], previous2[j - 2] + 1)
+            if min(current) > limit:
+                return limit + 1
+            previous2, previous = previous, current
+        return min(previous[len(b)], limit + 1)
+    
+    def _add_terms(self, terms):
+        for term in terms:
+            if self._counts[term] == 0:
+                for gram in self._grams(term):
+                    self._trigrams[gram].add(term)
+            self._counts[term] += 1
+        self._cache.clear()
+    
+    def _remove_terms(self, terms):
+        for term in terms:
+            self._counts[term] -= 1
+            if self._counts[term] <= 0:
+                del self._counts[term]
+                for gram in self._grams(term):
+                    bucket = self._trigrams.get(gram)
+                    if bucket is not None:
+                        bucket.discard(term)
+                        if not bucket:
+                            del self._trigrams[gram]
+        self._cache.clear()
+    
+    def build(self):
+        """从在售物品构建词表"""
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, title, course_code_norm FROM listings WHERE status = 'active'")
+            rows = [dict(row) for row in cursor.fetchall()]
+        
+        with self._lock:
+            self._counts = Counter()
+            self._trigrams = defaultdict(set)
+            self._listings = {}
+            for row in rows:
+                terms = self._listing_terms(row)
+                self._listings[row['id']] = terms
+                self._add_terms(terms)
+            self._ready = True
+        return len(self._counts)
+    
+    def _apply(self, listing_id, row):
+        """按物品当前状态更新词表"""
+        with self._lock:
+            self._remove_terms(self._listings.pop(listing_id, set()))
+            if row is not None and row['status'] == 'active':
+                terms = self._listing_terms(row)
+                self._listings[listing_id] = terms
+                self._add_terms(terms)
+    
+    def correct(self, token):
+        """返回 token 的纠正结果；已在词表中或找不到足够接近的词时返回 None"""
+        token = token.lower()
+        if len(token) < self.MIN_TOKEN_LENGTH or token.isdigit():
+            return None
+        
+        with self._lock:
+            if token in self._counts:
+                return None
+            if token in self._cache:
+                return self._cache[token]
+            
+            limit = self.max_distance(token)
+            grams = self._grams(token)
+            shared = Counter()
+            for gram in grams:
+                shared.update(self._trigrams.get(gram, ()))
+            
+            # q-gram 过滤：距离 <= limit 的词至少共享 len(grams) - 3 * limit 个三元组
+            threshold = max(1, len(grams) - 3 * limit)
+            best = None
+            for term, count in shared.items():
+                if count < threshold or abs(len(term) - len(token)) > limit:
+                    continue
+                distance = self.distance(token, term, limit)
+                if distance <= limit:
+                    candidate = (distance, -self._counts[term], term)
+                    if best is None or candidate < best:
+                        best = candidate
+            
+            result = best[2] if best else None
+            if len(self._cache) >= self.MAX_CACHED_TOKENS:
+                self._cache.clear()
+            self._cache[token] = result
+            return result
+    
+    def suggest(self, query):
+        """纠正查询中的拼写错误，没有可纠正的词时返回 None"""
+        if not self._ready or not query:
+            return None
+        tokens = SearchEngine.tokenize(query)
+        corrected = [self.correct(token) or token for token in tokens]
+        if corrected == tokens:
+            return None
+        self._corrections += 1
+        return ' '.join(corrected)
+    
+    def _stats_locked(self):
+        return {
+            'terms': len(self._counts),
+            'trigrams': len(self._trigrams),
+            'corrections': self._corrections
+        }
+
+
+_search_index = InvertedIndex()
+_suggestion_index = SuggestionIndex()
+_spelling = SpellingCorrector()
+
+
+def build_search_index():
+    """构建倒排索引、搜索建议和纠错词表并注册增量更新（SEARCH_INDEX_ENABLED=0 时跳过）"""
+    if not SEARCH_INDEX_ENABLED:
+        return 0
+    count = _search_index.build()
+    _suggestion_index.build()
+    _spelling.build()
+    db.register_listing_listener(_search_index.on_listing_change)
+    db.register_listing_listener(_suggestion_index.on_listing_change)
+    db.register_listing_listener(_spelling.on_listing_change)
+    return count
+
+
+def suggest_correction(query):
+    """拼写纠错：返回纠正后的查询，无需纠正时返回 None"""
+    return _spelling.suggest(query)
+
+
+def get_search_index_stats():
+    """获取倒排索引和搜索建议索引统计"""
+    stats = _search_index.stats()
+    stats['suggestions'] = _suggestion_index.stats()
+    stats['spelling'] = _spelling.stats()
+    stats['popular_searches'] = _popular_searches.stats()
+    stats['related'] = _related_index.stats()
+    stats['trending'] = _trending.stats()
+    stats['bitmaps'] = _bitmap_index.stats()
+    return stats
+
+
+@db.cached_result(
+    # 分面计数覆盖筛选条件之外的分类和社区，任何物品变更都可能影响
+    scope=lambda a: (None, None, None) if a['facets'] else
+        ((a['filters'] or {}).get('community_id'), (a['filters'] or {}).get('category'), None),
+    key=lambda a: (SearchEngine.normalize_query(a['query']) if a['query'] else '', a['filters'] or {}, a['facets'])
+)
+def search_listings_advanced(query, filters=None, facets=False):
     """
     高级搜索
     
@@ -86,115 +889,239 @@ def search_listings_advanced(query, filters=None):
             - max_price: 最高价格
             - category: 分类
             - community_id: 社区ID
+            - course_code: 课程代码（任意写法，按标准化代码精确匹配）
+            - has_images: 为真时只返回带图片的物品
+            - near: (纬度, 经度, 距离公里)，只返回该范围内的物品并附带 distance_km
             - sort_by: 排序字段 (relevance/price/created_at/views)
             - sort_order: 排序方向 (ASC/DESC)
             - limit: 返回数量限制
             - offset: 偏移量
+            - cursor: 上一页返回的游标（排序键, id），按相关度排序时不适用
+        facets: 为真时返回 {items, facets}，facets 为全部匹配结果（不分页）
+            按分类、社区、价格区间、有无图片的计数，见 FacetCounter
     """
     filters = filters or {}
     
-    with db.get_db() as conn:
-        cursor = conn.cursor()
-        
-        # 基础查询
-        sql = '''
-            SELECT l.*, 
-                   u.nickname, u.verify_status, u.avatar,
-                   (SELECT COUNT(*) FROM reviews WHERE listing_id = l.id) as review_count,
-                   (SELECT AVG(rating) FROM reviews WHERE listing_id = l.id) as avg_rating
+    # 附近筛选：R*Tree 预筛选 + haversine，和课程筛选一样不参与分面
+    near_sql, near_params, centers = '', [], None
+    if filters.get('near'):
+        with db.get_db() as conn:
+            near_sql, near_params, centers = db.near_listing_filter(conn.cursor(), filters['near'])
+    
+    # 有全文索引且搜索词足够长时走 FTS5，否则回退到 LIKE
+    normalized_query = SearchEngine.normalize_query(query) if query else ''
+    match = db.build_fts_query(normalized_query) if normalized_query and db.has_fts_index() else None
+    
+    # 基础查询
+    if match:
+        from_sql = '''
+            FROM listings_fts
+            JOIN listings l ON l.id = listings_fts.rowid
+            JOIN users u ON l.user_id = u.id
+            WHERE listings_fts MATCH ? AND l.status = 'active'
+        '''
+        params = [match]
+    else:
+        from_sql = '''
             FROM listings l
             JOIN users u ON l.user_id = u.id
             WHERE l.status = 'active'
         '''
         params = []
+    
+    # 搜索关键词（无全文索引时）
+    if normalized_query and not match:
+        from_sql += ''' AND (
+            LOWER(l.title) LIKE ? OR 
+            LOWER(l.description) LIKE ? OR 
+            LOWER(l.course_code) LIKE ? OR
+            LOWER(l.category) LIKE ?
+        )'''
+        search_term = f'%{normalized_query}%'
+        params.extend([search_term, search_term, search_term, search_term])
+    
+    # 课程筛选（走 course_code_norm 索引）
+    if filters.get('course_code'):
+        from_sql += ' AND l.course_code_norm = ?'
+        params.append(SearchEngine.normalize_course_code(filters['course_code']))
+    
+    from_sql += near_sql
+    params.extend(near_params)
+    
+    # 分面统计的范围：搜索词、课程和附近筛选，不含下面的分面筛选
+    facet_sql, facet_params = from_sql, list(params)
+    
+    # 价格范围
+    if filters.get('min_price') is not None:
+        from_sql += ' AND l.price >= ?'
+        params.append(filters['min_price'])
+    
+    if filters.get('max_price') is not None:
+        from_sql += ' AND l.price <= ?'
+        params.append(filters['max_price'])
+    
+    # 分类筛选
+    if filters.get('category'):
+        from_sql += ' AND l.category = ?'
+        params.append(filters['category'])
+    
+    # 社区筛选
+    if filters.get('community_id'):
+        from_sql += ' AND l.community_id = ?'
+        params.append(filters['community_id'])
+    
+    # 图片筛选
+    if filters.get('has_images'):
+        from_sql += f' AND {HAS_IMAGES_SQL}'
+    
+    limit = filters.get('limit', 50)
+    offset = filters.get('offset', 0)
+    sort_by = filters.get('sort_by', 'relevance')
+    counter = FacetCounter() if facets else None
+    
+    def respond(listings):
+        if centers is not None:
+            db.annotate_distance(listings, filters['near'], centers)
+        if counter is None:
+            return listings
+        return {'items': listings, 'facets': counter.result()}
+    
+    with db.get_db() as conn:
+        cursor = conn.cursor()
         
-        # 搜索关键词
-        if query:
-            normalized_query = SearchEngine.normalize_query(query)
-            sql += ''' AND (
-                LOWER(l.title) LIKE ? OR 
-                LOWER(l.description) LIKE ? OR 
-                LOWER(l.course_code) LIKE ? OR
-                LOWER(l.category) LIKE ?
-            )'''
-            search_term = f'%{normalized_query}%'
-            params.extend([search_term, search_term, search_term, search_term])
-        
-        # 价格范围
-        if filters.get('min_price') is not None:
-            sql += ' AND l.price >= ?'
-            params.append(filters['min_price'])
-        
-        if filters.get('max_price') is not None:
-            sql += ' AND l.price <= ?'
-            params.append(filters['max_price'])
-        
-        # 分类筛选
-        if filters.get('category'):
-            sql += ' AND l.category = ?'
-            params.append(filters['category'])
-        
-        # 社区筛选
-        if filters.get('community_id'):
-            sql += ' AND l.community_id = ?'
-            params.append(filters['community_id'])
-        
-        # 排序
-        sort_by = filters.get('sort_by', 'relevance')
-        sort_order = filters.get('sort_order', 'DESC')
-        
-        if sort_by == 'price':
-            sql += f' ORDER BY l.price {sort_order}'
-        elif sort_by == 'views':
-            sql += f' ORDER BY l.view_count {sort_order}'
-        elif sort_by == 'created_at':
-            sql += f' ORDER BY l.created_at {sort_order}'
-        else:
-            # 默认按创建时间排序，稍后在Python中计算相关度
-            sql += ' ORDER BY l.created_at DESC'
+        # 内存索引没有坐标，附近筛选时先取出范围内的物品 id
+        near_ids = None
+        if near_sql and _search_index.ready and (
+                (query and sort_by == 'relevance') or (counter is not None and not normalized_query)):
+            cursor.execute(f"SELECT l.id FROM listings l WHERE l.status = 'active'{near_sql}", near_params)
+            near_ids = {row[0] for row in cursor.fetchall()}
         
-        # 限制和偏移
-        limit = filters.get('limit', 50)
-        offset = filters.get('offset', 0)
-        sql += ' LIMIT ? OFFSET ?'
-        params.extend([limit, offset])
+        # 按相关度排序：对全部候选打分，只保留前 offset+limit 个（分面在同一遍中统计）
+        if query and sort_by == 'relevance':
+            if _search_index.ready:
+                page_ids, scores = _search_index.search(query, filters, limit, offset, facets=counter,
+                                                        allowed_ids=near_ids)
+            else:
+                # 统计分面时在 Python 中判断分面筛选，否则直接用完整的 SQL 条件
+                if counter is not None:
+                    page_ids, scores = _rank_candidates(cursor, facet_sql, facet_params, query, limit, offset,
+                                                        filters, counter)
+                else:
+                    page_ids, scores = _rank_candidates(cursor, from_sql, params, query, limit, offset, filters)
+            listings = _fetch_search_rows(cursor, page_ids)
+            for listing in listings:
+                listing['relevance_score'] = scores[listing['id']]
+            
+            # 首页结果太少时按纠正拼写后的查询补充，补充的结果带 corrected_query
+            if offset == 0 and len(listings) < min(limit, FUZZY_MIN_RESULTS):
+                corrected = suggest_correction(query)
+                if corrected:
+                    seen = {listing['id'] for listing in listings}
+                    for listing in search_listings_advanced(corrected, dict(filters, limit=limit - len(listings))):
+                        if listing['id'] not in seen:
+                            listing['corrected_query'] = corrected
+                            listings.append(listing)
+            return respond(listings)
         
-        cursor.execute(sql, params)
+        if counter is not None:
+            if _search_index.ready and not normalized_query:
+                _search_index.count_facets(filters, counter, near_ids)
+            else:
+                _count_facets(cursor, facet_sql, facet_params, filters, counter)
         
-        results = []
-        for row in cursor.fetchall():
-            listing = dict(row)
-            
-            # 解析 JSON 字段
-            try:
-                import json
-                listing['images'] = json.loads(listing['images']) if listing['images'] else []
-            except:
-                listing['images'] = []
-            
-            # 构建用户信息
-            listing['user'] = {
-                'nickname': listing['nickname'],
-                'verify_status': listing['verify_status'],
-                'avatar': listing['avatar']
-            }
-            
-            # 移除重复字段
-            for key in ['nickname', 'verify_status', 'avatar']:
-                listing.pop(key, None)
-            
-            # 计算相关度评分（如果有搜索词）
-            if query and sort_by == 'relevance':
-                query_tokens = SearchEngine.tokenize(query)
-                listing['relevance_score'] = SearchEngine.calculate_relevance_score(listing, query_tokens)
-            
-            results.append(listing)
+        # 排序
+        sort_order = 'ASC' if str(filters.get('sort_order', 'DESC')).upper() == 'ASC' else 'DESC'
+        if sort_by in SORT_COLUMNS:
+            sort_column = SORT_COLUMNS[sort_by]
+        else:
+            sort_column = 'l.created_at'
+            sort_order = 'DESC'
         
-        # 如果按相关度排序，重新排序结果
-        if query and sort_by == 'relevance':
-            results.sort(key=lambda x: x.get('relevance_score', 0), reverse=True)
+        # 键集分页
+        if filters.get('cursor'):
+            comparator = '>' if sort_order == 'ASC' else '<'
+            from_sql += f' AND ({sort_column}, l.id) {comparator} (?, ?)'
+            params.extend(db.decode_cursor(filters['cursor']))
+            offset = 0
         
-        return results
+        sql = f'''
+            SELECT l.*, 
+                   u.nickname, u.verify_status, u.avatar,
+                   (SELECT COUNT(*) FROM reviews WHERE listing_id = l.id) as review_count,
+                   (SELECT AVG(rating) FROM reviews WHERE listing_id = l.id) as avg_rating
+            {from_sql}
+            ORDER BY {sort_column} {sort_order}, l.id {sort_order}
+            LIMIT ? OFFSET ?
+        '''
+        cursor.execute(sql, params + [limit, offset])
+        return respond(db.map_listing_rows(cursor))
+
+
+def _facet_rows(cursor, from_sql, params, columns=''):
+    """取出分面统计所需的窄列（可附加其他列），行格式与 InvertedIndex 的文档一致"""
+    cursor.execute(f'''
+        SELECT l.id, l.category AS raw_category, l.community_id, l.price,
+               l.course_code_norm AS course_code_normalized, {HAS_IMAGES_SQL} AS has_images{columns}
+        {from_sql}
+    ''', params)
+    return map(dict, cursor.fetchall())
+
+
+def _count_facets(cursor, from_sql, params, filters, counter):
+    """索引不可用或带搜索词时，用一次窄列查询统计分面"""
+    for row in _facet_rows(cursor, from_sql, params):
+        counter.add(row, _failed_facets(row, filters))
+
+
+def _rank_candidates(cursor, from_sql, params, query, limit, offset, filters=None, counter=None):
+    """
+    对所有候选计算相关度，用大小为 offset+limit 的堆选出当前页
+    
+    from_sql 不含分面筛选（价格、分类、社区、图片），由 filters 在同一遍中判断；
+    counter 为 FacetCounter 时顺带统计分面。
+    同分按创建时间、id 倒序，保证翻页顺序稳定。返回 (当前页 id 列表, {id: 评分})
+    """
+    filters = filters or {}
+    prepared = SearchEngine.prepare_query(query)
+    scored = []
+    for candidate in _facet_rows(cursor, from_sql, params,
+                                 ', l.title, l.description, l.course_code, l.course_code_norm, l.category, l.created_at'):
+        failed = _failed_facets(candidate, filters)
+        if counter is not None:
+            counter.add(candidate, failed)
+        if failed == []:
+            scored.append((SearchEngine.calculate_relevance_score(candidate, prepared['tokens'], prepared['course_code']),
+                           candidate['created_at'] or '', candidate['id']))
+    top = heapq.nlargest(offset + limit, scored)[offset:]
+    return [listing_id for _, _, listing_id in top], {listing_id: score for score, _, listing_id in top}
+
+
+def _fetch_search_rows(cursor, listing_ids):
+    """按给定顺序取回完整的搜索结果行"""
+    if not listing_ids:
+        return []
+    placeholders = ','.join('?' * len(listing_ids))
+    cursor.execute(f'''
+        SELECT l.*, 
+               u.nickname, u.verify_status, u.avatar,
+               (SELECT COUNT(*) FROM reviews WHERE listing_id = l.id) as review_count,
+               (SELECT AVG(rating) FROM reviews WHERE listing_id = l.id) as avg_rating
+        FROM listings l
+        JOIN users u ON l.user_id = u.id
+        WHERE l.id IN ({placeholders})
+    ''', listing_ids)
+    rows = {listing['id']: listing for listing in db.map_listing_rows(cursor)}
+    return [rows[listing_id] for listing_id in listing_ids if listing_id in rows]
+
+
+def get_next_cursor(query, results, filters=None):
+    """根据高级搜索结果生成下一页游标，按相关度排序时返回 None"""
+    filters = filters or {}
+    sort_by = filters.get('sort_by', 'relevance')
+    if query and sort_by == 'relevance':
+        return None
+    field = SORT_CURSOR_FIELDS.get(sort_by, 'created_at')
+    return db.make_next_cursor(results, filters.get('limit', 50), field, 'id')
 
 
 def get_search_suggestions(query, limit=5):
@@ -210,6 +1137,9 @@ def get_search_suggestions(query, limit=5):
     
     normalized_query = SearchEngine.normalize_query(query)
     
+    if _suggestion_index.ready:
+        return _indexed_suggestions(query, normalized_query, limit)
+    
     with db.get_db() as conn:
         cursor = conn.cursor()
         
@@ -255,6 +1185,235 @@ def get_search_suggestions(query, limit=5):
         return suggestions[:limit]
 
 
+def _indexed_suggestions(query, normalized_query, limit):
+    """从搜索建议索引取结果：课程代码优先，其次标题，最后热门搜索词"""
+    suggestions = []
+    seen = set()
+    
+    # 课程代码同时按原样和标准化形式（CSUY1134）匹配
+    course_prefixes = {normalized_query, SearchEngine.normalize_course_code(query).lower()}
+    course_codes = []
+    for prefix in course_prefixes:
+        if prefix:
+            course_codes.extend(_suggestion_index.complete(prefix, 'course_code', limit))
+    for code in sorted(set(course_codes), key=lambda code: -_suggestion_index.weight('course_code', code))[:limit]:
+        suggestions.append({'type': 'course_code', 'text': code, 'display': f'📚 {code}'})
+        seen.add(code.lower())
+    
+    for type in ('title', 'query'):
+        remaining = limit - len(suggestions)
+        if remaining <= 0:
+            break
+        for text in _suggestion_index.complete(normalized_query, type, limit):
+            if text.lower() in seen:
+                continue
+            suggestions.append({'type': type, 'text': text, 'display': text})
+            seen.add(text.lower())
+            if len(suggestions) >= limit:
+                break
+    
+    return suggestions[:limit]
+
+
+class SpaceSaving:
+    """
+    Space-Saving 频繁项统计
+    
+    最多保留 capacity 个词；满了以后新词顶替计数最小的词，
+    继承其计数作为误差上界。计数 >= 真实次数，误差不超过 总数/capacity。
+    """
+    
+    def __init__(self, capacity=POPULAR_SKETCH_CAPACITY):
+        self.capacity = capacity
+        self.counters = {}
+    
+    def add(self, item, count=1):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [count, 0]
+        else:
+            victim = min(self.counters, key=lambda key: self.counters[key][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[item] = [floor + count, floor]
+    
+    def merge(self, other):
+        """合并另一个统计（计数和误差相加），超出容量时保留计数最大的词"""
+        for item, (count, error) in other.counters.items():
+            counter = self.counters.setdefault(item, [0, 0])
+            counter[0] += count
+            counter[1] += error
+        if len(self.counters) > self.capacity:
+            keep = heapq.nlargest(self.capacity, self.counters.items(), key=lambda item: item[1][0])
+            self.counters = dict(keep)
+    
+    def top(self, k):
+        """计数最高的 k 个 (词, 计数, 误差)"""
+        return [(item, count, error) for item, (count, error)
+                in heapq.nlargest(k, self.counters.items(), key=lambda item: item[1][0])]
+
+
+class PopularSearchTracker:
+    """
+    热门搜索统计
+    
+    每天一个 Space-Saving 桶，由 save_search_history 实时累加；
+    查询时合并窗口内的桶，代价只与天数和桶容量有关。
+    桶定期写回 search_trend_buckets 表，重启后从表中恢复。
+    """
+    
+    def __init__(self, capacity=POPULAR_SKETCH_CAPACITY, retention_days=POPULAR_BUCKET_DAYS,
+                 checkpoint_interval=POPULAR_CHECKPOINT_INTERVAL):
+        self.capacity = capacity
+        self.retention_days = retention_days
+        self.checkpoint_interval = checkpoint_interval
+        self._buckets = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._ready = False
+        self._last_checkpoint = time.monotonic()
+        self._checkpoints = 0
+    
+    @property
+    def ready(self):
+        return self._ready
+    
+    @staticmethod
+    def _bucket_key(when):
+        return when.strftime('%Y-%m-%d')
+    
+    def load(self):
+        """
+        从 search_trend_buckets 恢复各日统计
+        
+        表为空时用保留期内的搜索历史（原始记录和按天汇总）初始化一次
+        """
+        since = self._bucket_key(datetime.now() - timedelta(days=self.retention_days))
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM search_trend_buckets LIMIT 1')
+            seeded = cursor.fetchone() is not None
+            if seeded:
+                cursor.execute('''
+                    SELECT bucket, query, count, error
+                    FROM search_trend_buckets
+                    WHERE bucket >= ?
+                ''', (since,))
+                rows = cursor.fetchall()
+            else:
+                cursor.execute('''
+                    SELECT day, query, SUM(count), 0 FROM (
+                        SELECT DATE(created_at) AS day, LOWER(query) AS query, COUNT(*) AS count
+                        FROM search_history
+                        WHERE created_at >= ?
+                        GROUP BY DATE(created_at), LOWER(query)
+                        UNION ALL
+                        SELECT day, query, count
+                        FROM search_history_daily
+                        WHERE day >= ?
+                    )
+                    GROUP BY day, query
+                ''', (since, since))
+                rows = cursor.fetchall()
+        
+        with self._lock:
+            self._buckets = {}
+            for bucket, query, count, error in rows:
+                sketch = self._buckets.setdefault(bucket, SpaceSaving(self.capacity))
+                sketch.counters[query] = [count, error]
+            # 由 search_history 初始化时每天的词数可能超过容量
+            for sketch in self._buckets.values():
+                sketch.merge(SpaceSaving(self.capacity))
+            self._dirty = set() if seeded else set(self._buckets)
+            self._ready = True
+        return len(rows)
+    
+    def record(self, query, when=None):
+        """记录一次搜索"""
+        if not self._ready:
+            return
+        bucket = self._bucket_key(when or datetime.now())
+        with self._lock:
+            sketch = self._buckets.get(bucket)
+            if sketch is None:
+                sketch = self._buckets[bucket] = SpaceSaving(self.capacity)
+                self._expire_locked()
+            sketch.add(query)
+            self._dirty.add(bucket)
+            due = time.monotonic() - self._last_checkpoint >= self.checkpoint_interval
+        if due:
+            self.checkpoint(wait=False)
+    
+    def _expire_locked(self):
+        since = self._bucket_key(datetime.now() - timedelta(days=self.retention_days))
+        for bucket in [bucket for bucket in self._buckets if bucket < since]:
+            del self._buckets[bucket]
+            self._dirty.discard(bucket)
+    
+    def top(self, limit=10, days=7):
+        """最近 days 天内搜索次数最多的 limit 个词：[(词, 次数)]"""
+        since = self._bucket_key(datetime.now() - timedelta(days=days))
+        merged = SpaceSaving(self.capacity)
+        with self._lock:
+            for bucket, sketch in self._buckets.items():
+                if bucket >= since:
+                    merged.merge(sketch)
+        return [(item, count) for item, count, _ in merged.top(limit)]
+    
+    def checkpoint(self, wait=True):
+        """把有变化的桶写回数据库（经由写队列）"""
+        with self._lock:
+            self._last_checkpoint = time.monotonic()
+            snapshot = {bucket: [(bucket, item, count, error) for item, (count, error) in self._buckets[bucket].counters.items()]
+                        for bucket in self._dirty if bucket in self._buckets}
+            self._dirty = set()
+            since = self._bucket_key(datetime.now() - timedelta(days=self.retention_days))
+        if not snapshot:
+            return None
+        
+        def op(cursor):
+            for bucket, rows in snapshot.items():
+                cursor.execute('DELETE FROM search_trend_buckets WHERE bucket = ?', (bucket,))
+                cursor.executemany('''
+                    INSERT INTO search_trend_buckets (bucket, query, count, error)
+                    VALUES (?, ?, ?, ?)
+                ''', rows)
+            cursor.execute('DELETE FROM search_trend_buckets WHERE bucket < ?', (since,))
+            self._checkpoints += 1
+        
+        future = db.submit_write(op)
+        return future.result() if wait else future
+    
+    def shutdown(self):
+        """退出前写回未保存的统计"""
+        if self._ready:
+            try:
+                self.checkpoint()
+            except Exception as e:
+                print(f'热门搜索统计写回失败: {e}')
+    
+    def stats(self):
+        """统计信息"""
+        with self._lock:
+            return {
+                'ready': self._ready,
+                'buckets': len(self._buckets),
+                'tracked_queries': sum(len(sketch.counters) for sketch in self._buckets.values()),
+                'dirty_buckets': len(self._dirty),
+                'checkpoints': self._checkpoints
+            }
+
+
+_popular_searches = PopularSearchTracker()
+atexit.register(_popular_searches.shutdown)
+
+
+def load_popular_searches():
+    """从数据库恢复热门搜索统计"""
+    return _popular_searches.load()
+
+
 def get_popular_searches(limit=10, days=7):
     """
     获取热门搜索
@@ -263,51 +1422,334 @@ def get_popular_searches(limit=10, days=7):
         limit: 返回数量
         days: 统计天数
     """
-    with db.get_db() as conn:
-        cursor = conn.cursor()
+    if _popular_searches.ready:
+        rows = _popular_searches.top(limit, days)
+    else:
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            
+            # 获取最近N天的搜索历史
+            since_date = datetime.now() - timedelta(days=days)
+            # 未压缩的原始记录 + 已压缩的按天汇总
+            cursor.execute('''
+                SELECT query, SUM(count) as count FROM (
+                    SELECT LOWER(query) AS query, COUNT(*) AS count
+                    FROM search_history
+                    WHERE created_at >= ?
+                    GROUP BY LOWER(query)
+                    UNION ALL
+                    SELECT query, count
+                    FROM search_history_daily
+                    WHERE day >= ?
+                )
+                GROUP BY query
+                ORDER BY count DESC
+                LIMIT ?
+            ''', (since_date, since_date.strftime('%Y-%m-%d'), limit))
+            rows = cursor.fetchall()
+    
+    results = []
+    for row in rows:
+        results.append({
+            'keyword': row[0],
+            'count': row[1]
+        })
+    
+    # 如果没有足够的搜索历史，返回默认热门搜索
+    if len(results) < limit:
+        default_searches = [
+            {'keyword': 'CS-UY 1134', 'count': 45},
+            {'keyword': 'MA-UY 1024', 'count': 38},
+            {'keyword': '计算器', 'count': 32},
+            {'keyword': '椅子', 'count': 28},
+            {'keyword': 'Python', 'count': 25},
+            {'keyword': '微波炉', 'count': 22},
+            {'keyword': 'iPad', 'count': 20},
+            {'keyword': '台灯', 'count': 18},
+            {'keyword': '数据结构', 'count': 15},
+            {'keyword': '显示器', 'count': 12}
+        ]
+        results.extend(default_searches[len(results):limit])
+    
+    return results[:limit]
+
+
+class RelatedListingsIndex(db.ListingListener):
+    """
+    相关商品索引
+    
+    标题（双倍权重）和描述的 TF-IDF 余弦相似度，加上同分类、价格相近、
+    同社区的加分，为每个在售物品保存前 RELATED_TOP_N 个邻居到 listing_related。
+    批量计算时按词的倒排表累加稀疏向量点积，只比较有共同词的物品，
+    再补充同分类、同社区最新的若干物品；物品上架/下架时增量更新受影响的列表。
+    """
+    
+    def __init__(self, top_n=RELATED_TOP_N):
+        super().__init__()
+        self.top_n = top_n
+        self._reset()
+    
+    def _reset(self):
+        self._docs = {}
+        self._vectors = {}
+        self._postings = defaultdict(dict)
+        self._categories = defaultdict(list)
+        self._communities = defaultdict(list)
+        self._neighbours = {}
+        self._reverse = defaultdict(set)
+    
+    @staticmethod
+    def _terms(row):
+        terms = Counter(SearchEngine.tokenize(row.get('title') or ''))
+        for term in terms:
+            terms[term] *= 2
+        terms.update(SearchEngine.tokenize(row.get('description') or ''))
+        return terms
+    
+    def _load_rows(self):
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, title, description, category, price, community_id, created_at
+                FROM listings
+                WHERE status = 'active'
+                ORDER BY created_at, id
+            ''')
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def _vectorize(self, terms):
+        """按当前文档频率计算归一化的 TF-IDF 稀疏向量"""
+        total = len(self._docs) or 1
+        vector = {}
+        for term, count in terms.items():
+            df = len(self._postings.get(term, ())) or 1
+            vector[term] = (1 + math.log(count)) * (math.log((total + 1) / (df + 1)) + 1)
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {term: weight / norm for term, weight in vector.items()}
+    
+    def _add_doc(self, row, terms):
+        listing_id = row['id']
+        self._docs[listing_id] = {
+            'terms': terms,
+            'category': row.get('category'),
+            'community_id': row.get('community_id'),
+            'price': row.get('price') or 0
+        }
+        for term in terms:
+            self._postings[term][listing_id] = 0.0
+        self._categories[row.get('category')].append(listing_id)
+        self._communities[row.get('community_id')].append(listing_id)
+    
+    def _remove_doc(self, listing_id):
+        doc = self._docs.pop(listing_id, None)
+        if doc is None:
+            return
+        for term in doc['terms']:
+            posting = self._postings.get(term)
+            if posting is not None:
+                posting.pop(listing_id, None)
+                if not posting:
+                    del self._postings[term]
+        self._vectors.pop(listing_id, None)
+        for members in (self._categories.get(doc['category']), self._communities.get(doc['community_id'])):
+            if members and listing_id in members:
+                members.remove(listing_id)
+    
+    def _set_vector(self, listing_id):
+        vector = self._vectorize(self._docs[listing_id]['terms'])
+        self._vectors[listing_id] = vector
+        for term, weight in vector.items():
+            self._postings[term][listing_id] = weight
+    
+    def _bonus(self, doc, other):
+        bonus = 0.0
+        if doc['category'] == other['category']:
+            bonus += RELATED_CATEGORY_BONUS
+            low, high = sorted((doc['price'], other['price']))
+            if high <= 0 or low >= high * 0.5:
+                bonus += RELATED_PRICE_BONUS
+        if doc['community_id'] == other['community_id']:
+            bonus += RELATED_COMMUNITY_BONUS
+        return bonus
+    
+    def _similarities(self, listing_id):
+        """候选物品及其文本相似度：{other_id: cosine}"""
+        doc = self._docs[listing_id]
+        vector = self._vectors.get(listing_id, {})
+        max_df = max(2, int(len(self._docs) * RELATED_MAX_DF_RATIO))
         
-        # 获取最近N天的搜索历史
-        since_date = datetime.now() - timedelta(days=days)
-        cursor.execute('''
-            SELECT query, COUNT(*) as count
-            FROM search_history
-            WHERE created_at >= ?
-            GROUP BY LOWER(query)
-            ORDER BY count DESC
-            LIMIT ?
-        ''', (since_date, limit))
+        # 稀疏点积：只遍历共同词的倒排表，跳过过于常见的词
+        scores = defaultdict(float)
+        for term, weight in vector.items():
+            posting = self._postings.get(term, {})
+            if len(posting) > max_df:
+                continue
+            for other_id, other_weight in posting.items():
+                if other_id != listing_id:
+                    scores[other_id] += weight * other_weight
         
-        results = []
-        for row in cursor.fetchall():
-            results.append({
-                'keyword': row[0],
-                'count': row[1]
-            })
+        # 没有共同词的同分类、同社区物品，各取最新的若干个作为补充
+        for group in (self._categories.get(doc['category'], []), self._communities.get(doc['community_id'], [])):
+            for other_id in group[-RELATED_CATEGORY_CANDIDATES:]:
+                if other_id != listing_id:
+                    scores.setdefault(other_id, 0.0)
+        return scores
+    
+    def _set_neighbours(self, listing_id, neighbours):
+        for _, other_id in self._neighbours.get(listing_id, []):
+            self._reverse[other_id].discard(listing_id)
+        self._neighbours[listing_id] = neighbours
+        for _, other_id in neighbours:
+            self._reverse[other_id].add(listing_id)
+    
+    def _compute_neighbours(self, listing_id, similarities=None):
+        """
+        相关度最高的 top_n 个邻居：[(score, other_id)]
         
-        # 如果没有足够的搜索历史，返回默认热门搜索
-        if len(results) < limit:
-            default_searches = [
-                {'keyword': 'CS-UY 1134', 'count': 45},
-                {'keyword': 'MA-UY 1024', 'count': 38},
-                {'keyword': '计算器', 'count': 32},
-                {'keyword': '椅子', 'count': 28},
-                {'keyword': 'Python', 'count': 25},
-                {'keyword': '微波炉', 'count': 22},
-                {'keyword': 'iPad', 'count': 20},
-                {'keyword': '台灯', 'count': 18},
-                {'keyword': '数据结构', 'count': 15},
-                {'keyword': '显示器', 'count': 12}
-            ]
-            results.extend(default_searches[len(results):limit])
+        按文本相似度从高到低检查候选，加分上限也追不上当前第 N 名时提前结束
+        """
+        doc = self._docs[listing_id]
+        if similarities is None:
+            similarities = self._similarities(listing_id)
         
-        return results[:limit]
+        heap = []
+        for other_id, similarity in sorted(similarities.items(), key=lambda item: item[1], reverse=True):
+            if len(heap) == self.top_n and similarity + RELATED_MAX_BONUS <= heap[0][0]:
+                break
+            item = (similarity + self._bonus(doc, self._docs[other_id]), other_id)
+            if len(heap) < self.top_n:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        return sorted(heap, reverse=True)
+    
+    def _write(self, listing_ids):
+        """把指定物品的邻居列表写回 listing_related"""
+        rows = []
+        for listing_id in listing_ids:
+            rows.extend((listing_id, rank, other_id, round(score, 6))
+                        for rank, (score, other_id) in enumerate(self._neighbours.get(listing_id, [])))
+        delete_ids = [(listing_id,) for listing_id in listing_ids]
+        
+        def op(cursor):
+            cursor.executemany('DELETE FROM listing_related WHERE listing_id = ?', delete_ids)
+            cursor.executemany('''
+                INSERT INTO listing_related (listing_id, rank, related_id, score)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+        
+        db.execute_write(op)
+    
+    def build(self, rebuild=False):
+        """
+        加载在售物品的向量；rebuild 为真或表为空时全量重算并写入
+        
+        返回在售物品数
+        """
+        rows = self._load_rows()
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT listing_id, rank, related_id, score FROM listing_related ORDER BY listing_id, rank')
+            stored = cursor.fetchall()
+        
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._add_doc(row, self._terms(row))
+            for listing_id in self._docs:
+                self._set_vector(listing_id)
+            
+            if rebuild or not stored:
+                for listing_id in self._docs:
+                    self._set_neighbours(listing_id, self._compute_neighbours(listing_id))
+                neighbours = dict(self._neighbours)
+            else:
+                loaded = defaultdict(list)
+                for listing_id, _, related_id, score in stored:
+                    loaded[listing_id].append((score, related_id))
+                for listing_id, neighbours in loaded.items():
+                    self._set_neighbours(listing_id, neighbours)
+                neighbours = None
+            self._ready = True
+        
+        if neighbours is not None:
+            def op(cursor):
+                cursor.execute('DELETE FROM listing_related')
+                cursor.executemany('''
+                    INSERT INTO listing_related (listing_id, rank, related_id, score)
+                    VALUES (?, ?, ?, ?)
+                ''', [(listing_id, rank, other_id, round(score, 6))
+                      for listing_id, items in neighbours.items()
+                      for rank, (score, other_id) in enumerate(items)])
+            db.execute_write(op)
+        return len(rows)
+    
+    def add(self, row):
+        """物品上架：计算它的邻居，并插入到分数足够高的其他物品的列表中"""
+        listing_id = row['id']
+        with self._lock:
+            self._remove_doc(listing_id)
+            self._add_doc(row, self._terms(row))
+            self._set_vector(listing_id)
+            similarities = self._similarities(listing_id)
+            self._set_neighbours(listing_id, self._compute_neighbours(listing_id, similarities))
+            
+            doc = self._docs[listing_id]
+            changed = [listing_id]
+            for other_id, similarity in similarities.items():
+                score = similarity + self._bonus(doc, self._docs[other_id])
+                current = [item for item in self._neighbours.get(other_id, []) if item[1] != listing_id]
+                if len(current) < self.top_n or score > current[-1][0]:
+                    current.append((score, listing_id))
+                    self._set_neighbours(other_id, heapq.nlargest(self.top_n, current))
+                    changed.append(other_id)
+        
+        self._write(changed)
+    
+    def remove(self, listing_id):
+        """物品下架或删除：移除它并重算把它列为邻居的物品"""
+        with self._lock:
+            affected = list(self._reverse.pop(listing_id, set()))
+            self._remove_doc(listing_id)
+            self._set_neighbours(listing_id, [])
+            self._neighbours.pop(listing_id, None)
+            for other_id in affected:
+                if other_id in self._docs:
+                    self._set_neighbours(other_id, self._compute_neighbours(other_id))
+        
+        self._write([listing_id] + affected)
+    
+    def _apply(self, listing_id, row):
+        """在售物品重算邻居，下架或删除则移除"""
+        if row is not None and row['status'] == 'active':
+            self.add(row)
+        else:
+            self.remove(listing_id)
+    
+    def _stats_locked(self):
+        return {
+            'documents': len(self._docs),
+            'terms': len(self._postings),
+            'lists': len(self._neighbours)
+        }
+
+
+_related_index = RelatedListingsIndex()
+
+
+def build_related_index(rebuild=False):
+    """加载相关商品索引并注册增量更新，rebuild 为真时全量重算"""
+    count = _related_index.build(rebuild)
+    db.register_listing_listener(_related_index.on_listing_change)
+    return count
 
 
 def get_related_listings(listing_id, limit=4):
     """
     获取相关商品
     
-    算法:
+    优先读取预先计算的 listing_related（见 RelatedListingsIndex），
+    没有结果时按以下规则实时查询:
     1. 同类别商品
     2. 相似价格范围（±50%）
     3. 相同社区
@@ -316,6 +1758,22 @@ def get_related_listings(listing_id, limit=4):
     with db.get_db() as conn:
         cursor = conn.cursor()
         
+        cursor.execute('''
+            SELECT l.*, 
+                   u.nickname, u.verify_status, u.avatar,
+                   (l.view_count + 1) as popularity_score,
+                   r.score as similarity_score
+            FROM listing_related r
+            JOIN listings l ON l.id = r.related_id
+            JOIN users u ON l.user_id = u.id
+            WHERE r.listing_id = ? AND l.status = 'active'
+            ORDER BY r.rank
+            LIMIT ?
+        ''', (listing_id, limit))
+        results = db.map_listing_rows(cursor)
+        if results:
+            return results
+        
         # 获取当前商品信息
         cursor.execute('''
             SELECT category, price, community_id, title 
@@ -368,23 +1826,7 @@ def get_related_listings(listing_id, limit=4):
         ))
         
         results = []
-        for row in cursor.fetchall():
-            listing = dict(row)
-            
-            # 解析图片
-            try:
-                import json
-                listing['images'] = json.loads(listing['images']) if listing['images'] else []
-            except:
-                listing['images'] = []
-            
-            # 构建用户信息
-            listing['user'] = {
-                'nickname': listing['nickname'],
-                'verify_status': listing['verify_status'],
-                'avatar': listing['avatar']
-            }
-            
+        for listing in db.map_listing_rows(cursor):
             # 计算相关度
             listing_tokens = SearchEngine.tokenize(listing['title'])
             common_tokens = set(title_tokens) & set(listing_tokens)
@@ -410,13 +1852,18 @@ def save_search_history(user_id, query):
         return
     
     normalized_query = SearchEngine.normalize_query(query)
+    created_at = datetime.now()
     
-    with db.get_db() as conn:
-        cursor = conn.cursor()
+    def op(cursor):
         cursor.execute('''
             INSERT INTO search_history (user_id, query, created_at)
             VALUES (?, ?, ?)
-        ''', (user_id, normalized_query, datetime.now()))
+        ''', (user_id, normalized_query, created_at))
+    
+    db.execute_write(op)
+    _suggestion_index.record_query(normalized_query)
+    _popular_searches.record(normalized_query, created_at)
+    _maybe_compact_search_history()
 
 
 def get_search_history(user_id, limit=10):
@@ -429,14 +1876,21 @@ def get_search_history(user_id, limit=10):
     """
     with db.get_db() as conn:
         cursor = conn.cursor()
+        # 近期原始记录 + 已压缩的用户搜索词
         cursor.execute('''
-            SELECT DISTINCT query, MAX(created_at) as last_searched
-            FROM search_history 
-            WHERE user_id = ? 
-            GROUP BY LOWER(query)
+            SELECT query, MAX(last_searched) as last_searched FROM (
+                SELECT LOWER(query) AS query, created_at AS last_searched
+                FROM search_history
+                WHERE user_id = ?
+                UNION ALL
+                SELECT query, last_searched
+                FROM search_history_user
+                WHERE user_id = ?
+            )
+            GROUP BY query
             ORDER BY last_searched DESC 
             LIMIT ?
-        ''', (user_id, limit))
+        ''', (user_id, user_id, limit))
         
         return [row[0] for row in cursor.fetchall()]
 
@@ -451,22 +1905,325 @@ def clear_search_history(user_id):
     with db.get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM search_history WHERE user_id = ?', (user_id,))
+        cursor.execute('DELETE FROM search_history_user WHERE user_id = ?', (user_id,))
+
+
+def _compact_search_history(cursor, raw_days, per_user, rollup_days):
+    """压缩搜索历史（在写事务内执行），返回压缩和清理的行数"""
+    cutoff = datetime.now() - timedelta(days=raw_days)
+    
+    # 1. 过期原始记录汇总到按天统计
+    cursor.execute('''
+        INSERT INTO search_history_daily (day, query, count)
+        SELECT DATE(created_at), LOWER(query), COUNT(*)
+        FROM search_history
+        WHERE created_at < ?
+        GROUP BY DATE(created_at), LOWER(query)
+        ON CONFLICT(day, query) DO UPDATE SET count = count + excluded.count
+    ''', (cutoff,))
+    
+    # 2. 合并到每个用户的搜索词
+    cursor.execute('''
+        INSERT INTO search_history_user (user_id, query, last_searched)
+        SELECT user_id, LOWER(query), MAX(created_at)
+        FROM search_history
+        WHERE created_at < ?
+        GROUP BY user_id, LOWER(query)
+        ON CONFLICT(user_id, query) DO UPDATE SET
+            last_searched = MAX(last_searched, excluded.last_searched)
+    ''', (cutoff,))
+    
+    # 3. 删除已压缩的原始记录
+    cursor.execute('DELETE FROM search_history WHERE created_at < ?', (cutoff,))
+    compacted = cursor.rowcount
+    
+    # 4. 每个用户只保留最近 per_user 个搜索词
+    cursor.execute('''
+        DELETE FROM search_history_user
+        WHERE rowid IN (
+            SELECT rowid FROM (
+                SELECT rowid, ROW_NUMBER() OVER (
+                    PARTITION BY user_id ORDER BY last_searched DESC
+                ) AS position
+                FROM search_history_user
+            )
+            WHERE position > ?
+        )
+    ''', (per_user,))
+    trimmed = cursor.rowcount
+    
+    # 5. 清理过旧的按天汇总
+    rollup_cutoff = (datetime.now() - timedelta(days=rollup_days)).strftime('%Y-%m-%d')
+    cursor.execute('DELETE FROM search_history_daily WHERE day < ?', (rollup_cutoff,))
+    
+    return {'compacted': compacted, 'trimmed': trimmed}
 
 
-def get_trending_items(limit=10, hours=24):
+def compact_search_history(raw_days=None, per_user=None, rollup_days=None):
     """
-    获取热门商品（基于浏览量增长）
+    压缩搜索历史
+    
+    参数:
+        raw_days: 原始记录保留天数，更早的记录汇总到 search_history_daily
+        per_user: 每个用户保留的最近搜索词数（search_history_user）
+        rollup_days: 按天汇总的保留天数
+    """
+    raw_days = SEARCH_HISTORY_RAW_DAYS if raw_days is None else raw_days
+    per_user = SEARCH_HISTORY_PER_USER if per_user is None else per_user
+    rollup_days = SEARCH_ROLLUP_DAYS if rollup_days is None else rollup_days
+    
+    return db.execute_write(lambda cursor: _compact_search_history(cursor, raw_days, per_user, rollup_days))
+
+
+_last_compaction = time.monotonic()
+_compaction_lock = threading.Lock()
+
+
+def _maybe_compact_search_history():
+    """距上次压缩超过 SEARCH_HISTORY_COMPACT_INTERVAL 时，在写队列中异步压缩"""
+    global _last_compaction
+    if time.monotonic() - _last_compaction < SEARCH_HISTORY_COMPACT_INTERVAL:
+        return
+    with _compaction_lock:
+        if time.monotonic() - _last_compaction < SEARCH_HISTORY_COMPACT_INTERVAL:
+            return
+        _last_compaction = time.monotonic()
+    db.submit_write(lambda cursor: _compact_search_history(
+        cursor, SEARCH_HISTORY_RAW_DAYS, SEARCH_HISTORY_PER_USER, SEARCH_ROLLUP_DAYS
+    ))
+
+
+class TrendingEngine(db.ListingListener):
+    """
+    基于时间衰减的热度引擎
+    
+    每次浏览/收藏按权重累加到物品热度，热度按 TRENDING_HALF_LIFE_HOURS
+    指数衰减。采用前向衰减：事件权重乘以 exp(λ·(t - 基准时刻))，
+    已有分数无需随时间更新，不同物品之间仍可直接比较；指数过大时整体平移基准。
+    
+    全站、每个社区、每个分类、社区+分类各维护一个惰性最大堆：
+    分数变化时压入新条目，取 top-k 时跳过过期条目。
+    """
+    
+    RENORMALIZE_EXPONENT = 50.0
+    
+    def __init__(self, half_life_hours=TRENDING_HALF_LIFE_HOURS):
+        super().__init__(threading.Lock())
+        self.decay = math.log(2) / (half_life_hours * 3600)
+        self._events = 0
+        self._reset(time.time())
+    
+    def _reset(self, landmark):
+        self._landmark = landmark
+        self._scores = {}
+        self._groups = {}
+        self._heaps = defaultdict(list)
+    
+    @staticmethod
+    def _keys(group):
+        community_id, category = group
+        return (None, ('community', community_id), ('category', category), ('both', community_id, category))
+    
+    def _weight(self, timestamp):
+        return math.exp(self.decay * (timestamp - self._landmark))
+    
+    def _push(self, listing_id):
+        entry = (-self._scores[listing_id], listing_id)
+        for key in self._keys(self._groups[listing_id]):
+            heap = self._heaps[key]
+            heapq.heappush(heap, entry)
+            # 过期条目太多时重建
+            if len(heap) > 64 and len(heap) > 4 * len(self._scores):
+                self._heaps[key] = self._rebuild_heap(key)
+    
+    def _rebuild_heap(self, key):
+        heap = [(-score, listing_id) for listing_id, score in self._scores.items()
+                if key in self._keys(self._groups[listing_id])]
+        heapq.heapify(heap)
+        return heap
+    
+    def _renormalize(self, now):
+        """平移基准时刻，防止指数溢出"""
+        factor = math.exp(-self.decay * (now - self._landmark))
+        scores = {listing_id: score * factor for listing_id, score in self._scores.items()}
+        groups = self._groups
+        self._reset(now)
+        self._scores = scores
+        self._groups = groups
+        for listing_id in scores:
+            self._push(listing_id)
+    
+    def _add_locked(self, listing_id, weight, timestamp):
+        if listing_id not in self._groups:
+            return
+        if self.decay * (timestamp - self._landmark) > self.RENORMALIZE_EXPONENT:
+            self._renormalize(timestamp)
+        self._scores[listing_id] = self._scores.get(listing_id, 0.0) + weight * self._weight(timestamp)
+        self._push(listing_id)
+    
+    def load(self):
+        """
+        从数据库加载在售物品
+        
+        以累计浏览量（按发布时间衰减）和近期收藏（按收藏时间衰减）作为初始热度
+        """
+        # 数据库时间为 UTC（CURRENT_TIMESTAMP），统一按 UTC 比较
+        horizon = datetime.now(timezone.utc) - timedelta(hours=TRENDING_HALF_LIFE_HOURS * 20)
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, community_id, category, view_count, created_at
+                FROM listings
+                WHERE status = 'active'
+            ''')
+            listings = cursor.fetchall()
+            cursor.execute('''
+                SELECT f.listing_id, f.created_at
+                FROM favorites f
+                WHERE f.created_at >= ?
+            ''', (horizon.strftime('%Y-%m-%d %H:%M:%S'),))
+            favorites = cursor.fetchall()
+        
+        now = time.time()
+        with self._lock:
+            self._reset(now)
+            for listing_id, community_id, category, view_count, created_at in listings:
+                self._groups[listing_id] = (community_id, category)
+                self._scores[listing_id] = 0.0
+                views = (view_count or 0) + db.get_pending_views(listing_id)
+                if views:
+                    self._scores[listing_id] += TRENDING_WEIGHTS['view'] * views * self._weight(
+                        min(now, self._timestamp(created_at, now)))
+            for listing_id, created_at in favorites:
+                if listing_id in self._groups:
+                    self._scores[listing_id] += TRENDING_WEIGHTS['favorite'] * self._weight(
+                        min(now, self._timestamp(created_at, now)))
+            for listing_id in self._groups:
+                self._push(listing_id)
+            self._ready = True
+        return len(listings)
+    
+    @staticmethod
+    def _timestamp(value, default):
+        """把数据库中的时间转换为时间戳（不带时区的一律按 UTC，与 CURRENT_TIMESTAMP 一致）"""
+        if not value:
+            return default
+        try:
+            parsed = datetime.fromisoformat(str(value))
+        except ValueError:
+            return default
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+    
+    def record(self, event, listing_id, timestamp=None):
+        """记录一次浏览或收藏"""
+        weight = TRENDING_WEIGHTS.get(event)
+        if not self._ready or not weight:
+            return
+        with self._lock:
+            self._events += 1
+            self._add_locked(listing_id, weight, timestamp or time.time())
+    
+    def _apply(self, listing_id, row):
+        """
+        物品上架时加入，下架或删除时移除
+        
+        只把变化的物品压入新分组的堆；旧分组堆中的条目在 top() 中作为过期条目跳过
+        """
+        with self._lock:
+            if row is None or row['status'] != 'active':
+                self._scores.pop(listing_id, None)
+                self._groups.pop(listing_id, None)
+            elif self._groups.get(listing_id) != (row['community_id'], row['category']):
+                self._groups[listing_id] = (row['community_id'], row['category'])
+                self._scores.setdefault(listing_id, 0.0)
+                self._push(listing_id)
+    
+    def top(self, limit=10, community_id=None, category=None):
+        """
+        热度最高的 limit 个物品：[(listing_id, 当前热度)]
+        
+        弹出堆顶直到凑够 limit 个有效条目，再把有效条目放回
+        """
+        if community_id and category:
+            key = ('both', community_id, category)
+        elif community_id:
+            key = ('community', community_id)
+        elif category:
+            key = ('category', category)
+        else:
+            key = None
+        
+        with self._lock:
+            heap = self._heaps.get(key, [])
+            valid = []
+            seen = set()
+            while heap and len(valid) < limit:
+                entry = heapq.heappop(heap)
+                neg_score, listing_id = entry
+                if listing_id in seen or self._scores.get(listing_id) != -neg_score \
+                        or key not in self._keys(self._groups[listing_id]):
+                    continue
+                seen.add(listing_id)
+                valid.append(entry)
+            for entry in valid:
+                heapq.heappush(heap, entry)
+            
+            # 换算为当前时刻的热度
+            factor = self._weight(time.time())
+            return [(listing_id, -neg_score / factor) for neg_score, listing_id in valid]
+    
+    def _stats_locked(self):
+        return {
+            'listings': len(self._scores),
+            'heaps': len(self._heaps),
+            'heap_entries': sum(len(heap) for heap in self._heaps.values()),
+            'events': self._events
+        }
+
+
+_trending = TrendingEngine()
+
+
+def load_trending():
+    """加载热度引擎并订阅浏览、收藏和物品变更事件"""
+    count = _trending.load()
+    db.register_activity_listener(_trending.record)
+    db.register_listing_listener(_trending.on_listing_change)
+    return count
+
+
+def get_trending_items(limit=10, hours=24, community_id=None, category=None):
+    """
+    获取热门商品
+    
+    热度引擎已加载时按时间衰减的浏览/收藏热度排序；
+    否则回退为最近 hours 小时发布的物品按浏览量排序
     
     参数:
         limit: 返回数量
-        hours: 统计时间范围（小时）
+        hours: 统计时间范围（小时，仅回退查询使用）
+        community_id: 社区ID
+        category: 分类
     """
+    if _trending.ready:
+        ranked = _trending.top(limit, community_id, category)
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            listings = _fetch_search_rows(cursor, [listing_id for listing_id, _ in ranked])
+        scores = dict(ranked)
+        for listing in listings:
+            listing['view_count'] += db.get_pending_views(listing['id'])
+            listing['trend_score'] = round(scores[listing['id']], 2)
+        return listings
+    
     with db.get_db() as conn:
         cursor = conn.cursor()
         
         since_time = datetime.now() - timedelta(hours=hours)
         
-        cursor.execute('''
+        query = '''
             SELECT l.*, 
                    u.nickname, u.verify_status, u.avatar,
                    l.view_count as trend_score
@@ -474,46 +2231,334 @@ def get_trending_items(limit=10, hours=24):
             JOIN users u ON l.user_id = u.id
             WHERE l.status = 'active'
             AND l.created_at >= ?
-            ORDER BY l.view_count DESC, l.created_at DESC
-            LIMIT ?
-        ''', (since_time, limit))
+        '''
+        params = [since_time]
+        if community_id:
+            query += ' AND l.community_id = ?'
+            params.append(community_id)
+        if category:
+            query += ' AND l.category = ?'
+            params.append(category)
+        query += ' ORDER BY l.view_count DESC, l.created_at DESC LIMIT ?'
+        params.append(limit)
+        cursor.execute(query, params)
         
-        results = []
-        for row in cursor.fetchall():
-            listing = dict(row)
-            
-            try:
-                import json
-                listing['images'] = json.loads(listing['images']) if listing['images'] else []
-            except:
-                listing['images'] = []
-            
-            listing['user'] = {
-                'nickname': listing['nickname'],
-                'verify_status': listing['verify_status'],
-                'avatar': listing['avatar']
-            }
-            
-            results.append(listing)
+        results = db.map_listing_rows(cursor)
+        for listing in results:
+            # 加上尚未写回数据库的浏览次数
+            pending_views = db.get_pending_views(listing['id'])
+            listing['view_count'] += pending_views
+            listing['trend_score'] += pending_views
         
         return results
 
 
+# ===== 位图筛选 =====
+def _bit_count(bitmap):
+    """位图中置位的个数（Python 3.10 以下没有 int.bit_count）"""
+    return bin(bitmap).count('1')
+
+
+if hasattr(int, 'bit_count'):
+    _bit_count = int.bit_count
+
+
+class ListingBitmapIndex(db.ListingListener):
+    """
+    物品多条件筛选位图
+    
+    每个物品按 (created_at, id) 升序占一个槽位，状态、分类、社区、价格区间
+    （PRICE_FACET_BOUNDARIES）和有无图片的每个取值各维护一个位图（Python 大整数）。
+    任意 AND/OR/NOT 组合直接用位运算求值，从最高位往下取就是按发布时间倒序的一页。
+    价格另按分存成位切片索引（第 i 个位图为价格第 i 位），任意价格区间只需
+    固定次数的位运算。新物品通常最新，追加到末尾；发布时间较早的（如导入数据）
+    按顺序插入，其后的位整体左移一位。槽位不回收，删除只清位。
+    """
+    
+    FIELDS = ('status', 'category', 'community_id', 'price_bucket', 'has_images')
+    PRICE_BITS = 32
+    
+    def __init__(self):
+        super().__init__()
+        self._built_at = None
+        self._queries = 0
+        self._reset()
+    
+    def _reset(self):
+        self._keys = []
+        self._listing_keys = {}
+        self._values = {}
+        self._bitmaps = {field: {} for field in self.FIELDS}
+        self._price_slices = [0] * self.PRICE_BITS
+        self._priced = 0
+        self._all = 0
+    
+    @classmethod
+    def _cents(cls, price):
+        return min(max(int(round(price * 100)), 0), (1 << cls.PRICE_BITS) - 1)
+    
+    @staticmethod
+    def _row_values(row):
+        price = row['price']
+        return {
+            'status': row['status'],
+            'category': row['category'],
+            'community_id': row['community_id'],
+            'price_bucket': bisect.bisect_right(PRICE_FACET_BOUNDARIES, price) if price is not None else None,
+            'has_images': (row['images'] or '') not in ('', '[]')
+        }
+    
+    def build(self):
+        """从 listings 表全量构建位图，返回物品数"""
+        with db.get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, status, category, community_id, price, images, created_at
+                FROM listings
+                ORDER BY created_at, id
+            ''')
+            rows = cursor.fetchall()
+        
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._add_locked(row)
+            self._ready = True
+            self._built_at = datetime.now()
+        return len(rows)
+    
+    @staticmethod
+    def _insert_bit(bitmap, position):
+        """在 position 处插入一个 0 位，原来该位及以上的位左移一位"""
+        return ((bitmap >> position) << (position + 1)) | (bitmap & ((1 << position) - 1))
+    
+    def _insert_slot_locked(self, key):
+        """按 (created_at, id) 顺序插入槽位，返回槽位号"""
+        position = bisect.bisect_left(self._keys, key)
+        self._keys.insert(position, key)
+        if position < len(self._keys) - 1:
+            insert_bit = self._insert_bit
+            for bitmaps in self._bitmaps.values():
+                for value, bitmap in bitmaps.items():
+                    bitmaps[value] = insert_bit(bitmap, position)
+            self._price_slices = [insert_bit(bitmap, position) for bitmap in self._price_slices]
+            self._priced = insert_bit(self._priced, position)
+            self._all = insert_bit(self._all, position)
+        return position
+    
+    def _slot(self, listing_id):
+        return bisect.bisect_left(self._keys, self._listing_keys[listing_id])
+    
+    def _add_locked(self, row):
+        listing_id = row['id']
+        key = self._listing_keys.get(listing_id)
+        if key is None:
+            key = self._listing_keys[listing_id] = (row['created_at'] or '', listing_id)
+            slot = self._insert_slot_locked(key)
+        else:
+            slot = self._slot(listing_id)
+        bit = 1 << slot
+        values = self._row_values(row)
+        for field, value in values.items():
+            bitmaps = self._bitmaps[field]
+            bitmaps[value] = bitmaps.get(value, 0) | bit
+        self._values[listing_id] = values
+        if row['price'] is not None:
+            cents = self._cents(row['price'])
+            for i in range(cents.bit_length()):
+                if cents >> i & 1:
+                    self._price_slices[i] |= bit
+            self._priced |= bit
+        self._all |= bit
+    
+    def _remove_locked(self, listing_id):
+        values = self._values.pop(listing_id, None)
+        if values is None:
+            return
+        bit = 1 << self._slot(listing_id)
+        for field, value in values.items():
+            bitmaps = self._bitmaps[field]
+            remaining = bitmaps[value] & ~bit
+            if remaining:
+                bitmaps[value] = remaining
+            else:
+                del bitmaps[value]
+        if self._priced & bit:
+            for i, price_slice in enumerate(self._price_slices):
+                if price_slice & bit:
+                    self._price_slices[i] = price_slice & ~bit
+            self._priced &= ~bit
+        self._all &= ~bit
+    
+    def _apply(self, listing_id, row):
+        """按物品当前行更新各位图（任何状态都收录，删除则清位）"""
+        with self._lock:
+            self._remove_locked(listing_id)
+            if row is not None:
+                self._add_locked(row)
+    
+    def _price_compare(self, price):
+        """位切片比较，返回 (价格 < price 的位图, 价格 == price 的位图)，按分比较"""
+        cents = self._cents(price)
+        less, equal = 0, self._priced
+        for i in range(self.PRICE_BITS - 1, -1, -1):
+            if cents >> i & 1:
+                less |= equal & ~self._price_slices[i]
+                equal &= self._price_slices[i]
+            else:
+                equal &= ~self._price_slices[i]
+        return less, equal
+    
+    def _price_range(self, min_price, max_price):
+        """价格在 [min_price, max_price] 内的位图"""
+        result = self._priced
+        if min_price is not None:
+            result &= ~self._price_compare(min_price)[0]
+        if max_price is not None:
+            less, equal = self._price_compare(max_price)
+            result &= less | equal
+        return result
+    
+    def _evaluate(self, expr):
+        """
+        求值筛选表达式
+        
+        {'and': [...]} / {'or': [...]} / {'not': 表达式}，或字段字典：
+        各字段之间为 AND，字段值为列表时取 OR；min_price/max_price 为价格区间
+        """
+        if 'and' in expr or 'or' in expr or 'not' in expr:
+            if len(expr) != 1:
+                raise ValueError('组合条件只能包含一个 and/or/not')
+            (op, operand), = expr.items()
+            if op == 'not':
+                return self._all & ~self._evaluate(operand)
+            bitmaps = [self._evaluate(item) for item in operand]
+            result = bitmaps[0] if bitmaps else (self._all if op == 'and' else 0)
+            for bitmap in bitmaps[1:]:
+                result = result & bitmap if op == 'and' else result | bitmap
+            return result
+        
+        result = self._all
+        if expr.get('min_price') is not None or expr.get('max_price') is not None:
+            result &= self._price_range(expr.get('min_price'), expr.get('max_price'))
+        for field, value in expr.items():
+            if field in ('min_price', 'max_price'):
+                continue
+            if field not in self.FIELDS:
+                raise ValueError(f'不支持的筛选字段: {field}')
+            bitmaps = self._bitmaps[field]
+            if isinstance(value, (list, tuple, set)):
+                union = 0
+                for item in value:
+                    union |= bitmaps.get(item, 0)
+                result &= union
+            else:
+                result &= bitmaps.get(value, 0)
+        return result
+    
+    @staticmethod
+    def _offset_boundary(bitmap, offset):
+        """
+        跳过最高的 offset 个置位后剩余部分的槽位上界
+        
+        二分查找最大的 p 使 bitmap >> p 仍含至少 offset 个置位，
+        只需 O(log n) 次整体移位计数，不逐位清除
+        """
+        low, high = 0, bitmap.bit_length()
+        while low < high:
+            middle = (low + high + 1) // 2
+            if _bit_count(bitmap >> middle) >= offset:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+    
+    def query(self, expr, limit=50, offset=0, after=None):
+        """
+        按发布时间倒序返回一页满足条件的物品 id
+        
+        after 为上一页最后一条的 (created_at, id)，提供时忽略 offset；
+        offset 同样先换算成槽位上界，和 after 一样按键集截断位图。
+        返回 (id 列表, 满足条件的总数)
+        """
+        with self._lock:
+            self._queries += 1
+            bitmap = self._evaluate(expr or {})
+            total = _bit_count(bitmap)
+            if after is not None:
+                boundary = bisect.bisect_left(self._keys, tuple(after))
+            elif offset >= total:
+                boundary = 0
+            elif offset > 0:
+                boundary = self._offset_boundary(bitmap, offset)
+            else:
+                boundary = None
+            if boundary is not None:
+                bitmap &= (1 << boundary) - 1
+            
+            listing_ids = []
+            while bitmap and len(listing_ids) < limit:
+                slot = bitmap.bit_length() - 1
+                listing_ids.append(self._keys[slot][1])
+                bitmap ^= 1 << slot
+        return listing_ids, total
+    
+    def _stats_locked(self):
+        return {
+            'listings': len(self._values),
+            'slots': len(self._keys),
+            'bitmaps': sum(len(bitmaps) for bitmaps in self._bitmaps.values()),
+            'bytes': sum((bitmap.bit_length() + 7) // 8
+                         for bitmaps in self._bitmaps.values() for bitmap in bitmaps.values()) +
+                     sum((bitmap.bit_length() + 7) // 8 for bitmap in self._price_slices),
+            'queries': self._queries,
+            'built_at': self._built_at.isoformat() if self._built_at else None
+        }
+
+
+_bitmap_index = ListingBitmapIndex()
+
+
+def build_bitmap_index():
+    """构建物品筛选位图并订阅物品变更"""
+    count = _bitmap_index.build()
+    db.register_listing_listener(_bitmap_index.on_listing_change)
+    return count
+
+
+def browse_listings(expr=None, limit=50, offset=0, after=None):
+    """
+    多条件浏览物品（按发布时间倒序）
+    
+    expr 为筛选表达式，如 {'status': 'active', 'category': ['textbook', 'electronics'],
+    'community_id': [1, 3], 'min_price': 10, 'has_images': True}，
+    也可用 {'or': [...]} / {'and': [...]} / {'not': ...} 任意组合，见 ListingBitmapIndex。
+    after 为上一页返回的游标（提供时忽略 offset）。返回 (物品列表, 满足条件的总数)；
+    位图未构建时返回 None，由调用方回退到 get_listings
+    """
+    if not _bitmap_index.ready:
+        return None
+    listing_ids, total = _bitmap_index.query(expr, limit, offset, db.decode_cursor(after) if after else None)
+    listings = db.get_listings_by_ids(listing_ids)
+    # 加上尚未写回的浏览量，与物品详情、首页信息流一致
+    for listing in listings:
+        listing['view_count'] += db.get_pending_views(listing['id'])
+    return listings, total
+
+
 def search_by_category_stats():
-    """获取各分类的商品统计"""
+    """获取各分类的商品统计（读取由触发器维护的 category_stats 汇总表）"""
     with db.get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT 
                 category,
-                COUNT(*) as count,
-                AVG(price) as avg_price,
-                MIN(price) as min_price,
-                MAX(price) as max_price
-            FROM listings
-            WHERE status = 'active'
-            GROUP BY category
-            ORDER BY count DESC
+                listing_count as count,
+                price_sum / listing_count as avg_price,
+                min_price,
+                max_price
+            FROM category_stats
+            ORDER BY listing_count DESC
         ''')
         
         results = []
@@ -0,0 +1,24 @@
+import contextlib
+import io
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules import db
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """指向临时文件的新数据库（已建表并插入示例数据）"""
+    monkeypatch.setattr(db, 'DATABASE_PATH', str(tmp_path / 'marketplace.db'))
+    db.close_pool()
+    with contextlib.redirect_stdout(io.StringIO()):
+        db.init_database()
+        db.insert_sample_data()
+    db._result_cache.clear()
+    yield db
+    db.flush_view_counts()
+    db.close_pool()
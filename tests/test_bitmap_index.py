@@ -0,0 +1,44 @@
+from modules import search
+
+
+def _insert_listing(db, created_at, category='textbook'):
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO listings (user_id, title, price, category, community_id, created_at)
+            VALUES (1, 'imported', 12.5, ?, 1, ?)
+        ''', (category, created_at))
+        return cursor.lastrowid
+
+
+def test_out_of_order_listing_inserted_in_place(fresh_db):
+    db = fresh_db
+    index = search.ListingBitmapIndex()
+    index.build()
+    db.register_listing_listener(index.on_listing_change)
+    try:
+        newest = _insert_listing(db, '2999-01-01 00:00:00')
+        db._notify_listing_change('created', newest)
+        oldest = _insert_listing(db, '2000-01-01 00:00:00', category='furniture')
+        db._notify_listing_change('created', oldest)
+    finally:
+        db._listing_listeners.remove(index.on_listing_change)
+    
+    fresh = search.ListingBitmapIndex()
+    fresh.build()
+    for expr in (None, {'category': 'furniture'}, {'min_price': 12, 'max_price': 13}):
+        assert index.query(expr, 100) == fresh.query(expr, 100)
+    listing_ids, _ = index.query(None, 100)
+    assert listing_ids[0] == newest and listing_ids[-1] == oldest
+
+
+def test_browse_applies_pending_views(fresh_db, monkeypatch):
+    db = fresh_db
+    index = search.ListingBitmapIndex()
+    index.build()
+    monkeypatch.setattr(search, '_bitmap_index', index)
+    before = {listing['id']: listing['view_count'] for listing in search.browse_listings({'status': 'active'})[0]}
+    listing_id = next(iter(before))
+    db.increment_view_count(listing_id)
+    after = {listing['id']: listing['view_count'] for listing in search.browse_listings({'status': 'active'})[0]}
+    assert after[listing_id] == before[listing_id] + 1
@@ -0,0 +1,77 @@
+import pytest
+
+
+def _count_communities(db):
+    with db.get_db() as conn:
+        return conn.execute('SELECT COUNT(*) FROM communities').fetchone()[0]
+
+
+def test_outer_rollback_discards_inner_write_after_read(fresh_db):
+    db = fresh_db
+    before = _count_communities(db)
+    
+    with pytest.raises(RuntimeError):
+        with db.get_db() as conn:
+            # 外层只读过，尚未开启事务
+            conn.execute('SELECT COUNT(*) FROM listings').fetchone()
+            with db.get_db() as inner:
+                inner.execute("INSERT INTO communities (name, type) VALUES ('tmp', 'university')")
+            raise RuntimeError('outer failed')
+    
+    assert _count_communities(db) == before
+
+
+def test_inner_rollback_keeps_outer_write(fresh_db):
+    db = fresh_db
+    before = _count_communities(db)
+    
+    with db.get_db() as conn:
+        conn.execute("INSERT INTO communities (name, type) VALUES ('kept', 'university')")
+        with pytest.raises(RuntimeError):
+            with db.get_db() as inner:
+                inner.execute("INSERT INTO communities (name, type) VALUES ('dropped', 'university')")
+                raise RuntimeError('inner failed')
+    
+    with db.get_db() as conn:
+        names = {row[0] for row in conn.execute('SELECT name FROM communities')}
+    assert _count_communities(db) == before + 1
+    assert 'kept' in names and 'dropped' not in names
+
+
+def test_write_queue_group_commits_batch(fresh_db):
+    import sqlite3
+    
+    db = fresh_db
+    writer = db.WriteQueue(window_ms=200)
+    visible = []
+    
+    def count_outside(cursor):
+        # 另开连接观察：组提交时同批的写入在提交前不可见
+        with sqlite3.connect(db.DATABASE_PATH) as other:
+            return other.execute("SELECT COUNT(*) FROM communities WHERE name LIKE 'batch-%'").fetchone()[0]
+    
+    def insert(i):
+        def op(cursor):
+            visible.append(count_outside(cursor))
+            cursor.execute("INSERT INTO communities (name, type) VALUES (?, 'university')", (f'batch-{i}',))
+            return i
+        return op
+    
+    def fail(cursor):
+        cursor.execute("INSERT INTO communities (name, type) VALUES ('batch-failed', 'university')")
+        raise ValueError('op failed')
+    
+    futures = [writer.submit(insert(i)) for i in range(3)]
+    futures.append(writer.submit(fail))
+    futures += [writer.submit(insert(i)) for i in range(3, 5)]
+    
+    assert [f.result() for i, f in enumerate(futures) if i != 3] == [0, 1, 2, 3, 4]
+    with pytest.raises(ValueError):
+        futures[3].result()
+    writer.shutdown()
+    
+    assert writer.stats()['batches'] == 1
+    assert visible == [0] * 5
+    with db.get_db() as conn:
+        names = {row[0] for row in conn.execute("SELECT name FROM communities WHERE name LIKE 'batch-%'")}
+    assert names == {f'batch-{i}' for i in range(5)}
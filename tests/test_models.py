@@ -0,0 +1,36 @@
+from modules import models
+
+
+def test_listing_record_decodes_images_lazily(fresh_db):
+    db = fresh_db
+    listing_id = db.create_listing(user_id=1, title='lamp', price=5, category='furniture', community_id=1,
+                                   images=['a.png', 'b.png'])
+    with db.get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT l.*, u.nickname, u.verify_status, u.avatar, 1 as score
+            FROM listings l JOIN users u ON l.user_id = u.id WHERE l.id = ?
+        ''', (listing_id,))
+        record = db.listing_row_mapper(cursor).hydrate(cursor.fetchone())
+    assert isinstance(record, models.Listing)
+    assert record._images is None
+    assert record.images == ['a.png', 'b.png']
+    data = record.to_dict()
+    assert set(data['user']) == {'id', 'nickname', 'verify_status', 'avatar'}
+    assert data['user']['id'] == 1
+    assert data['score'] == 1
+    assert db.get_listing_by_id(listing_id)['images'] == ['a.png', 'b.png']
+
+
+def test_decode_images_is_bounded_lru(monkeypatch):
+    monkeypatch.setattr(models, 'IMAGE_DECODE_CACHE_SIZE', 2)
+    models._decoded_images.clear()
+    models.decode_images('["a"]')
+    models.decode_images('["b"]')
+    models.decode_images('["a"]')
+    models.decode_images('["c"]')
+    assert list(models._decoded_images) == ['["a"]', '["c"]']
+    assert models.decode_images('not json') == []
+    images = models.decode_images('["a"]')
+    images.append('x')
+    assert models.decode_images('["a"]') == ['a']
@@ -0,0 +1,32 @@
+import contextlib
+import io
+
+
+def test_normalize_isbn_converts_only_valid_isbn10(fresh_db):
+    db = fresh_db
+    assert db.normalize_isbn('0-306-40615-2') == '9780306406157'
+    assert db.normalize_isbn('030640615x') == '030640615X'
+    assert db.normalize_isbn('978-0-306-40615-7') == '9780306406157'
+    assert db.normalize_isbn('X306406152') == 'X306406152'
+    # 校验位错误的 ISBN-10 不转换
+    assert db.normalize_isbn('0-306-40615-3') == '0306406153'
+    assert db.normalize_isbn('0-8044-2957-X') == '9780804429573'
+    assert db.normalize_isbn('') == ''
+
+
+def test_listing_with_malformed_isbn(fresh_db):
+    db = fresh_db
+    listing_id = db.create_listing(user_id=1, title='bad isbn', price=10, category='textbook',
+                                   community_id=1, isbn='X306406152')
+    assert db.get_listing_by_id(listing_id)['isbn_norm'] == 'X306406152'
+    db.update_listing(listing_id, isbn='X-306-40615-2')
+    assert db.get_listing_by_id(listing_id)['isbn_norm'] == 'X306406152'
+
+
+def test_init_database_backfills_malformed_isbn(fresh_db):
+    db = fresh_db
+    with db.get_db() as conn:
+        conn.execute("UPDATE listings SET isbn = 'X306406152', isbn_norm = NULL WHERE id = 1")
+    with contextlib.redirect_stdout(io.StringIO()):
+        db.init_database()
+    assert db.get_listing_by_id(1)['isbn_norm'] == 'X306406152'
@@ -0,0 +1,34 @@
+def test_production_queries_use_indexes(fresh_db):
+    db = fresh_db
+    problems = [problem for problem in db.audit_query_plans() if not problem['exempt']]
+    assert problems == []
+
+
+def test_exemptions_cover_only_listed_steps(fresh_db):
+    db = fresh_db
+    assert db._plan_exemption('get_trending_items', 'USE TEMP B-TREE FOR ORDER BY')
+    assert db._plan_exemption('get_trending_items', 'SCAN l') is None
+    assert db._plan_exemption('get_listings', 'SCAN l USING INDEX idx_listings_created') is None
+
+
+def test_limit_does_not_hide_index_scan(fresh_db):
+    db = fresh_db
+    with db.get_db() as conn:
+        # WHERE 不匹配索引前缀，只能整条索引遍历
+        sql = "SELECT id FROM listings WHERE title = 'x' ORDER BY created_at DESC LIMIT 10"
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+    assert db._plan_problems(sql, plan)
+
+
+def test_notifications_init_drops_superseded_indexes(fresh_db):
+    from modules import notifications
+    
+    db = fresh_db
+    with db.get_db() as conn:
+        conn.execute('CREATE INDEX idx_notifications_user ON notifications(user_id)')
+        conn.execute('CREATE INDEX idx_notifications_unread ON notifications(user_id, is_read)')
+    notifications.init_notifications_table()
+    with db.get_db() as conn:
+        names = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert not names & {'idx_notifications_user', 'idx_notifications_unread'}
+    assert {'idx_notifications_user_created', 'idx_notifications_user_unread_created'} <= names
@@ -0,0 +1,20 @@
+def test_all_category_entry_dropped_on_create(fresh_db):
+    db = fresh_db
+    # status='all' 绕过热门动态缓存，直接走结果缓存
+    before = db.get_listings(community_id=1, category='all', status='all')
+    assert db._result_cache.stats()['entries'] == 1
+
+    listing_id = db.create_listing(user_id=1, title='cache test', price=5, category='textbook', community_id=1)
+    assert db._result_cache.stats()['entries'] == 0
+
+    after = db.get_listings(community_id=1, category='all', status='all')
+    assert listing_id in {item['id'] for item in after}
+    assert len(after) == len(before) + 1
+
+
+def test_cache_scope_normalizes_wildcards(fresh_db):
+    db = fresh_db
+    assert db.cache_scope('all', 'all', None) == (None, None, None)
+    assert db.cache_scope('', '', 0) == (None, None, None)
+    assert db.cache_scope('3', 'textbook', '7') == (3, 'textbook', 7)
+    assert db.cache_scope([1, 2], ['textbook'], None) == (None, None, None)